@@ -1,4 +1,6 @@
 import os, io, logging, json, time, re
+import logging.handlers
+import sys
 from datetime import datetime
 from threading import Condition
 import threading
@@ -6,20 +8,44 @@ import argparse
 import subprocess  # For running libcamera-vid command
 import signal      # For handling process signals
 import shlex       # For properly escaping command arguments
+import tempfile
+import queue
+import mmap
+import struct
+import collections
+import concurrent.futures
+import sqlite3
+import base64
+import hashlib
+import shutil
+import bisect
+import itertools
+import mimetypes
+import functools
+import copy
+import asyncio
+import socket
 
-from flask import Flask, render_template, request, jsonify, Response, send_file, abort, session
+from flask import Flask, render_template, request, jsonify, Response, send_file, abort, session, url_for, make_response
 
 import secrets
+import urllib.parse
+
+try:
+    import uvicorn  # Optional, only used by --server asgi
+except ImportError:
+    uvicorn = None
 
 from PIL import Image
+import numpy as np
 
 from gpiozero import Button, LED
 
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
 from picamera2.encoders import JpegEncoder
 from picamera2.encoders import MJPEGEncoder
 from picamera2.encoders import H264Encoder
-from picamera2.outputs import FileOutput
+from picamera2.outputs import FileOutput, Output
 from libcamera import Transform, controls
 
 # Init Flask
@@ -29,6 +55,79 @@ app.secret_key = secrets.token_hex(16)  # Generates a random 32-character hexade
 app.config["SESSION_COOKIE_SAMESITE"] = "None"
 Picamera2.set_logging(Picamera2.DEBUG)
 
+class RateLimitFilter(logging.Filter):
+    """Lets at most rate records per interval seconds through for each logging call site.
+
+    Per-frame and per-chunk messages keep a sample instead of flooding the log; how
+    many were held back is appended to the next message that gets through.
+    """
+    def __init__(self, rate=10, interval=10.0):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.windows = {}   # (pathname, lineno) -> [window start, passed, suppressed]
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            window = self.windows.get(key)
+            held_back = 0
+            if window is None or record.created - window[0] >= self.interval:
+                held_back = window[2] if window else 0
+                window = self.windows[key] = [record.created, 0, 0]
+            if window[1] >= self.rate:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+            window[1] += 1
+        if held_back:
+            record.msg = f"{record.msg} ({held_back} similar messages suppressed)"
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler on a bounded queue that drops records instead of blocking the caller"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Capture, stream and polling paths log through a queue, a listener thread does the
+# actual (possibly blocking) writes to stdout so journald back-pressure never stalls them
+log_queue = queue.Queue(maxsize=10000)
+log_handler = DroppingQueueHandler(log_queue)
+log_handler.addFilter(RateLimitFilter())
+log_listener = None
+
+def setup_logging(level='INFO', module_levels=None):
+    """Send the webui loggers through the queue, module_levels maps e.g. 'stream' to 'DEBUG'"""
+    global log_listener
+    webui_log = logging.getLogger('webui')
+    webui_log.setLevel(level)
+    webui_log.propagate = False
+    if log_handler not in webui_log.handlers:
+        webui_log.addHandler(log_handler)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(f'webui.{name}').setLevel(module_level)
+    if log_listener is None:
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        log_listener = logging.handlers.QueueListener(log_queue, console)
+        log_listener.start()
+
+stream_log = logging.getLogger('webui.stream')        # Frame hub, live viewers
+capture_log = logging.getLogger('webui.capture')      # libcamera-vid process
+recording_log = logging.getLogger('webui.recording')  # Recording and event clip writers
+http_log = logging.getLogger('webui.http')            # Status polling routes
+media_log = logging.getLogger('webui.media')          # Gallery catalog, thumbnails, previews, retention
+setup_logging()
+
 # Get global camera information
 global_cameras = Picamera2.global_camera_info()
 # global_cameras = [global_cameras[0]]
@@ -125,10 +224,335 @@ os.makedirs(app.config['CAMERA_CONFIG_FOLDER'], exist_ok=True)
 # Set the path where the images will be stored
 UPLOAD_FOLDER = os.path.join(current_dir, 'static/gallery')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+GALLERY_PAGE_SIZE = 24
 
-class StreamingOutput(io.BufferedIOBase):
+class MetricSeries:
+    """One labelled series of a counter or histogram"""
+    __slots__ = ('lock', 'value', 'buckets', 'counts', 'count')
+
+    def __init__(self, lock, buckets=None):
+        self.lock = lock
+        self.value = 0        # Counter value, or the sum of a histogram's observations
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) if buckets else None
+        self.count = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.value += value
+            self.count += 1
+
+class Metric:
+    """A named counter, histogram or gauge with its label names"""
+    def __init__(self, lock, kind, name, documentation, labelnames=(), buckets=None, callback=None):
+        self.lock = lock
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if buckets else None
+        self.callback = callback
+        self.series = {}
+
+    def labels(self, *values):
+        """The series of these label values, created on first use; hot paths keep the result"""
+        values = tuple(str(value) for value in values)
+        series = self.series.get(values)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(values, MetricSeries(self.lock, self.buckets))
+        return series
+
+    def remove(self, *values):
+        with self.lock:
+            self.series.pop(tuple(str(value) for value in values), None)
+
+    def _label_text(self, values, extra=''):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if self.callback:
+            for values, value in self.callback():
+                lines.append(f"{self.name}{self._label_text(values)} {value}")
+            return lines
+        with self.lock:
+            series = [(values, item.value, list(item.counts) if item.counts else None, item.count)
+                      for values, item in self.series.items()]
+        for values, value, counts, count in series:
+            if counts is None:
+                lines.append(f"{self.name}{self._label_text(values)} {value}")
+                continue
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._label_text(values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(values)} {value}")
+            lines.append(f"{self.name}_count{self._label_text(values)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Prometheus counters, histograms and gauges rendered by /metrics in the text format.
+
+    Hot paths look up their labelled series once and then only take a short lock to
+    add to it, so counting a frame costs about a microsecond and the metrics can
+    stay on in production. Gauges are read from a callback at scrape time instead.
+    """
     def __init__(self):
-        self.buffer = io.BytesIO()
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def _add(self, *args, **kwargs):
+        metric = Metric(self.lock, *args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add('counter', name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=()):
+        return self._add('histogram', name, documentation, labelnames, buckets=buckets)
+
+    def gauge(self, name, documentation, labelnames, callback):
+        """callback returns (label values, value) pairs when the metrics are scraped"""
+        return self._add('gauge', name, documentation, labelnames, callback=callback)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                http_log.warning(f"Could not render metric {metric.name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metric_frames_captured = metrics.counter('picamera_frames_captured_total', 'Frames published on the camera hub', ['camera'])
+metric_frame_bytes = metrics.histogram('picamera_frame_bytes', 'Size of published JPEG frames', ['camera'],
+                                       buckets=(16384, 32768, 65536, 131072, 262144, 524288, 1048576, 2097152))
+metric_frames_delivered = metrics.counter('picamera_frames_delivered_total', 'Frames sent to one live stream viewer', ['camera', 'viewer'])
+metric_frames_dropped = metrics.counter('picamera_frames_dropped_total', 'Frames a consumer skipped or could not keep', ['camera', 'consumer'])
+metric_viewer_skipped = metrics.counter('picamera_viewer_frames_skipped_total', 'Stale frames one live stream viewer skipped', ['camera', 'viewer'])
+metric_send_latency = metrics.histogram('picamera_capture_to_send_seconds', 'Time from a frame reaching the hub until a viewer sent it', ['camera'],
+                                        buckets=(0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0))
+metric_pipe_read_bytes = metrics.histogram('picamera_pipe_read_bytes', 'Bytes per read from the libcamera-vid pipe', ['camera'],
+                                           buckets=(1024, 4096, 8192, 16384, 32768, 65536))
+metric_pipeline_restarts = metrics.counter('picamera_pipeline_restarts_total', 'Capture pipeline restarts of a running session', ['camera'])
+
+class FrameRingBuffer:
+    """Preallocated, fixed-capacity ring of complete frames.
+
+    Every slot owns a bytearray allocated up front together with a memoryview over
+    it, a sequence number and a capture timestamp. Writers copy a frame into the
+    next slot without reallocating, readers get zero-copy memoryviews of frame N or
+    of the latest frame. A view stays valid until the writer wraps around to its
+    slot again, readers that hold on to one can check that with is_valid().
+    """
+    def __init__(self, capacity=8, slot_size=512 * 1024):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.storage = [bytearray(slot_size) for _ in range(capacity)]
+        self.views = [memoryview(buf) for buf in self.storage]
+        self.sizes = [0] * capacity
+        self.sequences = [0] * capacity    # 0 means the slot is empty or being written
+        self.timestamps = [0.0] * capacity
+        self.sequence = 0                  # Sequence number of the newest complete frame
+
+    def write(self, frame, timestamp=None):
+        """Copy one frame into the next slot and return its sequence number"""
+        size = len(frame)
+        sequence = self.sequence + 1
+        index = sequence % self.capacity
+        
+        # Invalidate the slot first so readers never see a half-written frame as valid
+        self.sequences[index] = 0
+        if size > len(self.storage[index]):
+            # Only happens when a frame is bigger than anything seen before, grow the slot once
+            stream_log.debug(f"Frame of {size} bytes exceeds slot size {len(self.storage[index])}, growing slot")
+            self.storage[index] = bytearray(max(size, 2 * len(self.storage[index])))
+            self.views[index] = memoryview(self.storage[index])
+        self.views[index][:size] = frame
+        self.sizes[index] = size
+        self.timestamps[index] = time.time() if timestamp is None else timestamp
+        self.sequences[index] = sequence
+        self.sequence = sequence
+        return sequence
+
+    def get(self, sequence):
+        """Return (sequence, timestamp, memoryview) for frame N, or None if it has been overwritten"""
+        if sequence <= 0:
+            return None
+        index = sequence % self.capacity
+        if self.sequences[index] != sequence:
+            return None
+        return sequence, self.timestamps[index], self.views[index][:self.sizes[index]]
+
+    def latest(self):
+        """Return (sequence, timestamp, memoryview) for the newest frame, or None if empty"""
+        return self.get(self.sequence)
+
+    def is_valid(self, sequence):
+        """Check that a previously returned view has not been overwritten by the writer"""
+        return sequence > 0 and self.sequences[sequence % self.capacity] == sequence
+
+class JpegFrameSplitter:
+    """Incremental, marker-aware splitter for an MJPEG byte stream.
+
+    Data is read straight into a reusable buffer and the scan position is kept
+    across reads, so every byte is looked at once. Marker segments are skipped by
+    their length field and only an EOI marker inside entropy-coded data ends a
+    frame, so an FFD9 pair inside an EXIF thumbnail or segment payload is not
+    mistaken for the end of the frame. Frames are yielded as memoryviews into the
+    buffer and are only valid until the next read.
+    """
+    SEEK_SOI = 0
+    MARKERS = 1
+    ENTROPY = 2
+
+    def __init__(self, capacity=1024 * 1024, max_frame_size=32 * 1024 * 1024):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.max_frame_size = max_frame_size
+        self.start = 0      # Start of the frame being parsed (or of unconsumed data)
+        self.pos = 0        # Scan position
+        self.end = 0        # End of valid data
+        self.state = self.SEEK_SOI
+        self.frames_found = 0
+        self.bytes_discarded = 0
+
+    def _reserve(self, size):
+        """Make room for at least size more bytes, moving the unconsumed tail to the front"""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start > 0:
+            self.view[:pending] = self.view[self.start:self.end]
+            self.pos -= self.start
+            self.start = 0
+            self.end = pending
+        if len(self.buffer) - self.end < size:
+            # Only a frame bigger than the whole buffer gets here, grow it once
+            grown = bytearray(max(2 * len(self.buffer), pending + size))
+            grown[:pending] = self.buffer[:pending]
+            self.buffer = grown
+            self.view = memoryview(self.buffer)
+
+    def read_from(self, stream, size=32768):
+        """Read up to size bytes from a buffered stream straight into the buffer"""
+        self._reserve(size)
+        count = stream.readinto1(self.view[self.end:self.end + size])
+        if count:
+            self.end += count
+        return count
+
+    def feed(self, data):
+        """Append data that was read elsewhere"""
+        size = len(data)
+        self._reserve(size)
+        self.view[self.end:self.end + size] = data
+        self.end += size
+
+    def _resync(self, pos):
+        """Throw away a broken frame and look for the next SOI from pos"""
+        self.bytes_discarded += pos - self.start
+        self.start = self.pos = pos
+        self.state = self.SEEK_SOI
+
+    def frames(self):
+        """Yield every complete frame currently in the buffer"""
+        buf = self.buffer
+        end = self.end
+        while True:
+            if self.state != self.SEEK_SOI and self.pos - self.start > self.max_frame_size:
+                capture_log.debug(f"Frame exceeded {self.max_frame_size} bytes without EOI, resynchronising")
+                self._resync(self.pos)
+            if self.state == self.SEEK_SOI:
+                idx = buf.find(b'\xff\xd8', self.pos, end)
+                if idx < 0:
+                    # Keep a trailing 0xFF, it may be the first half of the next SOI
+                    keep = end - 1 if end > self.pos and buf[end - 1] == 0xFF else end
+                    self._resync(keep)
+                    return
+                self._resync(idx)
+                self.pos = idx + 2
+                self.state = self.MARKERS
+            elif self.state == self.MARKERS:
+                pos = self.pos
+                # Skip fill bytes in front of the marker
+                while pos + 1 < end and buf[pos] == 0xFF and buf[pos + 1] == 0xFF:
+                    pos += 1
+                self.pos = pos
+                if pos + 2 > end:
+                    break
+                if buf[pos] != 0xFF:
+                    self._resync(pos)
+                    continue
+                marker = buf[pos + 1]
+                if marker == 0xD9:
+                    frame_end = pos + 2
+                    self.frames_found += 1
+                    yield self.view[self.start:frame_end]
+                    self.start = self.pos = frame_end
+                    self.state = self.SEEK_SOI
+                elif marker == 0xD8:
+                    # A new SOI before EOI, the previous frame was truncated
+                    self._resync(pos)
+                elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                    self.pos = pos + 2
+                else:
+                    if pos + 4 > end:
+                        break
+                    length = (buf[pos + 2] << 8) | buf[pos + 3]
+                    if length < 2:
+                        self._resync(pos + 2)
+                        continue
+                    if pos + 2 + length > end:
+                        break
+                    self.pos = pos + 2 + length
+                    if marker == 0xDA:
+                        self.state = self.ENTROPY
+            else:
+                idx = buf.find(b'\xff', self.pos, end)
+                if idx < 0 or idx + 1 >= end:
+                    self.pos = end if idx < 0 else idx
+                    break
+                marker = buf[idx + 1]
+                if marker == 0x00 or 0xD0 <= marker <= 0xD7:
+                    # Stuffed byte or restart marker, still entropy-coded data
+                    self.pos = idx + 2
+                elif marker == 0xFF:
+                    self.pos = idx + 1
+                else:
+                    self.pos = idx
+                    self.state = self.MARKERS
+
+class StreamingOutput(io.BufferedIOBase):
+    """Broadcast hub holding the latest complete JPEG frame for one camera.
+
+    A single capture pipeline writes whole frames into the hub and any number of
+    viewers read from it, each keeping its own cursor (the last sequence number it
+    sent) so N viewers cost one encoder plus N socket writes.
+    """
+    def __init__(self, capacity=8, slot_size=512 * 1024, camera_num=None):
+        self.ring = FrameRingBuffer(capacity, slot_size)
+        self.camera_label = str(camera_num)
+        self.metric_frames = metric_frames_captured.labels(self.camera_label)
+        self.metric_frame_bytes = metric_frame_bytes.labels(self.camera_label)
+        self.metric_send_latency = metric_send_latency.labels(self.camera_label)
+        self.send_latency = 0.0    # Smoothed capture-to-send latency of the viewers in seconds
+        self.sinks = []            # Callables fed every frame, e.g. a recording tee
+        self.sinks_lock = threading.Lock()
+        self.viewers = 0           # Number of clients currently attached to the hub
         self.condition = Condition()
         self.frame_count = 0
         self.fps = 0.0
@@ -138,24 +562,16 @@ class StreamingOutput(io.BufferedIOBase):
         self.frame_intervals = []  # Keep track of recent frame intervals
         self.max_intervals = 30    # Store up to 30 frame intervals for averaging
         self.max_valid_fps = 120.0  # Maximum valid FPS value
-        print("DEBUG: StreamingOutput initialized")
+        stream_log.debug("StreamingOutput initialized")
 
     def write(self, buf):
+        """Publish one complete JPEG frame to every attached viewer"""
         try:
             current_time = time.time()
             buf_size = len(buf)
             
             if buf_size == 0:
-                print("DEBUG: Received empty buffer in write")
-                return
-            
-            try:
-                self.buffer.seek(0)
-                self.buffer.truncate()
-                self.buffer.write(buf)
-                self.frame_size = buf_size
-            except IOError as e:
-                print(f"DEBUG: Error writing to buffer: {e}")
+                stream_log.debug("Received empty buffer in write")
                 return
             
             # Calculate and validate frame interval
@@ -177,7 +593,7 @@ class StreamingOutput(io.BufferedIOBase):
                     
                     # Validate FPS value
                     if calculated_fps > self.max_valid_fps:
-                        print(f"DEBUG: Invalid FPS detected: {calculated_fps}, capping at {self.max_valid_fps}")
+                        stream_log.warning(f"Invalid FPS detected: {calculated_fps}, capping at {self.max_valid_fps}")
                         calculated_fps = self.max_valid_fps
                     
                     self.fps = round(calculated_fps, 1)
@@ -185,7 +601,7 @@ class StreamingOutput(io.BufferedIOBase):
                     # Calculate and validate average frame interval
                     if self.frame_intervals:
                         avg_interval = sum(self.frame_intervals) / len(self.frame_intervals)
-                        print(f"DEBUG: Actual FPS: {self.fps}, Avg interval: {avg_interval*1000:.1f}ms")
+                        stream_log.debug("Actual FPS: %s, Avg interval: %.1fms", self.fps, avg_interval * 1000)
                     
                     # Reset counters
                     self.frame_intervals = []
@@ -193,100 +609,783 @@ class StreamingOutput(io.BufferedIOBase):
                     self.last_time = current_time
                     
                 except (TypeError, ValueError, ZeroDivisionError) as e:
-                    print(f"DEBUG: FPS calculation error: {e}")
+                    stream_log.debug(f"FPS calculation error: {e}")
                     self.fps = 0.0
             
             with self.condition:
+                self.ring.write(buf, current_time)
+                self.frame_size = buf_size
                 self.condition.notify_all()
+            self.metric_frames.inc()
+            self.metric_frame_bytes.observe(buf_size)
+            
+            # Sinks must not block, they hand the frame over to their own thread
+            for sink in self.sinks:
+                sink(buf, current_time)
                 
         except Exception as e:
-            print(f"DEBUG: Error in StreamingOutput.write: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+            stream_log.exception(f"Error in StreamingOutput.write: {e}")
             self.fps = 0.0
 
+    @property
+    def sequence(self):
+        """Sequence number of the newest complete frame"""
+        return self.ring.sequence
+
+    def read_frame(self):
+        """Return a copy of the most recent complete frame, or None if nothing has been captured yet"""
+        with self.condition:
+            latest = self.ring.latest()
+            return bytes(latest[2]) if latest else None
+
+    def wait_for_frame(self, last_sequence, timeout=1.0):
+        """Block until a frame newer than last_sequence is available.
+
+        Returns a (sequence, timestamp, memoryview) tuple straight from the ring. A
+        viewer that fell behind gets the newest frame and skips the ones in between;
+        on timeout None is returned.
+        """
+        with self.condition:
+            if self.ring.sequence <= last_sequence:
+                self.condition.wait_for(lambda: self.ring.sequence > last_sequence, timeout=timeout)
+            if self.ring.sequence <= last_sequence:
+                return None
+            return self.ring.latest()
+
+    def capture_frame(self, fresh=False, timeout=2.0):
+        """Return a copy of the newest frame as (sequence, timestamp, bytes), or None on timeout.
+
+        With fresh=True the call waits for the first frame published after it was made,
+        otherwise an already published frame is returned without waiting.
+        """
+        with self.condition:
+            last_sequence = self.ring.sequence if fresh else 0
+            if self.ring.sequence <= last_sequence:
+                self.condition.wait_for(lambda: self.ring.sequence > last_sequence, timeout=timeout)
+            if self.ring.sequence <= last_sequence:
+                return None
+            # Writers hold the condition while filling a slot, so the copy can not tear
+            sequence, timestamp, view = self.ring.latest()
+            return sequence, timestamp, bytes(view)
+
+    def copy_frame_into(self, frame, last_sequence, timeout=1.0):
+        """Copy the frame after last_sequence into a BurstFrame, or the newest one if it was overwritten.
+
+        The frame's bytearray is reused and only grown when a frame does not fit.
+        Returns the copied sequence number, or None on timeout.
+        """
+        with self.condition:
+            if self.ring.sequence <= last_sequence:
+                self.condition.wait_for(lambda: self.ring.sequence > last_sequence, timeout=timeout)
+            if self.ring.sequence <= last_sequence:
+                return None
+            sequence, timestamp, view = self.ring.get(last_sequence + 1) or self.ring.latest()
+            if frame.data is None or len(frame.data) < len(view):
+                frame.data = bytearray(max(len(view), self.ring.slot_size))
+            frame.data[:len(view)] = view
+            frame.size = len(view)
+            frame.timestamp = timestamp
+            return sequence
+
+    def add_sink(self, sink):
+        # Copy on write, write() iterates a snapshot without taking the lock
+        with self.sinks_lock:
+            self.sinks = self.sinks + [sink]
+
+    def remove_sink(self, sink):
+        with self.sinks_lock:
+            self.sinks = [s for s in self.sinks if s != sink]
+
+    def add_viewer(self):
+        with self.condition:
+            self.viewers += 1
+            return self.viewers
+
+    def remove_viewer(self):
+        with self.condition:
+            self.viewers = max(0, self.viewers - 1)
+            return self.viewers
+
     def get_current_fps(self):
         """Get the current actual FPS"""
         return self.fps
 
+    def record_send_latency(self, latency):
+        """Called by a viewer once a frame captured latency seconds ago went out"""
+        self.metric_send_latency.observe(latency)
+        self.send_latency += (latency - self.send_latency) * 0.1
+
     def get_current_latency(self):
-        """Get the current frame latency in milliseconds"""
-        if not self.frame_intervals:
+        """Smoothed capture-to-send latency of the live viewers in milliseconds, 0 without viewers"""
+        if not self.viewers:
             return 0.0
-        # Use the most recent frame interval for latency
-        return self.frame_intervals[-1] * 1000  # Convert to milliseconds
+        return self.send_latency * 1000  # Convert to milliseconds
+
+class RecordingSegments:
+    """Segment rollover and manifest of one recording session.
+
+    The session is written as numbered segments <stem>_<index>.<ext>, each with its
+    own timecode file. The writer checks due() before each frame (each keyframe for
+    H.264) and rolls over between two frames, so nothing is lost or written twice at
+    a handoff. A closed segment goes to on_segment right away and is listed in
+    <stem>.manifest.json with its frames, bytes and times, so a crash costs at most
+    the open segment. With segment_seconds and segment_bytes both 0 there is one.
+    """
+    def __init__(self, directory, stem, extension, segment_seconds=0, segment_bytes=0, on_open=None, on_segment=None):
+        self.directory = directory
+        self.stem = stem
+        self.extension = extension
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.on_open = on_open
+        self.on_segment = on_segment
+        self.manifest_path = os.path.join(directory, f"{stem}.manifest.json")
+        self.started = datetime.now()
+        self.segments = []
+        self.current = None
+        self.finished = False
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def paths(self, index):
+        name = f"{self.stem}_{index:04d}"
+        return os.path.join(self.directory, f"{name}.{self.extension}"), os.path.join(self.directory, f"{name}_timestamps.txt")
+
+    def open(self):
+        """Start the next segment, returns its file and timecode paths"""
+        self.index += 1
+        path, pts_path = self.paths(self.index)
+        self.current = {'index': self.index, 'file': os.path.basename(path), 'frames': 0, 'bytes': 0,
+                        'start': None, 'end': None, 'opened': datetime.now().isoformat()}
+        if self.on_open:
+            self.on_open(path, pts_path)
+        self.write_manifest()
+        return path, pts_path
+
+    def add(self, size, timestamp):
+        """Account a written frame, timestamp in seconds"""
+        if self.current['start'] is None:
+            self.current['start'] = timestamp
+        self.current['end'] = timestamp
+        self.current['frames'] += 1
+        self.current['bytes'] += size
+
+    def due(self, timestamp):
+        """Whether a frame at timestamp belongs in a new segment"""
+        segment = self.current
+        if segment is None or not segment['frames']:
+            return False
+        return bool((self.segment_seconds and timestamp - segment['start'] >= self.segment_seconds) or
+                    (self.segment_bytes and segment['bytes'] >= self.segment_bytes))
+
+    def close(self, last=False):
+        """Finish the open segment and hand it to on_segment, empty segments are removed"""
+        segment, self.current = self.current, None
+        self.finished = last
+        if segment is None:
+            return
+        path, pts_path = self.paths(segment['index'])
+        if not segment['frames']:
+            for empty in (path, pts_path):
+                if os.path.exists(empty):
+                    os.remove(empty)
+            self.write_manifest()
+            return
+        segment['duration'] = round(segment['end'] - segment['start'], 3)
+        with self.lock:
+            self.segments.append(segment)
+        self.write_manifest()
+        if self.on_segment:
+            self.on_segment(self, segment, path, pts_path)
+
+    def segment_done(self, segment, filename):
+        """Record the final file name of a closed segment once it is muxed and cataloged"""
+        with self.lock:
+            segment['file'] = filename
+            segment['ready'] = True
+        self.write_manifest()
+
+    def files(self):
+        with self.lock:
+            return [segment['file'] for segment in self.segments]
+
+    def bytes_written(self):
+        with self.lock:
+            return sum(segment['bytes'] for segment in self.segments) + (self.current['bytes'] if self.current else 0)
+
+    def write_manifest(self):
+        with self.lock:
+            manifest = {
+                'recording': self.stem,
+                'started': self.started.isoformat(),
+                'segment_seconds': self.segment_seconds,
+                'segment_bytes': self.segment_bytes,
+                'state': 'finished' if self.finished else 'recording',
+                'segments': self.segments,
+                'current': self.current
+            }
+            try:
+                with open(f"{self.manifest_path}.tmp", 'w') as file:
+                    json.dump(manifest, file, indent=4)
+                os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+            except OSError as e:
+                recording_log.warning(f"Could not write recording manifest {self.manifest_path}: {e}")
+
+class MJPEGFileRecorder:
+    """Tee that writes every frame published on a StreamingOutput hub to a file.
+
+    Frames are copied into a bounded queue and written on the recorder's own thread,
+    so a slow SD card never stalls the capture thread or the live viewers. A
+    timecode v2 file with one timestamp per written frame is kept next to it.
+    Frames passed as preroll are written first, and with stop_at set the recorder
+    detaches itself once a frame newer than that time arrives. Given segments
+    (RecordingSegments) instead of a path, the file rolls over on frame boundaries.
+    """
+    def __init__(self, output, path=None, pts_path=None, max_queue=120, preroll=None, stop_at=None, on_close=None, segments=None):
+        self.output = output
+        self.path = path
+        self.pts_path = pts_path
+        self.max_queue = max_queue
+        self.queue = queue.Queue()
+        self.preroll = preroll or []
+        self.preroll_frames = len(self.preroll)
+        self.stop_at = stop_at
+        self.on_close = on_close
+        self.segments = segments
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.metric_dropped = metric_frames_dropped.labels(getattr(output, 'camera_label', None), 'recording')
+        self.thread = None
+        self.finished = False
+
+    def _open(self):
+        if self.segments:
+            self.path, self.pts_path = self.segments.open()
+        self.file = open(self.path, 'wb')
+        self.pts_file = open(self.pts_path, 'w') if self.pts_path else None
+        if self.pts_file:
+            self.pts_file.write("# timecode format v2\n")
+        self.first_timestamp = None
+
+    def _close(self):
+        self.file.close()
+        if self.pts_file:
+            self.pts_file.close()
+
+    def start(self):
+        self._open()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.output.add_sink(self.push)
+        return True
+
+    def push(self, frame, timestamp):
+        if self.finished:
+            return
+        if self.stop_at is not None and timestamp > self.stop_at:
+            self.finish()
+            return
+        # The queue is unbounded so the end marker always fits, the limit is applied here
+        if self.queue.qsize() >= self.max_queue:
+            self.frames_dropped += 1
+            self.metric_dropped.inc()
+            return
+        self.queue.put_nowait((bytes(frame), timestamp))
+
+    def finish(self):
+        """Detach from the hub, frames already queued are still written"""
+        self.finished = True
+        self.output.remove_sink(self.push)
+        self.queue.put(None)
+
+    def _write(self, frame, timestamp):
+        try:
+            if self.segments and self.segments.due(timestamp):
+                self._close()
+                self.segments.close()
+                self._open()
+            self.file.write(frame)
+            if self.pts_file:
+                if self.first_timestamp is None:
+                    self.first_timestamp = timestamp
+                self.pts_file.write(f"{(timestamp - self.first_timestamp) * 1000:.3f}\n")
+            if self.segments:
+                self.segments.add(len(frame), timestamp)
+            self.frames_written += 1
+        except OSError as e:
+            recording_log.warning(f"Error writing recording {self.path}: {e}")
+            self.frames_dropped += 1
+
+    def _run(self):
+        for frame, timestamp in self.preroll:
+            self._write(frame, timestamp)
+        self.preroll = []
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._write(*item)
+        self._close()
+        if self.segments:
+            self.segments.close(last=True)
+        recording_log.debug(f"Recording {self.path} closed, {self.frames_written} frames written, {self.frames_dropped} dropped")
+        if self.on_close:
+            self.on_close(self.path)
+
+    def is_alive(self):
+        return bool(self.thread and self.thread.is_alive())
+
+    def stop(self):
+        """Detach from the hub and wait until every queued frame is on disk"""
+        if not self.finished:
+            self.finish()
+        if self.thread:
+            self.thread.join()
+        return True
+
+class PreEventBuffer:
+    """Keeps the last few seconds of encoded frames of a hub in RAM.
+
+    The buffer is a hub sink, so it costs one copy per frame and never touches the
+    capture pipeline. Frames are evicted once they are older than `seconds` or when
+    the byte budget is exceeded, whichever comes first. trigger() writes the buffered
+    pre-roll followed by `post_seconds` of live frames to disk on a recorder thread.
+    """
+    def __init__(self, seconds=5, max_bytes=32 * 1024 * 1024):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.output = None
+        self.clips = []
+        self.lock = threading.Lock()
+
+    def attach(self, output):
+        """Follow a new hub, frames from the previous one are dropped"""
+        with self.lock:
+            if self.output is not None:
+                self.output.remove_sink(self.push)
+                # Clips on the old hub would wait forever for their post-roll
+                for clip in self.clips:
+                    if not clip.finished:
+                        clip.finish()
+            self.frames.clear()
+            self.bytes = 0
+            self.output = output
+            if output is not None:
+                output.add_sink(self.push)
+
+    def detach(self):
+        self.attach(None)
+
+    def configure(self, seconds, max_bytes):
+        with self.lock:
+            self.seconds = seconds
+            self.max_bytes = max_bytes
+            self._evict(time.time())
+
+    def push(self, frame, timestamp):
+        frame = bytes(frame)
+        with self.lock:
+            self.frames.append((frame, timestamp))
+            self.bytes += len(frame)
+            self._evict(timestamp)
+
+    def _evict(self, now):
+        while self.frames and (self.bytes > self.max_bytes or now - self.frames[0][1] > self.seconds):
+            frame, _ = self.frames.popleft()
+            self.bytes -= len(frame)
+
+    @property
+    def duration(self):
+        with self.lock:
+            if len(self.frames) < 2:
+                return 0.0
+            return self.frames[-1][1] - self.frames[0][1]
+
+    def latest(self):
+        """The newest buffered frame as (bytes, timestamp), or None"""
+        with self.lock:
+            return self.frames[-1] if self.frames else None
+
+    def trigger(self, path, pts_path=None, post_seconds=5, on_close=None):
+        """Start writing pre-roll plus post-roll to path, returns the clip recorder"""
+        with self.lock:
+            if self.output is None:
+                return None
+            now = time.time()
+            preroll = list(self.frames)
+            self.clips = [clip for clip in self.clips if clip.is_alive()]
+            clip = MJPEGFileRecorder(self.output, path, pts_path, preroll=preroll, stop_at=now + post_seconds,
+                                     on_close=on_close)
+            clip.start()
+            self.clips.append(clip)
+        recording_log.debug(f"Event clip {path}: {len(preroll)} pre-roll frames, {post_seconds}s post-roll")
+        return clip
+
+    def stop(self):
+        """Detach and finish any event clip still collecting post-roll"""
+        self.detach()
+        for clip in self.clips:
+            clip.stop()
+        self.clips = []
+
+def read_timecodes(pts_path):
+    """Read a timecode format v2 file into a list of millisecond timestamps"""
+    timestamps = []
+    try:
+        with open(pts_path) as file:
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    timestamps.append(float(line))
+    except (OSError, ValueError) as e:
+        recording_log.warning(f"Could not read timestamps from {pts_path}: {e}")
+    return timestamps
+
+def iter_h264_access_units(data):
+    """Split an Annex B H.264 stream into access units.
+
+    Yields (nal_units, is_keyframe) tuples, where nal_units is a list of
+    (start, end) offsets into data. Works on bytes, bytearrays and mmaps.
+    """
+    def nal_units():
+        pos = data.find(b'\x00\x00\x01')
+        while pos >= 0:
+            start = pos + 3
+            nxt = data.find(b'\x00\x00\x01', start)
+            end = len(data) if nxt < 0 else nxt
+            # A four byte start code leaves a zero in front of the next one
+            if nxt >= 0 and data[nxt - 1] == 0:
+                end -= 1
+            if end > start:
+                yield start, end
+            pos = nxt
+
+    units = []
+    has_slice = False
+    keyframe = False
+    for start, end in nal_units():
+        nal_type = data[start] & 0x1F
+        if nal_type in (1, 5):
+            # first_mb_in_slice == 0 starts a new picture
+            first_slice = end - start > 1 and data[start + 1] & 0x80
+            if has_slice and first_slice:
+                yield units, keyframe
+                units, has_slice, keyframe = [], False, False
+            has_slice = True
+            keyframe = keyframe or nal_type == 5
+        elif nal_type in (6, 7, 8, 9) and has_slice:
+            yield units, keyframe
+            units, has_slice, keyframe = [], False, False
+        units.append((start, end))
+    if has_slice:
+        yield units, keyframe
+
+def _mp4_box(box_type, *payload):
+    body = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(body), box_type) + body
+
+def _mp4_full_box(box_type, version, flags, *payload):
+    return _mp4_box(box_type, struct.pack('>I', (version << 24) | flags), *payload)
+
+def _mp4_init_segment(width, height, sps, pps, timescale):
+    """ftyp and moov boxes for a single fragmented H.264 track"""
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    avcc = struct.pack('>BBBBBB', 1, sps[1], sps[2], sps[3], 0xFF, 0xE1) + struct.pack('>H', len(sps)) + sps
+    avcc += struct.pack('>BH', 1, len(pps)) + pps
+    if sps[1] in (100, 110, 122, 144):
+        # High profiles carry chroma format and bit depth, the Pi encoder gives 8-bit 4:2:0
+        avcc += bytes((0xFC | 1, 0xF8, 0xF8, 0))
+    avc1 = _mp4_box(b'avc1', bytes(6), struct.pack('>HHH', 1, 0, 0), bytes(12),
+                    struct.pack('>HHIIIH', width, height, 0x480000, 0x480000, 0, 1),
+                    bytes(32), struct.pack('>Hh', 0x18, -1), _mp4_box(b'avcC', avcc))
+    stbl = _mp4_box(b'stbl',
+                    _mp4_full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+                    _mp4_full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+                    _mp4_full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+                    _mp4_full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+                    _mp4_full_box(b'stco', 0, 0, struct.pack('>I', 0)))
+    minf = _mp4_box(b'minf',
+                    _mp4_full_box(b'vmhd', 0, 1, bytes(8)),
+                    _mp4_box(b'dinf', _mp4_full_box(b'dref', 0, 0, struct.pack('>I', 1), _mp4_full_box(b'url ', 0, 1))),
+                    stbl)
+    mdia = _mp4_box(b'mdia',
+                    _mp4_full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, timescale, 0, 0x55C4, 0)),
+                    _mp4_full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'vide'), b'VideoHandler\x00'),
+                    minf)
+    trak = _mp4_box(b'trak',
+                    _mp4_full_box(b'tkhd', 0, 3, struct.pack('>IIIII8xhhH2x', 0, 0, 1, 0, 0, 0, 0, 0), matrix,
+                                  struct.pack('>II', width << 16, height << 16)),
+                    mdia)
+    mvex = _mp4_box(b'mvex', _mp4_full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0)))
+    moov = _mp4_box(b'moov',
+                    _mp4_full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH10x', 0, 0, 1000, 0, 0x10000, 0x100), matrix,
+                                  bytes(24), struct.pack('>I', 2)),
+                    trak, mvex)
+    ftyp = _mp4_box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isomiso5iso6avc1mp41')
+    return ftyp + moov
+
+def _mp4_fragment(sequence, decode_time, samples, data):
+    """moof and mdat boxes for one fragment, samples are (nal_units, keyframe, duration) tuples"""
+    entries = []
+    sizes = []
+    for units, keyframe, duration in samples:
+        size = sum(4 + end - start for start, end in units)
+        sizes.append(size)
+        flags = 0x02000000 if keyframe else 0x01010000
+        entries.append(struct.pack('>III', duration, size, flags))
+    def moof(data_offset):
+        trun_payload = struct.pack('>Ii', len(samples), data_offset) + b''.join(entries)
+        return _mp4_box(b'moof', _mp4_full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)),
+                        _mp4_box(b'traf', _mp4_full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1)),
+                                 _mp4_full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+                                 _mp4_full_box(b'trun', 0, 0x000701, trun_payload)))
+    # The trun data offset points from the start of moof to the first sample in mdat
+    moof_box = moof(len(moof(0)) + 8)
+    mdat = [struct.pack('>I4s', 8 + sum(sizes), b'mdat')]
+    for units, keyframe, duration in samples:
+        for start, end in units:
+            mdat.append(struct.pack('>I', end - start))
+            mdat.append(data[start:end])
+    return moof_box, mdat
+
+def mux_h264_to_fmp4(h264_path, mp4_path, width, height, pts_path=None, fps=30):
+    """Mux a raw H.264 elementary stream into a fragmented MP4, one fragment per GOP.
+
+    Sample durations come from the per-frame timestamps in pts_path when they are
+    available, otherwise a constant fps is assumed. Returns the number of frames.
+    """
+    timescale = 90000
+    timestamps = read_timecodes(pts_path) if pts_path else []
+    default_duration = int(round(timescale / fps))
+    
+    with open(h264_path, 'rb') as source:
+        if os.fstat(source.fileno()).st_size == 0:
+            raise ValueError(f"{h264_path} is empty")
+        data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            sps = pps = None
+            access_units = []
+            for units, keyframe in iter_h264_access_units(data):
+                samples = []
+                for start, end in units:
+                    nal_type = data[start] & 0x1F
+                    # Parameter sets go into avcC, access unit delimiters are dropped
+                    if nal_type == 7:
+                        sps = sps or bytes(data[start:end])
+                    elif nal_type == 8:
+                        pps = pps or bytes(data[start:end])
+                    elif nal_type != 9:
+                        samples.append((start, end))
+                access_units.append((samples, keyframe))
+            if not sps or not pps:
+                raise ValueError(f"{h264_path} has no SPS/PPS")
+            
+            # Frame durations from the saved timestamps, in 90 kHz ticks
+            ticks = [int(round(ms * timescale / 1000)) for ms in timestamps[:len(access_units)]]
+            if len(ticks) != len(access_units):
+                ticks = [i * default_duration for i in range(len(access_units))]
+            durations = [max(1, b - a) for a, b in zip(ticks, ticks[1:])]
+            durations.append(durations[-1] if durations else default_duration)
+            
+            with open(mp4_path, 'wb') as target:
+                target.write(_mp4_init_segment(width, height, sps, pps, timescale))
+                sequence = 1
+                fragment = []
+                decode_time = 0
+                for (units, keyframe), duration in zip(access_units, durations):
+                    if keyframe and fragment:
+                        moof, mdat = _mp4_fragment(sequence, decode_time, fragment, data)
+                        target.write(moof)
+                        target.writelines(mdat)
+                        decode_time += sum(sample[2] for sample in fragment)
+                        sequence += 1
+                        fragment = []
+                    fragment.append((units, keyframe, duration))
+                if fragment:
+                    moof, mdat = _mp4_fragment(sequence, decode_time, fragment, data)
+                    target.write(moof)
+                    target.writelines(mdat)
+            return len(access_units)
+        finally:
+            data.close()
 
 # Define a function to generate the stream for a specific camera
-def generate_stream(camera):
-    """Generator function for streaming video frames"""
-    print("DEBUG: Starting generate_stream function")
+viewer_ids = itertools.count(1)
+
+def parse_max_fps(value):
+    """The ?maxfps= of a live stream request, None if not given. Raises ValueError unless it is a positive number."""
+    if value is None or value == '':
+        return None
+    max_fps = float(value)
+    if not max_fps > 0:
+        raise ValueError("maxfps must be a positive number")
+    return max_fps
+
+# Most bytes a viewer's socket may hold unsent, more and a slow viewer's writes block and it skips frames
+VIEWER_UNSENT_LIMIT = 128 * 1024
+
+def limit_unsent(sock, limit=VIEWER_UNSENT_LIMIT):
+    """Cap the unsent data the kernel queues on sock (Linux TCP_NOTSENT_LOWAT), a no-op elsewhere.
+
+    By default the send buffer grows to megabytes, seconds of video on a poor link,
+    before a write blocks. Accepted sockets inherit the option from a listening one.
+    """
+    if sock is None or not hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, limit)
+    except OSError as e:
+        stream_log.debug(f"Could not limit unsent bytes: {e}")
+
+class ViewerPacer:
+    """Frame bookkeeping of one live stream viewer, shared by generate_stream and the ASGI viewer.
+
+    A viewer always takes the newest frame. Frames it missed because its socket was
+    still busy, or because of its max_fps cap, are counted as skipped for this viewer.
+    """
+    def __init__(self, camera, max_fps=None):
+        self.camera_label = camera.camera_info.get('Num')
+        self.viewer_id = next(viewer_ids)
+        self.interval = 1.0 / max_fps if max_fps else 0.0
+        self.next_send = 0.0
+        self.last_sequence = 0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.delivered = metric_frames_delivered.labels(self.camera_label, self.viewer_id)
+        self.skipped = metric_viewer_skipped.labels(self.camera_label, self.viewer_id)
+        self.dropped = metric_frames_dropped.labels(self.camera_label, 'viewer')
+
+    def delay(self):
+        """Seconds to wait before taking the next frame, non-zero only under a max_fps cap"""
+        return max(0.0, self.next_send - time.monotonic())
+
+    def take(self, sequence):
+        """Record that sequence is the next frame to send, counting the ones skipped since the last"""
+        if self.last_sequence and sequence > self.last_sequence + 1:
+            self.skip(sequence - self.last_sequence - 1)
+        self.last_sequence = sequence
+        if self.interval:
+            self.next_send = max(self.next_send + self.interval, time.monotonic())
+
+    def skip(self, count=1):
+        self.frames_skipped += count
+        self.skipped.inc(count)
+        self.dropped.inc(count)
+
+    def sent(self, output, timestamp):
+        self.frames_sent += 1
+        self.delivered.inc()
+        output.record_send_latency(time.time() - timestamp)
+
+    def close(self):
+        metric_frames_delivered.remove(self.camera_label, self.viewer_id)
+        metric_viewer_skipped.remove(self.camera_label, self.viewer_id)
+        stream_log.debug(f"Viewer {self.viewer_id} sent {self.frames_sent} frames, skipped {self.frames_skipped}")
+
+def generate_stream(camera, max_fps=None):
+    """Generator function for streaming video frames from the camera's broadcast hub"""
+    stream_log.debug("Starting generate_stream function")
     
     if not camera:
-        print("DEBUG: Camera is None")
+        stream_log.warning("Camera is None")
         return
     
     # Use the correct streaming output attribute
-    if hasattr(camera, 'output'):
-        output = camera.output
-    else:
-        print("DEBUG: Camera has no output attribute")
-        return
-    
+    output = getattr(camera, 'output', None)
     if not output:
-        print("DEBUG: Camera output is None")
+        stream_log.warning("Camera output is None")
         return
     
+    # Each viewer keeps its own cursor into the hub
+    pacer = ViewerPacer(camera, max_fps)
+    pacer.last_sequence = max(0, output.sequence - 1)
+    camera.session.acquire('preview')
+    viewers = output.add_viewer()
+    stream_log.debug(f"Viewer attached, {viewers} viewer(s) on stream")
+    
     try:
         while True:
-            try:
-                # Wait for a new frame
-                print("DEBUG: Waiting for next frame")
-                with output.condition:
-                    output.condition.wait(timeout=1.0)
-                    
-                    # Get the frame
-                    frame = output.read_frame()
-                        
-                    if frame:
-                        print(f"DEBUG: Got frame of size {len(frame)} bytes")
-                        yield (b'--frame\r\n'
-                            b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-                    else:
-                        print("DEBUG: No frame received")
-                        time.sleep(0.1)  # Short sleep to prevent busy-waiting
-            except Exception as e:
-                print(f"DEBUG: Error in frame generation: {e}")
-                time.sleep(0.1)  # Short sleep to prevent busy-waiting
+            # The camera may have been restarted with a new hub (e.g. settings change)
+            if camera.output is not None and camera.output is not output:
+                output.remove_viewer()
+                output = camera.output
+                output.add_viewer()
+                pacer.last_sequence = 0
+            
+            # Under a maxfps cap the frames published meanwhile are skipped, not queued
+            delay = pacer.delay()
+            if delay:
+                time.sleep(delay)
+            latest = output.wait_for_frame(pacer.last_sequence, timeout=1.0)
+            if latest is None:
+                continue
+            sequence, timestamp, frame = latest
+            # A viewer slower than the camera jumps to the newest frame
+            pacer.take(sequence)
+            
+            # Building the part copies the frame out of the ring, drop it if the slot was reused meanwhile
+            part = b''.join((b'--frame\r\nContent-Type: image/jpeg\r\n\r\n', frame, b'\r\n'))
+            if not output.ring.is_valid(sequence):
+                pacer.skip()
+                continue
+            yield part
+            # The server asks for the next part once this one is written to the socket
+            pacer.sent(output, timestamp)
+    except GeneratorExit:
+        pass
     except Exception as e:
-        print(f"DEBUG: Error in generate_stream: {e}")
-        import traceback
-        print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+        stream_log.exception(f"Error in generate_stream: {e}")
+    finally:
+        pacer.close()
+        camera.session.release('preview')
+        viewers = output.remove_viewer()
+        stream_log.debug(f"Viewer detached, {viewers} viewer(s) left on stream")
 
 class LibcameraProcess:
     """Class to manage libcamera-vid processes for streaming and recording"""
+    # Controls libcamera-vid takes on its command line, everything else is ignored by it
+    CONTROL_FLAGS = {'Brightness': '--brightness', 'Contrast': '--contrast', 'Saturation': '--saturation',
+                     'Sharpness': '--sharpness', 'ExposureValue': '--ev', 'ExposureTime': '--shutter',
+                     'AnalogueGain': '--gain', 'AwbMode': '--awb', 'AeMeteringMode': '--metering'}
+    AWB_MODES = ('auto', 'incandescent', 'tungsten', 'fluorescent', 'indoor', 'daylight', 'cloudy', 'custom')
+    METERING_MODES = ('centre', 'spot', 'average', 'custom')
+
     def __init__(self, camera_num, output_handler=None):
         self.camera_num = camera_num
         self.process = None
         self.output_handler = output_handler
         self.is_running = False
         self.cmd_args = []
-        print(f"DEBUG: LibcameraProcess initialized for camera {camera_num}")
+        self.controls = {}   # The controls the running command line was built from
+        self.recorder = None
+        capture_log.debug(f"LibcameraProcess initialized for camera {camera_num}")
         
-    def start(self, width, height, fps=60, output=None, timeout=0, nopreview=True, codec="mjpeg", quality=90, hflip=False, vflip=False, additional_args=None):
+    @classmethod
+    def control_args(cls, controls):
+        """The command line options for controls, exposure time and gain only while AeEnable is off as on Picamera2"""
+        args = []
+        for key, flag in cls.CONTROL_FLAGS.items():
+            if key not in controls:
+                continue
+            if key in ('ExposureTime', 'AnalogueGain') and controls.get('AeEnable', True):
+                continue
+            value = controls[key]
+            if key == 'AwbMode':
+                value = cls.AWB_MODES[int(value)] if 0 <= int(value) < len(cls.AWB_MODES) else 'auto'
+            elif key == 'AeMeteringMode':
+                value = cls.METERING_MODES[int(value)] if 0 <= int(value) < len(cls.METERING_MODES) else 'centre'
+            args.extend([flag, str(value)])
+        return args
+
+    def start(self, width, height, fps=60, output=None, timeout=0, nopreview=True, codec="mjpeg", quality=90, hflip=False, vflip=False, additional_args=None, controls=None):
         """Start a libcamera-vid process with the specified parameters"""
         if self.is_running:
-            print("DEBUG: Stopping existing process before starting new one")
+            capture_log.debug("Stopping existing process before starting new one")
             self.stop()
             time.sleep(0.1)  # Reduced wait time
             
-        # Check for any existing libcamera processes and kill them
-        try:
-            print("DEBUG: Checking for existing libcamera processes")
-            subprocess.run(["pkill", "-f", "libcamera-vid"], stderr=subprocess.DEVNULL)
-            time.sleep(0.1)  # Reduced wait time
-        except Exception as e:
-            print(f"DEBUG: Error killing existing processes: {e}")
-            
         # Base command with performance optimizations
         cmd = ["libcamera-vid"]
         
@@ -339,9 +1438,9 @@ class LibcameraProcess:
             if output_dir and not os.path.exists(output_dir):
                 try:
                     os.makedirs(output_dir, exist_ok=True)
-                    print(f"DEBUG: Created output directory: {output_dir}")
+                    capture_log.debug(f"Created output directory: {output_dir}")
                 except Exception as e:
-                    print(f"DEBUG: Error creating output directory: {e}")
+                    capture_log.warning(f"Error creating output directory: {e}")
                     return False
                     
             # Make sure output has a % directive if using segment
@@ -355,9 +1454,9 @@ class LibcameraProcess:
                 # Touch the file to ensure we can write to it
                 with open(output, 'a'):
                     pass
-                print(f"DEBUG: Successfully verified write access to: {output}")
+                capture_log.debug(f"Successfully verified write access to: {output}")
             except Exception as e:
-                print(f"DEBUG: Cannot write to output file: {e}")
+                capture_log.warning(f"Cannot write to output file: {e}")
                 return False
                 
             cmd.extend(["--output", output])
@@ -368,10 +1467,15 @@ class LibcameraProcess:
         # Add any additional arguments
         if additional_args:
             cmd.extend(additional_args)
+        
+        # Controls can only be given here, a change needs a new process
+        if controls:
+            cmd.extend(self.control_args(controls))
+        self.controls = dict(controls or {})
             
         # Store the command arguments for logging
         self.cmd_args = cmd
-        print(f"DEBUG: Starting libcamera-vid with command: {' '.join(cmd)}")
+        capture_log.debug(f"Starting libcamera-vid with command: {' '.join(cmd)}")
         
         try:
             # Start the process with optimized buffer sizes
@@ -407,13 +1511,11 @@ class LibcameraProcess:
                     )
                     
             self.is_running = True
-            print("DEBUG: Process started successfully")
+            capture_log.debug("Process started successfully")
             return True
             
         except Exception as e:
-            print(f"DEBUG: Error starting libcamera-vid process: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+            capture_log.exception(f"Error starting libcamera-vid process: {e}")
             self.process = None
             self.is_running = False
             return False
@@ -424,157 +1526,2151 @@ class LibcameraProcess:
             for line in self.process.stderr:
                 line = line.decode('utf-8', errors='ignore').strip()
                 if line:
-                    print(f"DEBUG: libcamera-vid stderr: {line}")
+                    # libcamera-vid reports every frame here, the rate limit keeps a sample
+                    capture_log.debug("libcamera-vid stderr: %s", line)
                     
             # Check if process exited with error
             if self.process.poll() is not None and self.process.returncode != 0:
-                print(f"DEBUG: libcamera-vid process exited with code: {self.process.returncode}")
+                capture_log.warning(f"libcamera-vid process exited with code: {self.process.returncode}")
         except Exception as e:
-            print(f"DEBUG: Error monitoring process output: {e}")
+            capture_log.warning(f"Error monitoring process output: {e}")
 
     def _handle_stdout(self):
         """Handle stdout from the libcamera-vid process"""
-        print("DEBUG: Stdout handler thread started")
+        capture_log.debug("Stdout handler thread started")
         
         if not self.process or not self.process.stdout:
-            print("DEBUG: No process or stdout available")
+            capture_log.warning("No process or stdout available")
             return
             
+        # libcamera-vid chunks do not line up with frames, split them as they arrive
+        splitter = JpegFrameSplitter()
+        read_sizes = metric_pipe_read_bytes.labels(self.camera_num)
+            
         try:
             while self.is_running and self.process and self.process.poll() is None:
                 try:
-                    # Read a chunk from stdout with a timeout
-                    chunk = self.process.stdout.read1(32768)  # Use read1 for better buffering
+                    # Read a chunk from stdout straight into the splitter's buffer
+                    chunk_size = splitter.read_from(self.process.stdout, 32768)
                     
-                    if not chunk:
-                        print("DEBUG: Empty chunk received, checking process status")
+                    if not chunk_size:
+                        capture_log.debug("Empty chunk received, checking process status")
                         if self.process.poll() is not None:
-                            print(f"DEBUG: Process exited with code {self.process.poll()}")
+                            capture_log.debug(f"Process exited with code {self.process.poll()}")
                             break
                         continue
                     
-                    print(f"DEBUG: Received chunk of size {len(chunk)} bytes")
+                    read_sizes.observe(chunk_size)
                     
-                    # Pass the chunk to the output handler
-                    if self.output_handler:
-                        self.output_handler.write(chunk)
-                    else:
-                        print("DEBUG: No output handler available")
+                    if not self.output_handler:
+                        capture_log.warning("No output handler available")
+                        continue
+                    
+                    # Pass every complete frame to the output handler
+                    for frame in splitter.frames():
+                        self.output_handler.write(frame)
                         
                 except IOError as e:
-                    print(f"DEBUG: IOError reading from stdout: {e}")
+                    capture_log.warning(f"IOError reading from stdout: {e}")
                     if not self.is_running or self.process.poll() is not None:
                         break
                     time.sleep(0.1)  # Brief pause before retry
                     
         except Exception as e:
-            print(f"DEBUG: Fatal error in stdout handler: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+            capture_log.exception(f"Fatal error in stdout handler: {e}")
         finally:
-            print("DEBUG: Stdout handler thread ending")
+            capture_log.debug("Stdout handler thread ending")
             if self.process and self.process.poll() is None:
-                print("DEBUG: Process still running at handler exit")
+                capture_log.debug("Process still running at handler exit")
             else:
-                print("DEBUG: Process not running at handler exit")
+                capture_log.debug("Process not running at handler exit")
 
     def stop(self):
         """Stop the libcamera-vid process"""
+        if self.recorder:
+            self.stop_recording()
         if self.process:
             try:
-                print("DEBUG: Attempting to stop process")
+                capture_log.debug("Attempting to stop process")
                 # Try to terminate gracefully first
                 self.process.terminate()
                 
                 # Wait a bit for the process to terminate
                 try:
                     self.process.wait(timeout=2)
-                    print("DEBUG: Process terminated gracefully")
+                    capture_log.debug("Process terminated gracefully")
                 except subprocess.TimeoutExpired:
                     # If it doesn't terminate, kill it
-                    print("DEBUG: Process did not terminate, forcing kill")
+                    capture_log.debug("Process did not terminate, forcing kill")
                     self.process.kill()
                     self.process.wait()
             except Exception as e:
-                print(f"DEBUG: Error stopping libcamera-vid process: {e}")
+                capture_log.warning(f"Error stopping libcamera-vid process: {e}")
             
             self.process = None
             self.is_running = False
-            print("DEBUG: Process stopped")
+            capture_log.debug("Process stopped")
         return True
         
+    def start_recording(self, segments, **encoder_options):
+        """Tee the MJPEG frames this process produces into segment files, the stream keeps running"""
+        if not self.output_handler or self.recorder:
+            return False
+        self.recorder = MJPEGFileRecorder(self.output_handler, segments=segments)
+        return self.recorder.start()
+
+    def stop_recording(self):
+        if not self.recorder:
+            return False
+        recorder, self.recorder = self.recorder, None
+        return recorder.stop()
+
+    def is_recording(self):
+        return bool(self.recorder and self.recorder.is_alive())
+
+    def set_controls(self, controls):
+        """libcamera-vid reads its controls from the command line only, True if it was started with these"""
+        return all(key in self.controls and self.controls[key] == value for key, value in controls.items())
+
+    def grab_burst_frame(self, frame, last_sequence, raw=False):
+        """Copy the next already encoded JPEG of the stream into a BurstFrame, raw is not available"""
+        if not self.output_handler:
+            return None
+        sequence = self.output_handler.copy_frame_into(frame, last_sequence)
+        if sequence is not None:
+            frame.format = 'JPEG'
+        return sequence
+
+    def save_burst_frame(self, frame, path, raw_path=None):
+        save_burst_image(frame, path)
+
+    def capture_still(self, path, mode='video', raw_path=None):
+        """Save the next frame of the stream, libcamera-vid already encodes it at the full output size.
+
+        The sensor is owned by the libcamera-vid process, so there is no mode switch
+        or raw capture here and mode and raw_path are ignored.
+        """
+        frame = self.output_handler.capture_frame(fresh=True) if self.output_handler else None
+        if frame is None:
+            return False
+        with open(path, 'wb') as file:
+            file.write(frame[2])
+        return True
+
+    @property
+    def pid(self):
+        """PID of the running libcamera-vid process, or None"""
+        return self.process.pid if self.process else None
+
     def is_alive(self):
         """Check if the process is still running"""
         is_alive = self.is_running and self.process and self.process.poll() is None
-        print(f"DEBUG: Process alive status: {is_alive}")
+        capture_log.debug("Process alive status: %s", is_alive)
         return is_alive
 
-# CameraObject that will store the itteration of 1 or more cameras
-class CameraObject:
-    def __init__(self, camera_num, camera_info):
-        # Store camera info but don't initialize Picamera2
-        self.camera_info = camera_info
-        self.camera = None  # Will be initialized on demand
-        
-        # Initialize recording attributes
-        self.recording = False
-        self.recording_process = None
-        self.video_path = None
-        
-        # Default controls for the Camera (will be populated when camera is initialized)
-        self.settings = {}
-        
-        # Initialize other attributes
-        self.sensor_modes = []
-        self.streaming_process = None
-        self.output = None
-        
-        # Load or create default configuration
-        self.live_config = self.default_camera_settings()
-        
-        # Initialize output resolutions
-        self.output_resolutions = {
-            "0": (1456, 1088)  # Default resolution
-        }
-        
-        print(f"\nCamera Settings:\n{self.live_config.get('capture-settings', {})}\n")
+class CameraConfigurations:
+    """Prebuilt Picamera2 configurations of one camera.
+
+    Configurations are built once per purpose (video, still, raw), sensor mode,
+    size and transform, and then reused across pipeline restarts and still
+    captures. The sensor mode list, which Picamera2 probes by configuring every
+    mode, is cached here as well.
+    """
+    def __init__(self):
+        self.configs = {}
+        self.sensor_modes = None
+
+    def load_sensor_modes(self, picam2):
+        """Probe the sensor modes once, the camera must not be running"""
+        if self.sensor_modes is None:
+            self.sensor_modes = picam2.sensor_modes
+        return self.sensor_modes
+
+    def get(self, picam2, kind, size, lores_size, fps, hflip=False, vflip=False, sensor_mode=None):
+        """Return the cached configuration of this kind, building it on first use.
+
+        sensor_mode is a {'size', 'bit_depth'} dict or None for the default mode.
+        Still and raw configurations capture at the sensor mode size (or the full
+        sensor resolution) and keep a lores stream identical to the video one, so
+        the live MJPEG encoder keeps running across a mode switch.
+        """
+        sensor_key = (tuple(sensor_mode['size']), sensor_mode['bit_depth']) if sensor_mode else None
+        key = (kind, tuple(size), tuple(lores_size), fps, hflip, vflip, sensor_key)
+        config = self.configs.get(key)
+        if config is not None:
+            return config
         
-        # Get the resolution from the config
-        resolution = self.live_config.get('capture-settings', {}).get("Resolution", "0")
-        if resolution in self.output_resolutions:
-            print(f"\nCamera Set Resolution:\n{self.output_resolutions[resolution]}\n")
-    
-    def init_camera(self):
-        """Initialize the Picamera2 instance on demand"""
-        if self.camera is not None:
-            # Camera already initialized
-            return self.camera
-            
-        try:
-            print(f"DEBUG: Initializing Picamera2 for camera {self.camera_info.get('Num', 0)}")
-            self.camera = Picamera2(self.camera_info.get('Num', 0))
-            self.settings = self.camera.camera_controls
-            self.sensor_modes = self.camera.sensor_modes
-            return self.camera
-        except Exception as e:
-            print(f"DEBUG: Error initializing camera: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
-            return None
+        sensor = {'output_size': sensor_mode['size'], 'bit_depth': sensor_mode['bit_depth']} if sensor_mode else {}
+        lores = {'size': lores_size, 'format': 'YUV420'}
+        transform = Transform(hflip=hflip, vflip=vflip)
+        if kind == 'video':
+            config = picam2.create_video_configuration(main={'size': size}, lores=lores, transform=transform,
+                                                       controls={'FrameRate': fps}, sensor=sensor)
+        elif kind in ('still', 'raw'):
+            full_size = tuple(sensor_mode['size']) if sensor_mode else picam2.sensor_resolution
+            raw = {'size': full_size} if kind == 'raw' else None
+            config = picam2.create_still_configuration(main={'size': full_size}, lores=lores, raw=raw,
+                                                       transform=transform, sensor=sensor)
+        else:
+            raise ValueError(f"Unknown configuration kind: {kind}")
+        self.configs[key] = config
+        capture_log.debug(f"Built {kind} configuration for {size[0]}x{size[1]}, sensor mode {sensor_key}")
+        return config
+
+class SegmentedFileOutput(Output):
+    """Picamera2 output that writes an H.264 stream as RecordingSegments.
+
+    Rollover only happens on keyframes. The recording encoder repeats SPS/PPS on
+    each of them, so every segment decodes and muxes on its own. Timecodes are
+    written per segment in the same format as FileOutput's pts file.
+    """
+    def __init__(self, segments):
+        super().__init__()
+        self.segments = segments
+        self.file = None
+        self.pts_file = None
+        self.first_timestamp = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def _open(self):
+        path, pts_path = self.segments.open()
+        self.file = open(path, 'wb')
+        self.pts_file = open(pts_path, 'w')
+        self.pts_file.write("# timecode format v2\n")
+        self.first_timestamp = None
+
+    def _close(self):
+        self.file.close()
+        self.pts_file.close()
+        self.file = self.pts_file = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        with self.lock:
+            if self.closed:
+                return
+            if timestamp is None:
+                timestamp = time.monotonic_ns() // 1000
+            try:
+                if self.file is None:
+                    # A recording starts on a keyframe, anything before it cannot be decoded
+                    if not keyframe:
+                        return
+                    self._open()
+                elif keyframe and self.segments.due(timestamp / 1e6):
+                    self._close()
+                    self.segments.close()
+                    self._open()
+                self.file.write(frame)
+                if self.first_timestamp is None:
+                    self.first_timestamp = timestamp
+                self.pts_file.write(f"{(timestamp - self.first_timestamp) / 1000:.3f}\n")
+                self.segments.add(len(frame), timestamp / 1e6)
+            except OSError as e:
+                recording_log.error(f"Error writing recording segment: {e}")
+
+    def stop(self):
+        super().stop()
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.file is not None:
+                self._close()
+            self.segments.close(last=True)
+
+class Picamera2Pipeline:
+    """In-process capture pipeline on a single Picamera2 instance.
+
+    The live stream is MJPEG-encoded from the lores stream into the frame hub while
+    recordings are H.264-encoded from the main stream into a file, so recording
+    costs neither the live view nor a second sensor pipeline.
+    """
+    def __init__(self, camera_num, output_handler=None, configs=None):
+        self.camera_num = camera_num
+        self.output_handler = output_handler
+        self.configs = configs if configs is not None else CameraConfigurations()
+        self.config_args = None
+        self.picam2 = None
+        self.is_running = False
+        self.stream_encoder = None
+        self.record_encoder = None
+        capture_log.debug(f"Picamera2Pipeline initialized for camera {camera_num}")
+
+    def start(self, width, height, fps=60, quality=90, hflip=False, vflip=False, stream_width=1280, sensor_mode=None, **kwargs):
+        """Configure main and lores streams and start the MJPEG stream encoder"""
+        try:
+            # The lores stream can not be bigger than main, scale it down keeping the aspect ratio
+            scale = min(1.0, stream_width / width)
+            lores_size = (int(width * scale) // 16 * 16, int(height * scale) // 2 * 2)
+            
+            self.picam2 = Picamera2(self.camera_num)
+            self.configs.load_sensor_modes(self.picam2)
+            self.config_args = {'size': (width, height), 'lores_size': lores_size, 'fps': fps,
+                                'hflip': hflip, 'vflip': vflip, 'sensor_mode': sensor_mode}
+            self.picam2.configure(self.configs.get(self.picam2, 'video', **self.config_args))
+            
+            self.stream_encoder = MJPEGEncoder()
+            self.picam2.start_encoder(self.stream_encoder, FileOutput(self.output_handler), name='lores')
+            self.picam2.start()
+            self.is_running = True
+            capture_log.debug(f"Picamera2 pipeline started, main {width}x{height}, stream {lores_size[0]}x{lores_size[1]} at {fps} FPS")
+            return True
+        except Exception as e:
+            capture_log.exception(f"Error starting Picamera2 pipeline: {e}")
+            self.stop()
+            return False
+
+    def start_recording(self, segments, bitrate=10000000, gop=60, profile='high'):
+        """Start H.264 encoding of the main stream into segment files alongside the live stream.
+
+        SPS/PPS are repeated on every keyframe (GOP frames apart) so the stream can
+        be cut and muxed per GOP.
+        """
+        if not self.is_running or self.record_encoder:
+            return False
+        self.record_encoder = H264Encoder(bitrate=bitrate, repeat=True, iperiod=gop, profile=profile)
+        self.picam2.start_encoder(self.record_encoder, SegmentedFileOutput(segments), name='main')
+        return True
+
+    def stop_recording(self):
+        if not self.record_encoder:
+            return False
+        encoder, self.record_encoder = self.record_encoder, None
+        self.picam2.stop_encoder(encoder)
+        return True
+
+    def is_recording(self):
+        return self.record_encoder is not None
+
+    def set_controls(self, controls):
+        """Queue controls on the running camera, libcamera applies them from the next request on"""
+        if not self.is_alive():
+            return False
+        # ScalerCrop and other rectangles arrive from JSON as lists
+        self.picam2.set_controls({key: tuple(value) if isinstance(value, list) else value
+                                  for key, value in controls.items()})
+        return True
+
+    def grab_burst_frame(self, frame, last_sequence, raw=False):
+        """Copy the next main (and raw) frame of the running configuration into a BurstFrame.
+
+        The request buffers are mapped and copied into the frame's preallocated arrays,
+        then the request is released right away so the camera never runs out of buffers.
+        """
+        request = self.picam2.capture_request()
+        try:
+            with MappedArray(request, 'main') as mapped:
+                if frame.data is None or frame.data.shape != mapped.array.shape:
+                    frame.data = np.empty_like(mapped.array)
+                np.copyto(frame.data, mapped.array)
+            frame.format = self.picam2.camera_config['main']['format']
+            frame.metadata = request.get_metadata()
+            frame.timestamp = time.time()
+            if raw:
+                with MappedArray(request, 'raw') as mapped:
+                    if frame.raw is None or frame.raw.shape != mapped.array.shape:
+                        frame.raw = np.empty_like(mapped.array)
+                    np.copyto(frame.raw, mapped.array)
+                frame.raw_config = self.picam2.camera_config['raw']
+        finally:
+            request.release()
+        # Number the frame by sensor time so frames missed between grabs show up as gaps
+        sensor_timestamp = frame.metadata.get('SensorTimestamp')
+        frame_duration = frame.metadata.get('FrameDuration')
+        if sensor_timestamp and frame_duration:
+            return round(sensor_timestamp / (frame_duration * 1000))
+        return last_sequence + 1
+
+    def save_burst_frame(self, frame, path, raw_path=None):
+        """Encode a BurstFrame grabbed by this pipeline, called on the burst writer threads"""
+        save_burst_image(frame, path)
+        if raw_path and frame.raw is not None:
+            self.picam2.helpers.save_dng(frame.raw.reshape(-1), frame.metadata, frame.raw_config, raw_path)
+
+    def capture_still(self, path, mode='video', raw_path=None):
+        """Save a still as a JPEG (and a DNG into raw_path), the stream encoder keeps running.
+
+        mode='video' takes the next main stream frame. mode='still' switches to the
+        cached full resolution configuration for one frame and back, which costs the
+        mode switch plus one frame instead of reopening the camera. While recording,
+        the main stream belongs to the H.264 encoder and the video frame is used.
+        """
+        if raw_path:
+            mode = 'raw'
+        if mode != 'video' and self.is_recording():
+            capture_log.debug("Recording on the main stream, taking the still from the video configuration")
+            mode, raw_path = 'video', None
+        
+        if mode == 'video':
+            request = self.picam2.capture_request()
+        else:
+            config = self.configs.get(self.picam2, mode, **self.config_args)
+            request = self.picam2.switch_mode_and_capture_request(config)
+        try:
+            request.save('main', path)
+            if raw_path:
+                request.save_dng(raw_path)
+        finally:
+            request.release()
+        return True
+
+    @property
+    def pid(self):
+        """The camera is held in-process, there is no separate process to track"""
+        return None
+
+    def stop(self):
+        if self.picam2 is not None:
+            try:
+                self.picam2.stop_encoder()
+                self.picam2.stop()
+                self.picam2.close()
+            except Exception as e:
+                capture_log.warning(f"Error stopping Picamera2 pipeline: {e}")
+        self.picam2 = None
+        self.stream_encoder = None
+        self.record_encoder = None
+        self.is_running = False
+        return True
+
+    def is_alive(self):
+        return self.is_running and self.picam2 is not None
+
+class StillCaptureQueue:
+    """Serialises still captures of a capture session on one worker thread.
+
+    Requests are queued and taken from the running pipeline in order, so callers
+    never stop or reopen the camera and concurrent requests never share a file.
+    submit() hands back a Future that resolves to the saved path.
+    """
+    def __init__(self, session, max_pending=8):
+        self.session = session
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, path, **options):
+        """Queue a capture into path, raises queue.Full when too many are pending"""
+        future = concurrent.futures.Future()
+        self.queue.put_nowait((path, options, future))
+        with self.lock:
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            path, options, future = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # Holding the session lock keeps the pipeline from restarting mid-capture
+                with self.session.lock:
+                    process = self.session.process
+                    if not process or not process.is_alive():
+                        raise RuntimeError("Capture pipeline is not running")
+                    if not process.capture_still(path, **options):
+                        raise RuntimeError("No frame received from the capture pipeline")
+                future.set_result(path)
+            except Exception as e:
+                capture_log.warning(f"Still capture {path} failed: {e}")
+                future.set_exception(e)
+
+class BurstFrame:
+    """One preallocated burst slot, refilled in place by every frame that passes through it"""
+    def __init__(self):
+        self.data = None        # bytearray of an encoded JPEG, or an array of the main stream
+        self.size = 0
+        self.format = None      # 'JPEG' or the Picamera2 pixel format of data
+        self.raw = None
+        self.raw_config = None
+        self.metadata = None
+        self.timestamp = 0.0
+
+def save_burst_image(frame, path, quality=90):
+    """Write a BurstFrame as a JPEG file, frames from libcamera-vid are already encoded"""
+    if frame.format == 'JPEG':
+        with open(path, 'wb') as file:
+            file.write(memoryview(frame.data)[:frame.size])
+        return
+    # Picamera2 names formats by their little-endian layout, XBGR8888 is R, G, B, X in memory
+    if frame.format == 'XBGR8888':
+        pixels = frame.data[..., :3]
+    elif frame.format == 'XRGB8888':
+        pixels = frame.data[..., 2::-1]
+    elif frame.format == 'BGR888':
+        pixels = frame.data
+    elif frame.format == 'RGB888':
+        pixels = frame.data[..., ::-1]
+    else:
+        raise ValueError(f"Can not encode {frame.format} burst frames")
+    Image.fromarray(np.ascontiguousarray(pixels)).save(path, quality=quality)
+
+class BurstCapture:
+    """Grabs a burst of frames at sensor rate into preallocated slots and writes them on a worker pool.
+
+    The capture loop only copies each frame into a free slot and hands it to the
+    writers, which encode the JPEG (and DNG) and put the slot back. Frames the
+    sensor produced while every slot was still waiting for a writer are skipped
+    and counted as dropped rather than queued without bound. start() runs the loop
+    on its own thread, so neither the camera's actor nor its session wait for it.
+    """
+    def __init__(self, process, directory, prefix, count, interval=0.0, make_raw=False, slots=16, workers=2, on_written=None):
+        self.process = process
+        self.on_written = on_written
+        self.directory = directory
+        self.prefix = prefix
+        self.count = count
+        self.interval = interval
+        self.make_raw = make_raw
+        self.free = queue.Queue()
+        for _ in range(min(count, slots)):
+            self.free.put(BurstFrame())
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='burst-writer')
+        self.lock = threading.Lock()
+        self.files = []
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frames_written = 0
+        self.write_errors = 0
+        self.backlog = 0
+        self.max_backlog = 0
+        self.elapsed = 0.0
+        self.started = None
+        self.thread = None
+        self.cancelled = threading.Event()
+
+    def start(self):
+        """Run the capture loop in the background and return at once"""
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='burst-capture')
+        self.thread.start()
+        return self
+
+    def running(self):
+        return bool(self.thread and self.thread.is_alive())
+
+    def cancel(self, timeout=3.0):
+        """Stop grabbing frames, e.g. before the pipeline goes away, frames already grabbed are still written"""
+        self.cancelled.set()
+        if self.running() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    def run(self, timeout=2.0):
+        """Capture the whole burst, the writers keep going after this returns"""
+        start = self.started = self.started or time.time()
+        next_time = time.monotonic()
+        last_sequence = None
+        while self.frames_captured < self.count and not self.cancelled.is_set():
+            if self.interval > 0:
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += self.interval
+            
+            try:
+                frame = self.free.get(timeout=timeout)
+            except queue.Empty:
+                capture_log.warning("Burst writers stalled, stopping the burst early")
+                break
+            sequence = self.process.grab_burst_frame(frame, last_sequence or 0, raw=self.make_raw)
+            if sequence is None:
+                self.free.put(frame)
+                capture_log.warning("No frame from the capture pipeline, stopping the burst early")
+                break
+            # Gaps in the sequence are frames the sensor delivered while no slot was free
+            if last_sequence is not None and self.interval <= 0:
+                self.frames_dropped += max(0, sequence - last_sequence - 1)
+            last_sequence = sequence
+            
+            filename = f"{self.prefix}_{self.frames_captured:04d}.jpg"
+            raw_path = None
+            if self.make_raw and frame.raw is not None:
+                raw_path = os.path.join(self.directory, filename.replace('.jpg', '.dng'))
+            with self.lock:
+                self.backlog += 1
+                self.max_backlog = max(self.max_backlog, self.backlog)
+            self.pool.submit(self._write, frame, os.path.join(self.directory, filename), raw_path)
+            self.files.append(filename)
+            self.frames_captured += 1
+        
+        self.elapsed = time.time() - start
+        self.pool.shutdown(wait=False)
+        if self.frames_dropped:
+            metric_frames_dropped.labels(getattr(self.process, 'camera_num', None), 'burst').inc(self.frames_dropped)
+        return self.stats()
+
+    def _write(self, frame, path, raw_path):
+        try:
+            self.process.save_burst_frame(frame, path, raw_path)
+            with self.lock:
+                self.frames_written += 1
+            if self.on_written:
+                self.on_written(path, raw_path)
+        except Exception as e:
+            capture_log.warning(f"Error writing burst frame {path}: {e}")
+            with self.lock:
+                self.write_errors += 1
+        finally:
+            with self.lock:
+                self.backlog -= 1
+            self.free.put(frame)
+
+    def wait(self):
+        """Block until the burst is captured and every frame is on disk"""
+        if self.thread:
+            self.thread.join()
+        self.pool.shutdown(wait=True)
+        return self.stats()
+
+    def stats(self):
+        running = self.running()
+        elapsed = time.time() - self.started if running and self.started else self.elapsed
+        with self.lock:
+            return {
+                'running': running,
+                'frames': self.frames_captured,
+                'fps': round(self.frames_captured / elapsed, 1) if elapsed > 0 else 0.0,
+                'dropped': self.frames_dropped,
+                'written': self.frames_written,
+                'write_errors': self.write_errors,
+                'backlog': self.backlog,
+                'max_backlog': self.max_backlog,
+                'files': list(self.files)
+            }
+
+class CaptureSession:
+    """Owns the one long-lived capture pipeline of a camera number.
+
+    The pipeline is only (re)started when it is not running or when the parameters
+    it was started with change. Consumers (preview, record, snapshot) attach to the
+    session's StreamingOutput hub without restarting the sensor. The pipeline is
+    either a libcamera-vid process, tracked by PID in a pid file and never by
+    matching its command line, or an in-process Picamera2 instance.
+    """
+    def __init__(self, camera_num, pid_file):
+        self.camera_num = camera_num
+        self.pid_file = pid_file
+        self.process = None
+        self.output = None
+        self.params = None
+        self.consumers = {}   # consumer name -> number of active users
+        self.restarts = 0
+        self.last_error = None   # Why the pipeline last failed, cleared when it starts
+        self.pre_event = PreEventBuffer()
+        self.stills = StillCaptureQueue(self)
+        self.burst = None        # Last BurstCapture, cancelled if the pipeline stops under it
+        self.configs = CameraConfigurations()
+        self.lock = threading.RLock()
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def is_alive(self):
+        return bool(self.process and self.process.is_alive())
+
+    def error(self):
+        """Why the pipeline is not producing frames, None while it runs or was stopped on purpose"""
+        if self.last_error:
+            return self.last_error
+        # A start or stop in progress holds the lock, the pipeline is not failed then
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if self.params is not None and not self.is_alive():
+                return f"{self.params['backend']} exited unexpectedly"
+            return None
+        finally:
+            self.lock.release()
+
+    def start(self, width, height, fps, hflip=False, vflip=False, quality=90, backend='libcamera-vid', sensor_mode=None, controls=None):
+        """Make sure the pipeline runs with these parameters, restarting it only if they changed.
+
+        libcamera-vid is started with the controls on its command line, so for it a
+        changed control is a changed parameter too. Picamera2 takes them while it runs.
+        """
+        params = {'width': width, 'height': height, 'fps': fps, 'hflip': hflip, 'vflip': vflip,
+                  'quality': quality, 'backend': backend, 'sensor_mode': sensor_mode,
+                  'controls': LibcameraProcess.control_args(controls or {}) if backend != 'picamera2' else None}
+        with self.lock:
+            if self.is_alive() and params == self.params:
+                return True
+            
+            if self.process:
+                active = [name for name, count in self.consumers.items() if count > 0]
+                capture_log.info(f"Restarting capture session for camera {self.camera_num} (consumers: {active or 'none'})")
+                self._stop_process()
+                self.restarts += 1
+                metric_pipeline_restarts.labels(self.camera_num).inc()
+            
+            # Ring slots sized so a quality 90 frame fits without growing
+            self.output = StreamingOutput(slot_size=max(256 * 1024, width * height // 2), camera_num=self.camera_num)
+            self.pre_event.attach(self.output)
+            if backend == 'picamera2':
+                self.process = Picamera2Pipeline(self.camera_num, self.output, self.configs)
+                mode_options = {'sensor_mode': sensor_mode}
+            else:
+                self.process = LibcameraProcess(self.camera_num, self.output)
+                mode_options = {'additional_args': None, 'controls': controls}
+                if sensor_mode:
+                    mode_width, mode_height = sensor_mode['size']
+                    mode_options['additional_args'] = ['--mode', f"{mode_width}:{mode_height}:{sensor_mode['bit_depth']}:P"]
+            if not self.process.start(width=width, height=height, fps=fps, codec="mjpeg", quality=quality,
+                                      hflip=hflip, vflip=vflip, **mode_options):
+                self.process = None
+                self.params = None
+                self.last_error = f"{backend} failed to start at {width}x{height} {fps}fps"
+                return False
+            
+            self.params = params
+            self.last_error = None
+            if self.pid:
+                self._write_pid_file()
+            capture_log.info(f"Capture session for camera {self.camera_num} running on {backend} (PID {self.pid or os.getpid()})")
+            return True
+
+    def start_recording(self, segments, **encoder_options):
+        """Record from the running pipeline into RecordingSegments, the live stream is not interrupted"""
+        with self.lock:
+            if not self.is_alive() or self.process.is_recording():
+                return False
+            if not self.process.start_recording(segments, **encoder_options):
+                return False
+            self.consumers['record'] = self.consumers.get('record', 0) + 1
+            return True
+
+    def stop_recording(self):
+        with self.lock:
+            if not self.process or not self.process.is_recording():
+                return False
+            self.process.stop_recording()
+            self.release('record')
+            return True
+
+    def is_recording(self):
+        return bool(self.process and self.process.is_recording())
+
+    def capture_still(self, path, **options):
+        """Queue a still capture from the running pipeline, returns a Future of the saved path"""
+        return self.stills.submit(path, **options)
+
+    def capture_burst(self, directory, prefix, count, interval=0.0, make_raw=False, on_written=None):
+        """Start a burst on the running pipeline, returns the running BurstCapture or None"""
+        # The lock only covers the setup, the burst grabs frames on its own thread
+        with self.lock:
+            if not self.is_alive():
+                return None
+            if self.burst is not None and self.burst.running():
+                capture_log.warning(f"A burst is already running on camera {self.camera_num}")
+                return None
+            self.burst = BurstCapture(self.process, directory, prefix, count, interval, make_raw, on_written=on_written)
+            return self.burst.start()
+
+    def trigger_event(self, path, pts_path=None, post_seconds=5, on_close=None):
+        """Write the buffered pre-roll plus post_seconds of live frames to path"""
+        with self.lock:
+            if not self.is_alive():
+                return None
+            return self.pre_event.trigger(path, pts_path, post_seconds, on_close)
+
+    def stop(self):
+        """Stop the pipeline, consumers keep their registration for the next start"""
+        with self.lock:
+            self._stop_process()
+            self.params = None
+
+    def acquire(self, consumer):
+        """Register a consumer and hand it the session's frame hub"""
+        with self.lock:
+            self.consumers[consumer] = self.consumers.get(consumer, 0) + 1
+            return self.output
+
+    def release(self, consumer):
+        with self.lock:
+            if self.consumers.get(consumer, 0) > 0:
+                self.consumers[consumer] -= 1
+
+    def _stop_process(self):
+        if self.burst is not None:
+            self.burst.cancel()
+        if self.process:
+            if self.process.is_recording():
+                recording_log.info(f"Stopping the recording on camera {self.camera_num} before the pipeline stops")
+                self.stop_recording()
+            self.pre_event.detach()
+            self.process.stop()
+            self.process = None
+        try:
+            os.remove(self.pid_file)
+        except FileNotFoundError:
+            pass
+
+    def _write_pid_file(self):
+        try:
+            with open(self.pid_file, 'w') as file:
+                file.write(str(self.pid))
+        except OSError as e:
+            capture_log.warning(f"Could not write pid file {self.pid_file}: {e}")
+
+class CaptureSessionManager:
+    """Hands out one CaptureSession per camera number"""
+    def __init__(self, pid_dir):
+        self.pid_dir = pid_dir
+        self.sessions = {}
+        self.lock = threading.Lock()
+        os.makedirs(pid_dir, exist_ok=True)
+
+    def get(self, camera_num):
+        with self.lock:
+            if camera_num not in self.sessions:
+                pid_file = os.path.join(self.pid_dir, f'capture_cam_{camera_num}.pid')
+                self.sessions[camera_num] = CaptureSession(camera_num, pid_file)
+            return self.sessions[camera_num]
+
+    def reap_stale(self):
+        """Stop capture processes left behind by a previous run, using their recorded PIDs"""
+        for name in os.listdir(self.pid_dir):
+            if not name.endswith('.pid'):
+                continue
+            pid_file = os.path.join(self.pid_dir, name)
+            try:
+                with open(pid_file) as file:
+                    pid = int(file.read().strip())
+                # Make sure the PID was not reused by an unrelated process
+                with open(f'/proc/{pid}/cmdline', 'rb') as file:
+                    cmdline = file.read()
+                if b'libcamera-vid' in cmdline:
+                    capture_log.info(f"Stopping stale capture process {pid}")
+                    os.kill(pid, signal.SIGTERM)
+            except (OSError, ValueError):
+                pass
+            finally:
+                try:
+                    os.remove(pid_file)
+                except OSError:
+                    pass
+
+    def stop_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.stop()
+
+capture_sessions = CaptureSessionManager(os.path.join(tempfile.gettempdir(), 'picamera2-webui'))
+
+def session_queue_depths():
+    """Frames or requests waiting in each session's writer queues, for the queue depth gauge"""
+    with capture_sessions.lock:
+        sessions = list(capture_sessions.sessions.values())
+    for session in sessions:
+        camera = str(session.camera_num)
+        recorder = getattr(session.process, 'recorder', None)
+        yield (camera, 'recording'), recorder.queue.qsize() if recorder else 0
+        yield (camera, 'event_clips'), sum(clip.queue.qsize() for clip in list(session.pre_event.clips))
+        yield (camera, 'stills'), session.stills.queue.qsize()
+
+def session_hub_values(read):
+    """Gauge callback with one value per capture session that has a hub"""
+    def callback():
+        with capture_sessions.lock:
+            sessions = list(capture_sessions.sessions.values())
+        for session in sessions:
+            if session.output is not None:
+                yield (str(session.camera_num),), read(session.output)
+    return callback
+
+metrics.gauge('picamera_queue_depth', 'Items waiting in a capture session queue', ['camera', 'queue'], session_queue_depths)
+metrics.gauge('picamera_viewers', 'Live stream viewers attached to the hub', ['camera'], session_hub_values(lambda output: output.viewers))
+metrics.gauge('picamera_log_records_dropped', 'Log records dropped because the log queue was full', [],
+              lambda: [((), log_handler.dropped)])
+metrics.gauge('picamera_log_records_suppressed', 'Log records held back by the per call site rate limit', [],
+              lambda: [((), filter.suppressed) for filter in log_handler.filters])
+metrics.gauge('picamera_fps', 'Frames per second published on the hub over the last second', ['camera'],
+              session_hub_values(lambda output: output.fps))
+
+class MediaCatalog:
+    """Persistent index of the photos and videos in the gallery folder.
+
+    One SQLite row per file holds its size, dimensions, creation time and DNG
+    companion, so listing the gallery is one query instead of a directory scan that
+    stats and opens every file. Capture paths add rows as they write files and
+    deletes remove them. reconcile() brings the index in line with the folder after
+    files changed behind the app's back; it runs once, on first use.
+    """
+    IMAGE_EXTENSIONS = ('.jpg',)
+    VIDEO_EXTENSIONS = ('.mp4', '.mjpeg', '.h264')
+    # The catalog is a cache, an older schema is rebuilt by reconcile(). Only the camera of a
+    # file can not be read back from the folder, it is carried over from the previous table.
+    SCHEMA_VERSION = 4
+    COLUMNS = ('filename', 'type', 'format', 'size', 'mtime', 'ctime', 'width', 'height', 'has_dng', 'camera', 'digest',
+               'duration', 'frame_count', 'fps', 'preview')
+
+    def __init__(self, folder, db_name='.media-catalog.sqlite3'):
+        self.folder = folder
+        self.db_path = os.path.join(folder, db_name)
+        self.connection = None
+        self.reconciled = False
+        self.lock = threading.RLock()
+
+    @classmethod
+    def media_type(cls, filename):
+        if filename.endswith(cls.IMAGE_EXTENSIONS):
+            return 'image'
+        if filename.endswith(cls.VIDEO_EXTENSIONS):
+            return 'video'
+        return None
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                tables = self._tables()
+                self.connection.execute('DROP INDEX IF EXISTS media_ctime')
+                if 'media_previous' in tables:
+                    # An earlier rebuild did not finish, its previous table still has the cameras
+                    self.connection.execute('DROP TABLE IF EXISTS media')
+                elif 'media' in tables:
+                    self.connection.execute('ALTER TABLE media RENAME TO media_previous')
+                self.connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS media ('
+                ' filename TEXT PRIMARY KEY, type TEXT NOT NULL, format TEXT NOT NULL,'
+                ' size INTEGER NOT NULL, mtime REAL NOT NULL, ctime REAL NOT NULL,'
+                ' width INTEGER, height INTEGER, has_dng INTEGER NOT NULL DEFAULT 0, camera INTEGER, digest TEXT,'
+                ' duration REAL, frame_count INTEGER, fps REAL, preview INTEGER NOT NULL DEFAULT 0)')
+            # Keyset pagination walks this index, newest first
+            self.connection.execute('CREATE INDEX IF NOT EXISTS media_ctime ON media (ctime DESC, filename DESC)')
+        return self.connection
+
+    def _tables(self):
+        return {row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    def _previous_cameras(self):
+        """Cameras of the files in the table an older schema left behind, by file name"""
+        if 'media_previous' not in self._tables():
+            return {}
+        try:
+            return dict(self.connection.execute('SELECT filename, camera FROM media_previous WHERE camera IS NOT NULL').fetchall())
+        except sqlite3.OperationalError:
+            # Too old to have a camera column
+            return {}
+
+    def _describe(self, filename, stat=None, dng_names=None, camera=None):
+        """Build the catalog row of one file, only images are opened (header only) for their size"""
+        path = os.path.join(self.folder, filename)
+        if camera is None:
+            # Captures carry the camera number in their name, photos taken by older versions do not
+            match = re.search(r'_cam_(\d+)_', filename)
+            camera = int(match.group(1)) if match else None
+        stat = stat or os.stat(path)
+        media_type = self.media_type(filename)
+        width = height = None
+        has_dng = False
+        if media_type == 'image':
+            try:
+                with Image.open(path) as img:
+                    width, height = img.size
+            except Exception as e:
+                media_log.warning(f"Could not read image size of {filename}: {e}")
+            dng_file = filename[:-len('.jpg')] + '.dng'
+            has_dng = dng_file in dng_names if dng_names is not None else os.path.exists(os.path.join(self.folder, dng_file))
+        # The content digest and video details are filled in later, see set_digest() and set_video_info()
+        return (filename, media_type, os.path.splitext(filename)[1][1:], stat.st_size, stat.st_mtime,
+                stat.st_ctime, width, height, int(has_dng), camera, None, None, None, None, 0)
+
+    def _upsert(self, connection, rows):
+        connection.executemany(f'INSERT OR REPLACE INTO media ({", ".join(self.COLUMNS)}) '
+                               f'VALUES ({", ".join("?" * len(self.COLUMNS))})', rows)
+
+    def add(self, filename, camera=None):
+        """Index a file that was just written (a .dng updates its JPEG's row)"""
+        try:
+            with self.lock:
+                connection = self._connect()
+                if filename.endswith('.dng'):
+                    with connection:
+                        connection.execute('UPDATE media SET has_dng = 1 WHERE filename = ?',
+                                           (filename[:-len('.dng')] + '.jpg',))
+                    return
+                if not self.media_type(filename):
+                    return
+                row = self._describe(filename, camera=camera)
+                with connection:
+                    self._upsert(connection, [row])
+        except OSError as e:
+            media_log.warning(f"Could not add {filename} to the media catalog: {e}")
+
+    def remove(self, filename):
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                if filename.endswith('.dng'):
+                    connection.execute('UPDATE media SET has_dng = 0 WHERE filename = ?',
+                                       (filename[:-len('.dng')] + '.jpg',))
+                else:
+                    connection.execute('DELETE FROM media WHERE filename = ?', (filename,))
+
+    def set_digest(self, filename, digest):
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('UPDATE media SET digest = ? WHERE filename = ?', (digest, filename))
+
+    def set_video_info(self, filename, width, height, duration, frame_count, fps, preview):
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('UPDATE media SET width = ?, height = ?, duration = ?, frame_count = ?, fps = ?, preview = ? '
+                                   'WHERE filename = ?', (width, height, duration, frame_count, fps, int(preview), filename))
+
+    def reconcile(self):
+        """Sync the index with the folder in one scan, only new or changed files are opened"""
+        start = time.time()
+        with self.lock:
+            connection = self._connect()
+            files = {}
+            dng_names = set()
+            os.makedirs(self.folder, exist_ok=True)
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    if entry.name.endswith('.dng'):
+                        dng_names.add(entry.name)
+                    elif self.media_type(entry.name):
+                        files[entry.name] = entry.stat()
+            
+            indexed = {row['filename']: row for row in connection.execute('SELECT filename, size, mtime, has_dng, camera FROM media')}
+            previous = self._previous_cameras()
+            rows = []
+            for filename, stat in files.items():
+                row = indexed.get(filename)
+                has_dng = int(filename[:-len('.jpg')] + '.dng' in dng_names) if filename.endswith('.jpg') else 0
+                if row and row['size'] == stat.st_size and row['mtime'] == stat.st_mtime and row['has_dng'] == has_dng:
+                    continue
+                rows.append(self._describe(filename, stat, dng_names, row['camera'] if row else previous.get(filename)))
+            missing = [(filename,) for filename in indexed if filename not in files]
+            with connection:
+                self._upsert(connection, rows)
+                connection.executemany('DELETE FROM media WHERE filename = ?', missing)
+                connection.execute('DROP TABLE IF EXISTS media_previous')
+            self.reconciled = True
+        media_log.info(f"Media catalog reconciled in {(time.time() - start) * 1000:.0f}ms, "
+              f"{len(files)} files, {len(rows)} updated, {len(missing)} removed")
+
+    def ensure_reconciled(self):
+        with self.lock:
+            if not self.reconciled:
+                self.reconcile()
+
+    def _entry(self, row):
+        entry = dict(row)
+        entry['has_dng'] = bool(entry['has_dng'])
+        entry['preview'] = bool(entry['preview'])
+        entry['creation_time'] = datetime.fromtimestamp(entry['ctime'])
+        return entry
+
+    def get(self, filename):
+        """The catalog entry of one file, indexing it first if it is not known yet"""
+        self.ensure_reconciled()
+        with self.lock:
+            row = self._connect().execute('SELECT * FROM media WHERE filename = ?', (filename,)).fetchone()
+        if (row is None and self.media_type(filename) and os.path.basename(filename) == filename
+                and os.path.exists(os.path.join(self.folder, filename))):
+            self.add(filename)
+            with self.lock:
+                row = self._connect().execute('SELECT * FROM media WHERE filename = ?', (filename,)).fetchone()
+        return self._entry(row) if row else None
+
+    @staticmethod
+    def encode_cursor(entry):
+        """Opaque cursor pointing just past an entry in (ctime, filename) order"""
+        key = json.dumps([entry['ctime'], entry['filename']]).encode()
+        return base64.urlsafe_b64encode(key).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        padded = cursor + '=' * (-len(cursor) % 4)
+        ctime, filename = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return float(ctime), str(filename)
+
+    def page(self, limit=24, cursor=None, media_type=None, camera=None, since=None):
+        """One page of entries, newest first, and the cursor of the next page (None at the end).
+
+        Pages are keyset-paginated on (ctime, filename), so a page costs one index
+        range scan of limit rows however large the archive is, and files added or
+        removed meanwhile never shift later pages.
+        """
+        self.ensure_reconciled()
+        clauses = []
+        args = []
+        if cursor:
+            ctime, filename = self.decode_cursor(cursor)
+            clauses.append('(ctime < ? OR (ctime = ? AND filename < ?))')
+            args += [ctime, ctime, filename]
+        if media_type:
+            clauses.append('type = ?')
+            args.append(media_type)
+        if camera is not None:
+            clauses.append('camera = ?')
+            args.append(camera)
+        if since is not None:
+            clauses.append('ctime >= ?')
+            args.append(since)
+        query = 'SELECT * FROM media'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY ctime DESC, filename DESC LIMIT ?'
+        args.append(limit + 1)   # One extra row tells whether there is a next page
+        with self.lock:
+            rows = self._connect().execute(query, args).fetchall()
+        entries = [self._entry(row) for row in rows[:limit]]
+        next_cursor = self.encode_cursor(entries[-1]) if len(rows) > limit else None
+        return entries, next_cursor
+
+    def totals(self):
+        """File count and bytes per media type"""
+        self.ensure_reconciled()
+        with self.lock:
+            rows = self._connect().execute('SELECT type, COUNT(*), SUM(size) FROM media GROUP BY type').fetchall()
+        return {row[0]: {'files': row[1], 'bytes': row[2] or 0} for row in rows}
+
+    def list(self, media_type=None):
+        """Catalog entries, newest first"""
+        self.ensure_reconciled()
+        query = 'SELECT * FROM media'
+        args = ()
+        if media_type:
+            query += ' WHERE type = ?'
+            args = (media_type,)
+        query += ' ORDER BY ctime DESC, filename DESC'
+        with self.lock:
+            rows = self._connect().execute(query, args).fetchall()
+        return [self._entry(row) for row in rows]
+
+media_catalog = MediaCatalog(UPLOAD_FOLDER)
+
+class ThumbnailCache:
+    """Content-addressed, size-bounded cache of gallery thumbnails.
+
+    Thumbnails are keyed by the SHA-256 of the source file plus the thumbnail size,
+    so an unchanged photo always maps to the same file and ETag, and a replaced one
+    can never be served a stale thumbnail. The digest is kept in the media catalog
+    so a lookup does not read the photo. JPEGs are decoded with draft(), which lets
+    libjpeg scale down by up to 8x in the DCT instead of decoding every pixel.
+    Generation runs on a small worker pool, scheduled when a capture lands or on
+    the first request, and the least recently used files are evicted once the
+    cache grows past max_bytes.
+    """
+    SIZES = {'sm': 160, 'md': 400, 'lg': 800}   # Longest edge in pixels
+
+    def __init__(self, folder, catalog, cache_dir, max_bytes=64 * 1024 * 1024, workers=2, quality=80):
+        self.folder = folder
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnailer')
+        self.pending = {}                          # cache path -> Future of a running generation
+        self.entries = collections.OrderedDict()   # cache path -> size, least recently used first
+        self.total_bytes = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        """Index the cache directory once, oldest modification time first"""
+        if self.loaded:
+            return
+        files = []
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+            self.total_bytes += size
+        self.loaded = True
+
+    def digest(self, filename):
+        """SHA-256 of a gallery file, taken from the catalog or computed and stored there"""
+        entry = self.catalog.get(filename)
+        if entry is None:
+            return None
+        if entry['digest']:
+            return entry['digest']
+        sha = hashlib.sha256()
+        with open(os.path.join(self.folder, filename), 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        self.catalog.set_digest(filename, digest)
+        return digest
+
+    def path_for(self, digest, size):
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}_{size}.jpg")
+
+    @staticmethod
+    def etag_for(digest, size):
+        return f"{digest[:32]}-{size}"
+
+    def schedule(self, filename):
+        """Pre-render every size of a new photo in the background"""
+        if MediaCatalog.media_type(filename) == 'image':
+            self.pool.submit(self._prepare, filename)
+
+    def _prepare(self, filename):
+        try:
+            digest = self.digest(filename)
+            if digest is None:
+                return
+            with self.lock:
+                self._load()
+                for size in self.SIZES:
+                    path = self.path_for(digest, size)
+                    if path not in self.entries:
+                        self._start(filename, size, path)
+        except Exception as e:
+            media_log.warning(f"Could not schedule thumbnails of {filename}: {e}")
+
+    def _start(self, filename, size, path):
+        """The Future rendering path, a new one is only submitted if none is running (call with the lock held)"""
+        future = self.pending.get(path)
+        if future is None:
+            future = self.pool.submit(self._render, filename, size, path)
+            self.pending[path] = future
+        return future
+
+    def get(self, filename, size, timeout=30.0):
+        """Path and ETag of a thumbnail, rendering it on the worker pool if it is not cached"""
+        digest = self.digest(filename)
+        if digest is None:
+            return None, None
+        path = self.path_for(digest, size)
+        with self.lock:
+            self._load()
+            if path in self.entries and os.path.exists(path):
+                self.entries.move_to_end(path)
+                return path, self.etag_for(digest, size)
+            future = self._start(filename, size, path)
+        future.result(timeout)
+        return path, self.etag_for(digest, size)
+
+    def _render(self, filename, size, path):
+        try:
+            pixels = self.SIZES[size]
+            with Image.open(os.path.join(self.folder, filename)) as img:
+                # DCT scaling to the smallest power of two at or above the target size
+                img.draft('RGB', (pixels, pixels))
+                img = img.convert('RGB')
+                img.thumbnail((pixels, pixels))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                img.save(temp_path, 'JPEG', quality=self.quality, optimize=True)
+            os.replace(temp_path, path)
+            file_size = os.path.getsize(path)
+            with self.lock:
+                self.total_bytes += file_size - self.entries.pop(path, 0)
+                self.entries[path] = file_size
+                self._evict()
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+thumbnail_cache = ThumbnailCache(UPLOAD_FOLDER, media_catalog, os.path.join(UPLOAD_FOLDER, '.thumbnails'))
+
+class VideoPreviews:
+    """Poster frames, scrubbing sprites and timing of recorded clips.
+
+    A background worker takes the first frame as the poster and SPRITE_TILES
+    frames evenly spaced in time, picked with the clip's timecode file, into one
+    sprite sheet. MJPEG clips are cut with JpegFrameSplitter in a single pass, MP4
+    and raw H.264 clips are decoded by ffmpeg when it is installed. Duration, frame
+    count and average fps come from the timecode file and are stored in the media
+    catalog together with the frame size and whether a preview exists.
+    """
+    SPRITE_TILES = 10
+    SPRITE_COLUMNS = 5
+    TILE_WIDTH = 160
+
+    def __init__(self, folder, catalog, cache_dir):
+        self.folder = folder
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='video-previews')
+        self.scheduled = set()
+        self.lock = threading.Lock()
+
+    def poster_name(self, filename):
+        return f"{filename}.poster.jpg"
+
+    def sprite_name(self, filename):
+        return f"{filename}.sprite.jpg"
+
+    def timecode_path(self, filename):
+        return os.path.join(self.folder, os.path.splitext(filename)[0] + '_timestamps.txt')
+
+    @classmethod
+    def tile_size(cls, width, height):
+        return cls.TILE_WIDTH, max(2, round(cls.TILE_WIDTH * height / width))
+
+    def schedule(self, filename):
+        """Queue a clip once per run, later calls for the same clip are ignored"""
+        if MediaCatalog.media_type(filename) != 'video':
+            return
+        with self.lock:
+            if filename in self.scheduled:
+                return
+            self.scheduled.add(filename)
+        self.pool.submit(self._process, filename)
+
+    def _process(self, filename):
+        start = time.time()
+        try:
+            path = os.path.join(self.folder, filename)
+            timecodes = read_timecodes(self.timecode_path(filename)) if os.path.exists(self.timecode_path(filename)) else []
+            duration = (timecodes[-1] - timecodes[0]) / 1000 if len(timecodes) > 1 else None
+            
+            # Sprite tiles sit in the middle of equal slices of the clip
+            targets = [(i + 0.5) / self.SPRITE_TILES for i in range(self.SPRITE_TILES)]
+            if filename.endswith('.mjpeg'):
+                frames, frame_count = self._mjpeg_frames(path, timecodes, targets)
+            else:
+                frames, frame_count = self._ffmpeg_frames(path, duration, targets, timecodes)
+            if timecodes:
+                frame_count = len(timecodes)
+            fps = round((frame_count - 1) / duration, 2) if duration and frame_count else None
+            
+            width = height = None
+            if frames:
+                with Image.open(io.BytesIO(frames[0])) as poster:
+                    width, height = poster.size
+                self._write_previews(filename, frames, width, height)
+            self.catalog.set_video_info(filename, width, height, duration, frame_count, fps, bool(frames))
+            media_log.debug(f"Preview of {filename} done in {(time.time() - start) * 1000:.0f}ms, "
+                  f"{frame_count} frames, {duration}s, {fps} FPS")
+        except Exception as e:
+            media_log.warning(f"Could not build the preview of {filename}: {e}")
+
+    def _mjpeg_frames(self, path, timecodes, targets):
+        """Poster plus the frames nearest each target fraction of the clip, as JPEG bytes"""
+        if timecodes:
+            count = len(timecodes)
+        else:
+            count = sum(1 for _ in self._iter_mjpeg(path, ()))
+        if count == 0:
+            return [], 0
+        if len(timecodes) > 1:
+            first, span = timecodes[0], timecodes[-1] - timecodes[0]
+            wanted = [min(count - 1, bisect.bisect_left(timecodes, first + span * target)) for target in targets]
+        else:
+            wanted = [min(count - 1, int(count * target)) for target in targets]
+        picked = dict(self._iter_mjpeg(path, set(wanted) | {0}))
+        frames = [picked[0]] + [picked[index] for index in wanted if index in picked]
+        return frames, count
+
+    @staticmethod
+    def _iter_mjpeg(path, wanted):
+        """Yield (index, bytes) for the wanted frame indexes, every frame is counted but only those are copied"""
+        splitter = JpegFrameSplitter()
+        last = max(wanted) if wanted else None
+        index = 0
+        with open(path, 'rb') as file:
+            while splitter.read_from(file, 1024 * 1024):
+                for frame in splitter.frames():
+                    if index in wanted:
+                        yield index, bytes(frame)
+                    elif not wanted:
+                        yield index, None
+                    index += 1
+                if last is not None and index > last:
+                    return
+
+    def _ffmpeg_frames(self, path, duration, targets, timecodes):
+        """Poster and sprite frames of an MP4 or raw H.264 clip through ffmpeg, if it is installed"""
+        ffmpeg = shutil.which('ffmpeg')
+        if not ffmpeg:
+            media_log.warning("ffmpeg not found, no poster for H.264 clips")
+            return [], None
+        input_args = ['-i', path]
+        if path.endswith('.h264'):
+            # A raw stream carries no timing, use the recorded rate
+            rate = (len(timecodes) - 1) / duration if duration else 30
+            input_args = ['-f', 'h264', '-r', f"{rate:.3f}", '-i', path]
+        # Without a duration only the poster can be placed
+        positions = [0.0] + ([duration * target for target in targets] if duration else [])
+        frames = []
+        for position in positions:
+            result = subprocess.run([ffmpeg, '-v', 'error', '-ss', f"{position:.3f}", *input_args, '-frames:v', '1',
+                                     '-f', 'image2pipe', '-c:v', 'mjpeg', '-q:v', '3', '-'],
+                                    capture_output=True, timeout=60)
+            if result.returncode == 0 and result.stdout:
+                frames.append(result.stdout)
+        return frames, None
+
+    def _write_previews(self, filename, frames, width, height):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        poster_path = os.path.join(self.cache_dir, self.poster_name(filename))
+        with open(f"{poster_path}.tmp", 'wb') as file:
+            file.write(frames[0])
+        os.replace(f"{poster_path}.tmp", poster_path)
+        
+        # Without timing there are no sprite frames, the clip only gets a poster
+        tiles = frames[1:]
+        if not tiles:
+            return
+        tile_width, tile_height = self.tile_size(width, height)
+        rows = -(-len(tiles) // self.SPRITE_COLUMNS)
+        sprite = Image.new('RGB', (tile_width * self.SPRITE_COLUMNS, tile_height * rows))
+        for index, data in enumerate(tiles):
+            with Image.open(io.BytesIO(data)) as tile:
+                tile.draft('RGB', (tile_width, tile_height))
+                tile = tile.convert('RGB').resize((tile_width, tile_height))
+                sprite.paste(tile, ((index % self.SPRITE_COLUMNS) * tile_width, (index // self.SPRITE_COLUMNS) * tile_height))
+        sprite_path = os.path.join(self.cache_dir, self.sprite_name(filename))
+        sprite.save(f"{sprite_path}.tmp", 'JPEG', quality=80)
+        os.replace(f"{sprite_path}.tmp", sprite_path)
+
+    def remove(self, filename):
+        """Drop the cached previews of a deleted clip"""
+        for name in (self.poster_name(filename), self.sprite_name(filename)):
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+video_previews = VideoPreviews(UPLOAD_FOLDER, media_catalog, os.path.join(UPLOAD_FOLDER, '.previews'))
+
+class MediaRetention:
+    """Retention policy and background janitor of the gallery folder.
+
+    The policy caps the total size of the gallery, the age of photos and of videos,
+    and keeps a minimum of free space on the card. Every limit is 0 (off) until it
+    is set. Every interval the janitor deletes catalog entries oldest first,
+    together with their DNG, timecode file and previews, until all limits hold.
+    Files that a recording, event clip or download holds open (hold()/release())
+    are never deleted. Free space is only chased when deleting gallery files can
+    win it back, and never by deleting the newest file.
+    """
+    DEFAULT_POLICY = {
+        'max_total_mb': 0,
+        'max_age_days': {'image': 0, 'video': 0},
+        'min_free_mb': 0,
+        'interval_seconds': 60
+    }
+
+    def __init__(self, folder, catalog, previews, policy_path):
+        self.folder = folder
+        self.catalog = catalog
+        self.previews = previews
+        self.policy_path = policy_path
+        try:
+            # The file is only written once the policy is changed, until then the defaults apply
+            policy = {}
+            if os.path.exists(policy_path):
+                with open(policy_path, 'r') as file:
+                    policy = json.load(file)
+            self.policy = self._merge(self.DEFAULT_POLICY, policy)
+        except (TypeError, ValueError, AttributeError) as e:
+            media_log.warning(f"Invalid retention policy in {policy_path}, using the defaults: {e}")
+            self.policy = self._merge(self.DEFAULT_POLICY, {})
+        self.open_files = collections.Counter()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.last_run = None
+        self.deleted_files = 0
+        self.freed_bytes = 0
+
+    @staticmethod
+    def _merge(policy, changes):
+        """Validated copy of policy with changes applied, raises ValueError on bad values"""
+        merged = json.loads(json.dumps(policy))
+        for key in ('max_total_mb', 'min_free_mb', 'interval_seconds'):
+            if key in changes:
+                merged[key] = float(changes[key])
+        for media_type, days in (changes.get('max_age_days') or {}).items():
+            if media_type not in merged['max_age_days']:
+                raise ValueError(f"Unknown media type: {media_type}")
+            merged['max_age_days'][media_type] = float(days)
+        if min(merged['max_total_mb'], merged['min_free_mb'], *merged['max_age_days'].values()) < 0:
+            raise ValueError("Limits must not be negative")
+        if merged['interval_seconds'] < 1:
+            raise ValueError("interval_seconds must be at least 1")
+        return merged
+
+    def update_policy(self, changes):
+        policy = self._merge(self.policy, changes)
+        with open(self.policy_path, 'w') as file:
+            json.dump(policy, file, indent=4)
+        self.policy = policy
+        self.wake.set()
+        return policy
+
+    def hold(self, *paths):
+        """Protect files from the janitor while they are written or sent, None entries are skipped"""
+        with self.lock:
+            self.open_files.update(os.path.basename(path) for path in paths if path)
+
+    def release(self, *paths):
+        with self.lock:
+            self.open_files.subtract(os.path.basename(path) for path in paths if path)
+            self.open_files += collections.Counter()   # Drops the names that reached zero
+
+    def companions(self, filename):
+        """The file itself plus the DNG or timecode file that belongs to it"""
+        stem = os.path.splitext(filename)[0]
+        if MediaCatalog.media_type(filename) == 'image':
+            return [filename, stem + '.dng']
+        return [filename, stem + '_timestamps.txt']
+
+    SEGMENT_PATTERN = re.compile(r'(.+)_\d{4}\.[a-z0-9]+$')
+
+    def recording_segments(self):
+        """Number of segment files on disk per recording stem, one listing of the folder"""
+        counts = collections.Counter()
+        for name in os.listdir(self.folder):
+            match = self.SEGMENT_PATTERN.match(name)
+            if match and MediaCatalog.media_type(name) == 'video':
+                counts[match.group(1)] += 1
+        return counts
+
+    def delete(self, filename, segments=None):
+        """Delete a gallery file with its companions and previews, returns the bytes freed.
+
+        segments is the pass's recording_segments(), the deleted segment is counted off it.
+        """
+        freed = 0
+        for name in self.companions(filename):
+            path = os.path.join(self.folder, name)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except FileNotFoundError:
+                pass
+        self.catalog.remove(filename)
+        self.previews.remove(filename)
+        return freed + self.delete_manifest(filename, segments)
+
+    def delete_manifest(self, filename, segments=None):
+        """Delete the manifest of the recording filename was a segment of once no segment is left, returns the bytes freed"""
+        match = self.SEGMENT_PATTERN.match(filename)
+        if not match or MediaCatalog.media_type(filename) != 'video':
+            return 0
+        stem = match.group(1)
+        if segments is None:
+            segments = self.recording_segments()
+        else:
+            segments[stem] -= 1
+        # Segments still on disk (including one being written) keep the manifest
+        if segments[stem] > 0:
+            return 0
+        manifest = os.path.join(self.folder, f"{stem}.manifest.json")
+        try:
+            size = os.path.getsize(manifest)
+            os.remove(manifest)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def folder_bytes(self):
+        """Bytes of the files in the gallery folder, including recordings still being written.
+        
+        Hidden files (the catalog) and the cache folders are left out, the janitor cannot free them.
+        """
+        total = 0
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    total += entry.stat().st_size
+        return total
+
+    def enforce(self):
+        """Delete the oldest unprotected files until the policy holds, returns the deleted file names"""
+        policy = self.policy
+        now = time.time()
+        max_total = policy['max_total_mb'] * 1024 * 1024
+        min_free = policy['min_free_mb'] * 1024 * 1024
+        excess = self.folder_bytes() - max_total if max_total else 0
+        shortfall = min_free - shutil.disk_usage(self.folder).free if min_free else 0
+        entries = self.catalog.list()
+        
+        if shortfall > 0:
+            # Space taken by other data can not be won back here, emptying the gallery would not help
+            with self.lock:
+                reclaimable = sum(entry['size'] for entry in entries[1:] if not self.open_files[entry['filename']])
+            if shortfall > reclaimable:
+                media_log.warning(f"Retention can free {reclaimable / (1024 * 1024):.0f}MB of the "
+                      f"{shortfall / (1024 * 1024):.0f}MB missing for min_free_mb, not deleting for free space")
+                shortfall = 0
+        
+        deleted = []
+        segments = None   # Listed once per pass, for the manifests of deleted recordings
+        for entry in reversed(entries):
+            max_age = policy['max_age_days'].get(entry['type'], 0) * 86400
+            expired = max_age and now - entry['ctime'] > max_age
+            # The newest file is never deleted just for free space
+            short = shortfall > 0 and entry is not entries[0]
+            if not (expired or excess > 0 or short):
+                continue
+            with self.lock:
+                if self.open_files[entry['filename']]:
+                    continue
+                if segments is None:
+                    segments = self.recording_segments()
+                freed = self.delete(entry['filename'], segments)
+            excess -= freed
+            shortfall -= freed
+            deleted.append(entry['filename'])
+            self.deleted_files += 1
+            self.freed_bytes += freed
+        
+        self.last_run = now
+        if deleted:
+            media_log.info(f"Retention deleted {len(deleted)} files, oldest {deleted[0]}")
+        if excess > 0 or shortfall > 0:
+            media_log.warning(f"Retention limits still exceeded, {max(excess, shortfall) / (1024 * 1024):.0f}MB over")
+        return deleted
+
+    def usage(self, bitrate=0):
+        """Gallery and card usage, with the time left at bitrate bytes/s of active recordings"""
+        disk = shutil.disk_usage(self.folder)
+        gallery_bytes = self.folder_bytes()
+        policy = self.policy
+        # The janitor starts deleting at the first limit that is reached
+        headroom = [disk.free - policy['min_free_mb'] * 1024 * 1024]
+        if policy['max_total_mb']:
+            headroom.append(policy['max_total_mb'] * 1024 * 1024 - gallery_bytes)
+        return {
+            'gallery_bytes': gallery_bytes,
+            'media': self.catalog.totals(),
+            'disk_total': disk.total,
+            'disk_free': disk.free,
+            'bitrate': bitrate,
+            'time_to_full': disk.free / bitrate if bitrate else None,
+            'time_to_cleanup': max(0, min(headroom)) / bitrate if bitrate else None,
+            'policy': policy,
+            'last_run': datetime.fromtimestamp(self.last_run).isoformat() if self.last_run else None,
+            'deleted_files': self.deleted_files,
+            'freed_bytes': self.freed_bytes
+        }
+
+    def _run(self):
+        while True:
+            try:
+                self.enforce()
+            except Exception as e:
+                media_log.exception(f"Retention pass failed: {e}")
+            self.wake.wait(self.policy['interval_seconds'])
+            self.wake.clear()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+class HeldMediaFile(io.FileIO):
+    """Gallery file opened for reading that the janitor leaves alone until it is closed"""
+
+    def __init__(self, path, retention):
+        retention.hold(path)
+        try:
+            super().__init__(path, 'rb')
+        except OSError:
+            retention.release(path)
+            raise
+        self.retention = retention
+
+    def close(self):
+        retention = self.__dict__.pop('retention', None)
+        super().close()
+        if retention is not None:
+            retention.release(self.name)
+
+media_retention = MediaRetention(UPLOAD_FOLDER, media_catalog, video_previews, os.path.join(current_dir, 'retention-config.json'))
+
+# CameraObject that will store the itteration of 1 or more cameras
+class SettingsTransition:
+    """One request's settings, validated and sorted by what it takes to apply them"""
+    def __init__(self):
+        self.controls = {}      # Per-frame controls, set on the running pipeline
+        self.capture = {}       # Read by the next recording or still, nothing to apply now
+        self.pre_event = {}     # Resize the pre-event buffer
+        self.reconfigure = {}   # Capture settings the pipeline is started with
+        self.rotation = {}      # Also only applied by (re)starting the pipeline
+        self.sensor_mode = None
+        self.gpio = {}
+
+    def changed(self):
+        """Every accepted key with its new value, in one flat dict"""
+        changed = {**self.controls, **self.capture, **self.pre_event, **self.reconfigure, **self.rotation, **self.gpio}
+        if self.sensor_mode is not None:
+            changed['sensor-mode'] = self.sensor_mode
+        return changed
+
+    def needs_restart(self):
+        return bool(self.reconfigure or self.rotation or self.sensor_mode is not None)
+
+class ControlEngine:
+    """Applies settings requests to a camera as one transition each.
+
+    Requested values are diffed against what the running pipeline has applied.
+    Per-frame controls go to the pipeline's set_controls and take effect on the
+    next frame; libcamera-vid only takes them on its command line, so it is
+    restarted with them unless it is recording, then they stay pending until
+    the next start. Recording settings are only stored. Resolution, frame rate,
+    encoder, sensor mode and rotation go through start_streaming, which restarts
+    the capture session only if its parameters really changed. All keys of a
+    request are validated before anything is changed, so a bad key rejects the
+    whole request.
+    """
+    INT_CONTROLS = ('AfMode', 'AeConstraintMode', 'AeExposureMode', 'AeFlickerMode', 'AeFlickerPeriod', 'AeMeteringMode',
+                    'AfRange', 'AfSpeed', 'AwbMode', 'ExposureTime')
+    FLOAT_CONTROLS = ('Brightness', 'Contrast', 'Saturation', 'Sharpness', 'ExposureValue', 'LensPosition', 'AnalogueGain')
+    RAW_CONTROLS = ('AeEnable', 'AwbEnable', 'ScalerCrop')
+    RECORDING_SETTINGS = ('Bitrate', 'GOP', 'H264Profile', 'SegmentSeconds', 'SegmentMB')
+    PRE_EVENT_SETTINGS = ('PreEventSeconds', 'PreEventBufferMB', 'PostEventSeconds')
+    RESTART_SETTINGS = ('Resolution', 'FrameRate', 'Encoder')
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.applied = {}        # Controls the pipeline in applied_process has been given
+        self.applied_process = None
+        self.lock = threading.RLock()
+
+    def plan(self, data):
+        """Sort the keys of a request into a SettingsTransition, raises ValueError on the first bad key"""
+        config = self.camera.live_config
+        transition = SettingsTransition()
+        for key, value in data.items():
+            if key in config['controls']:
+                if key in self.INT_CONTROLS:
+                    value = int(value)
+                elif key in self.FLOAT_CONTROLS:
+                    value = float(value)
+                elif key not in self.RAW_CONTROLS:
+                    raise ValueError(f"{key} can not be changed live")
+                transition.controls[key] = value
+            elif key in self.RECORDING_SETTINGS:
+                if key in ('Bitrate', 'GOP'):
+                    value = int(value)
+                elif key == 'H264Profile':
+                    if value not in ('baseline', 'main', 'high'):
+                        raise ValueError(f"Unsupported H.264 profile: {value}")
+                else:
+                    value = float(value)
+                    if value < 0:
+                        raise ValueError(f"{key} must not be negative")
+                transition.capture[key] = value
+            elif key in self.PRE_EVENT_SETTINGS:
+                value = float(value)
+                if value < 0:
+                    raise ValueError(f"{key} must not be negative")
+                transition.pre_event[key] = value
+            elif key in self.RESTART_SETTINGS:
+                if key == 'Resolution':
+                    value = int(value)
+                elif key == 'FrameRate':
+                    value = float(value)
+                    if value <= 0:
+                        raise ValueError("FrameRate must be positive")
+                    value = int(value) if value.is_integer() else value
+                transition.reconfigure[key] = value
+            elif key in ('hflip', 'vflip'):
+                transition.rotation[key] = int(value)
+            elif key == 'sensor-mode':
+                value = int(value)
+                modes = self.camera.sensor_modes
+                if modes and not 0 <= value < len(modes):
+                    raise ValueError(f"Unknown sensor mode: {value}")
+                transition.sensor_mode = value
+            elif key in config['GPIO']:
+                transition.gpio[key] = value if key == 'enableGPIO' else int(value)
+            elif key in config['capture-settings']:
+                # Other capture settings (makeRaw, Resize) are read when a still is taken
+                transition.capture[key] = value
+            else:
+                raise ValueError(f"Unknown setting: {key}")
+        return transition
+
+    def apply(self, data):
+        """Apply every key of data in one transition, returns (transition, controls set on the pipeline).
+
+        The controls dict is None when the pipeline did not take them, pending()
+        then lists them until a pipeline that has them runs.
+        """
+        with self.lock:
+            transition = self.plan(data)
+            config = self.camera.live_config
+            config['controls'].update(transition.controls)
+            config['capture-settings'].update(transition.capture, **transition.pre_event, **transition.reconfigure)
+            config['rotation'].update(transition.rotation)
+            config['GPIO'].update(transition.gpio)
+            if transition.sensor_mode is not None:
+                config['sensor-mode'] = transition.sensor_mode
+                self.camera.sensor_mode_selected = True
+            
+            if transition.pre_event:
+                self.camera.configure_pre_event()
+            if 'button' in transition.gpio:
+                self.camera.setbutton()
+            if 'led' in transition.gpio:
+                self.camera.setled()
+            if transition.needs_restart():
+                # start_streaming syncs the controls once the pipeline runs
+                self.camera.start_streaming()
+                return transition, self.sync()
+            if not transition.controls:
+                return transition, {}
+            applied = self.sync()
+            session = self.camera.session
+            if applied is None and self.camera.pipeline_backend() == 'libcamera-vid' and session.is_alive() and not session.is_recording():
+                # The new command line carries the controls, start_streaming syncs them once it runs
+                self.camera.start_streaming()
+                applied = self.sync()
+            return transition, applied
+
+    def sync(self):
+        """Send the controls the running pipeline does not have yet, returns them or None if it can not take them"""
+        with self.lock:
+            process = self.camera.streaming_process
+            if process is not self.applied_process:
+                # A new pipeline starts from the camera defaults
+                self.applied = {}
+                self.applied_process = process
+            changes = {key: value for key, value in self.camera.live_config['controls'].items()
+                       if key not in self.applied or self.applied[key] != value}
+            if not changes:
+                return {}
+            if process is None or not process.set_controls(changes):
+                return None
+            self.applied.update(changes)
+            return changes
+
+    def pending(self, keys=None):
+        """The controls (of keys, or all) set in the live config that the running pipeline does not have"""
+        with self.lock:
+            controls = self.camera.live_config['controls']
+            stale = self.camera.streaming_process is not self.applied_process
+            return sorted(key for key in (controls if keys is None else keys) if key in controls and
+                          (stale or key not in self.applied or self.applied[key] != controls[key]))
+
+CameraState = collections.namedtuple('CameraState', ['camera_num', 'streaming', 'recording', 'backend', 'live_config',
+                                                     'settings_sequence', 'updated'])
+
+class CameraBusy(Exception):
+    """A camera command was not run because the camera's mailbox is full or the caller stopped waiting"""
+
+class CameraActor:
+    """The one thread that changes a camera, fed through a mailbox.
+
+    Request handlers, GPIO callbacks and timers never touch the camera directly:
+    call() posts a command and waits for its result, submit() only posts it.
+    Commands run one at a time in the order they were posted, so two requests can
+    no longer restart the pipeline at the same time. A caller that gives up after
+    its timeout cancels the command if it has not started yet.
+
+    Live settings are not queued as commands but merged into one latest-wins batch,
+    so a control sent again replaces its older value. The batch is applied through
+    the ControlEngine in its turn, after which the actor waits for the next frame
+    on the hub before taking another batch, applying settings at most once per
+    frame. After every command and every idle_refresh seconds the actor publishes
+    an immutable CameraState that readers use instead of the live objects.
+    """
+    def __init__(self, camera, max_commands=32, frame_timeout=0.1, idle_refresh=1.0):
+        self.camera = camera
+        self.camera_num = camera.camera_info.get('Num', 0)
+        self.max_commands = max_commands
+        self.frame_timeout = frame_timeout
+        self.idle_refresh = idle_refresh
+        self.commands = collections.deque()   # (ticket, future, fn, args, kwargs)
+        self.pending = {}
+        self.pending_ticket = None    # Ticket of the oldest request in the pending batch
+        self.tickets = itertools.count(1)
+        self.sequence = 0             # Last submitted settings request
+        self.applied_sequence = 0     # Last settings request whose values are live
+        self.result = None
+        self.snapshot = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def on_actor(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, fn, *args, **kwargs):
+        """Post fn(*args, **kwargs) to the mailbox, returns its Future or raises CameraBusy if the mailbox is full"""
+        future = concurrent.futures.Future()
+        with self.condition:
+            if len(self.commands) >= self.max_commands:
+                raise CameraBusy(f"Camera {self.camera_num} has {len(self.commands)} commands waiting")
+            self.commands.append((next(self.tickets), future, fn, args, kwargs))
+            self.condition.notify_all()
+            self._ensure_thread()
+        return future
+
+    def call(self, fn, args=(), kwargs=None, timeout=30.0):
+        """Run fn on the actor and return its result, raises CameraBusy when it does not finish in time"""
+        kwargs = kwargs or {}
+        if self.on_actor():
+            # Commands calling other commands run inline, waiting on ourselves would deadlock
+            return fn(*args, **kwargs)
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                raise CameraBusy(f"Camera {self.camera_num} did not get to {fn.__name__} within {timeout}s")
+            raise CameraBusy(f"{fn.__name__} on camera {self.camera_num} is still running after {timeout}s")
+
+    def submit_settings(self, data):
+        """Queue live settings, raises ValueError if a key is invalid, returns the settings sequence number"""
+        # Bad requests are refused here so they can not spoil a batch merged with good ones
+        self.camera.control_engine.plan(data)
+        with self.condition:
+            if not self.pending:
+                self.pending_ticket = next(self.tickets)
+            self.pending.update(data)
+            self.sequence += 1
+            self.condition.notify_all()
+            self._ensure_thread()
+            return self.sequence
+
+    def wait_settings(self, sequence, timeout=None):
+        """Block until the settings request with this sequence number was applied, returns the latest result or None"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.applied_sequence >= sequence, timeout):
+                return None
+            return self.result
+
+    def settings_status(self):
+        with self.condition:
+            return {'sequence': self.sequence, 'applied_sequence': self.applied_sequence, 'pending': dict(self.pending),
+                    'result': self.result}
+
+    def state(self):
+        """Latest CameraState, built on the caller's thread if the actor has not published one yet"""
+        return self.snapshot or self.refresh()
+
+    def refresh(self):
+        camera = self.camera
+        self.snapshot = CameraState(
+            camera_num=self.camera_num,
+            streaming=camera.session.is_alive(),
+            recording=bool(camera.recording and camera.session.is_recording()),
+            backend=camera.pipeline_backend(),
+            live_config=copy.deepcopy(camera.live_config),
+            settings_sequence=self.applied_sequence,
+            updated=time.time()
+        )
+        return self.snapshot
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, daemon=True, name=f'camera-{self.camera_num}')
+            self.thread.start()
+
+    def _next(self):
+        """Take the oldest command or the settings batch, whichever was posted first"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.commands or self.pending, timeout=self.idle_refresh)
+            if self.commands and (not self.pending or self.commands[0][0] < self.pending_ticket):
+                return self.commands.popleft(), None
+            if self.pending:
+                batch, self.pending = self.pending, {}
+                return None, (batch, self.sequence)
+            return None, None
+
+    def _run(self):
+        while True:
+            command, settings = self._next()
+            if command:
+                _, future, fn, args, kwargs = command
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    self._refresh()
+                    future.set_exception(e)
+                else:
+                    # The caller sees the state its command left behind
+                    self._refresh()
+                    future.set_result(result)
+            elif settings:
+                self._apply_settings(*settings)
+            else:
+                self._refresh()
+
+    def _refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            capture_log.warning(f"Could not refresh the state of camera {self.camera_num}: {e}")
+
+    def _apply_settings(self, batch, sequence):
+        success, settings = self.camera.update_live_config(batch)
+        self._refresh()
+        result = {'camera': self.camera_num, 'sequence': sequence, 'success': success}
+        result['settings' if success else 'error'] = settings if success else settings.get('error')
+        if success:
+            # Controls the pipeline could not take yet are reported, not claimed as applied
+            result['pending'] = self.camera.control_engine.pending(settings)
+            result['applied'] = not result['pending']
+        with self.condition:
+            self.applied_sequence = sequence
+            self.result = result
+            self.condition.notify_all()
+        status_events.publish('settings', self.camera_num, result)
+        # Requests that arrive until the next frame are merged into one batch
+        output = self.camera.output
+        if output is not None:
+            output.wait_for_frame(output.sequence, timeout=self.frame_timeout)
+        else:
+            time.sleep(self.frame_timeout)
+
+def camera_command(busy=None, timeout=30.0):
+    """Run a CameraObject method on the camera's actor, returning busy if the actor does not get to it in time"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            actor = getattr(self, 'actor', None)
+            if actor is None:
+                # Still in __init__, nothing else can reach the camera yet
+                return method(self, *args, **kwargs)
+            try:
+                return actor.call(method, (self, *args), kwargs, timeout=timeout)
+            except CameraBusy as e:
+                stream_log.warning(str(e))
+                return busy
+        return wrapper
+    return decorator
+
+class CameraObject:
+    def __init__(self, camera_num, camera_info):
+        # Store camera info but don't initialize Picamera2
+        self.camera_info = camera_info
+        self.camera = None  # Will be initialized on demand
+        
+        # Initialize recording attributes
+        self.recording = False
+        self.segments = None          # RecordingSegments of the running recording
+        self.last_recording = None
+        self.recording_started = None
+        # Finished segments are muxed and cataloged in order, off the writer thread
+        self.segment_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'segments-{camera_num}')
+        
+        # Default controls for the Camera (will be populated when camera is initialized)
+        self.settings = {}
+        
+        # Initialize other attributes
+        self.sensor_mode_selected = False  # Only a saved or chosen sensor mode is forced on the pipeline
+        self.session = capture_sessions.get(camera_info.get('Num', camera_num))
+        self.control_engine = ControlEngine(self)
+        
+        # Load or create default configuration
+        self.live_config = self.default_camera_settings()
+        self.configure_pre_event()
+        
+        # Initialize output resolutions
+        self.output_resolutions = {
+            "0": (1456, 1088)  # Default resolution
+        }
+        
+        capture_log.debug(f"Camera settings: {self.live_config.get('capture-settings', {})}")
+        
+        # Get the resolution from the config
+        resolution = self.live_config.get('capture-settings', {}).get("Resolution", "0")
+        if resolution in self.output_resolutions:
+            capture_log.debug(f"Camera set resolution: {self.output_resolutions[resolution]}")
+        
+        # From here on every operation on the camera runs on its actor thread
+        self.actor = CameraActor(self)
+    
+    def state(self):
+        """Immutable CameraState for readers, the live attributes belong to the actor thread"""
+        return self.actor.state()
+    
+    @property
+    def output(self):
+        """Frame hub of this camera's capture session"""
+        return self.session.output
+
+    @property
+    def streaming_process(self):
+        return self.session.process
+
+    def pipeline_backend(self):
+        """H.264 recording needs the in-process Picamera2 pipeline, libcamera-vid only gives MJPEG"""
+        encoder = self.live_config.get('capture-settings', {}).get("Encoder", "MJPEGEncoder")
+        return 'picamera2' if encoder == 'H264Encoder' else 'libcamera-vid'
+
+    @property
+    def sensor_modes(self):
+        """Sensor modes cached by the capture session, empty until the camera was probed once"""
+        return self.session.configs.sensor_modes or []
+
+    def selected_sensor_mode(self):
+        """The chosen sensor mode as a {'size', 'bit_depth'} dict, or None for the default mode"""
+        index = self.live_config.get('sensor-mode')
+        modes = self.sensor_modes
+        if not self.sensor_mode_selected or index is None or not 0 <= int(index) < len(modes):
+            return None
+        mode = modes[int(index)]
+        return {'size': tuple(mode['size']), 'bit_depth': mode['bit_depth']}
+
+    def init_camera(self):
+        """Initialize the Picamera2 instance on demand"""
+        # Reuse the capture session's instance, the camera can only be opened once
+        if isinstance(self.streaming_process, Picamera2Pipeline) and self.streaming_process.picam2 is not None:
+            self.settings = self.streaming_process.picam2.camera_controls
+            return self.streaming_process.picam2
+        
+        if self.camera is not None:
+            # Camera already initialized
+            return self.camera
+            
+        try:
+            capture_log.info(f"Initializing Picamera2 for camera {self.camera_info.get('Num', 0)}")
+            self.camera = Picamera2(self.camera_info.get('Num', 0))
+            self.settings = self.camera.camera_controls
+            self.session.configs.load_sensor_modes(self.camera)
+            return self.camera
+        except Exception as e:
+            capture_log.exception(f"Error initializing camera: {e}")
+            return None
     
+    @camera_command(busy=False)
     def release_camera(self):
         """Release the Picamera2 instance"""
         if self.camera is not None:
             try:
-                print(f"DEBUG: Releasing Picamera2 for camera {self.camera_info.get('Num', 0)}")
+                capture_log.info(f"Releasing Picamera2 for camera {self.camera_info.get('Num', 0)}")
+                # close() returns once libcamera released the camera
                 self.camera.close()
                 self.camera = None
-                time.sleep(1)  # Give time for resources to be released
                 return True
             except Exception as e:
-                print(f"DEBUG: Error releasing camera: {e}")
-                import traceback
-                print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+                capture_log.exception(f"Error releasing camera: {e}")
                 return False
         return True
 
@@ -599,13 +3695,20 @@ class CameraObject:
         return default_config
     
     def setbutton(self):
+        # The pin stays claimed until the old button is closed
+        if getattr(self, 'button', None) is not None:
+            self.button.close()
+            self.button = None
         if self.live_config['GPIO']['enableGPIO']:
             if self.live_config['GPIO']['button'] >= 1:
                 self.button = Button(f'BOARD{self.live_config["GPIO"]["button"]}', bounce_time = 0.1)
-                self.button.when_pressed = self.take_photo
+                self.button.when_pressed = self.button_pressed
                 self.current_button = self.live_config["GPIO"]["button"]
                 
     def setled(self):
+        if getattr(self, 'led', None) is not None:
+            self.led.close()
+            self.led = None
         if self.live_config['GPIO']['enableGPIO']:
             if self.live_config['GPIO']['led'] >= 1:
                 self.led = LED(f'BOARD{self.live_config["GPIO"]["led"]}')
@@ -624,53 +3727,184 @@ class CameraObject:
         sorted_resolutions = sorted(unique_resolutions, key=lambda x: (x[0] * x[1], x))
         return sorted_resolutions
 
-    def take_photo(self):
-        """Take a photo with the camera"""
+    def take_photo(self, timeout=10.0):
+        """Take a full resolution photo through the session's still queue, the stream keeps running"""
+        # Only queueing runs on the actor, waiting for the still does not hold up other commands
+        queued = self.queue_photo()
+        if queued is None:
+            return None
+        still, filepath, raw_path = queued
+        try:
+            filepath = still.result(timeout=timeout)
+            self.catalog_files(filepath, raw_path)
+            capture_log.info(f"Photo captured successfully: {filepath}")
+            return filepath
+        except Exception as e:
+            capture_log.exception(f"Error capturing photo: {e}")
+            return None
+
+    @camera_command(timeout=10.0)
+    def queue_photo(self):
+        """Queue a still on the running pipeline, returns (future, path, raw path) or None"""
         try:
-            # Initialize camera on demand
-            camera = self.init_camera()
-            if not camera:
-                print("DEBUG: Failed to initialize camera for photo capture")
+            if not self.start_streaming():
+                capture_log.warning("Capture pipeline is not running, no photo taken")
                 return None
-                
-            # Configure camera
-            self.configure_camera()
             
             # Create output directory if it doesn't exist
             os.makedirs(UPLOAD_FOLDER, exist_ok=True)
             
-            # Generate filename
+            # Milliseconds keep photos taken within the same second apart
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+            filepath = os.path.join(UPLOAD_FOLDER, f"pimage_cam_{self.camera_info['Num']}_{timestamp}.jpg")
+            
+            # Full sensor resolution through a one-frame mode switch, plus a DNG when makeRaw is set
+            raw_path = filepath.replace('.jpg', '.dng') if self.live_config.get('capture-settings', {}).get('makeRaw') else None
+            return self.session.capture_still(filepath, mode='still', raw_path=raw_path), filepath, raw_path
+        except queue.Full:
+            capture_log.warning("Still capture queue is full, photo skipped")
+            return None
+        except Exception as e:
+            capture_log.warning(f"Error queueing photo: {e}")
+            return None
+
+    def capture_burst(self, count, interval=0.0, wait=False):
+        """Capture count frames from the running pipeline, DNGs too when makeRaw is set.
+
+        Returns the burst statistics, with wait=True only after every file is written.
+        """
+        # The burst grabs frames on its own thread, the actor is free again as soon as it started
+        burst = self.start_burst(count, interval)
+        if burst is None:
+            return None
+        try:
+            stats = burst.wait() if wait else burst.stats()
+            capture_log.info(f"Burst of {stats['frames']} frames at {stats['fps']} FPS, {stats['dropped']} dropped, backlog {stats['backlog']}")
+            return stats
+        except Exception as e:
+            capture_log.exception(f"Error capturing burst: {e}")
+            return None
+
+    @camera_command(timeout=10.0)
+    def start_burst(self, count, interval=0.0):
+        """Start a burst on the running pipeline, returns it or None.
+
+        Returns while the burst is still grabbing frames on its own thread, so the
+        actor takes the next command straight away.
+        """
+        try:
+            if not self.start_streaming():
+                capture_log.warning("Capture pipeline is not running, no burst taken")
+                return None
+            
+            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filepath = os.path.join(UPLOAD_FOLDER, f"pimage_{timestamp}.jpg")
+            make_raw = bool(self.live_config.get('capture-settings', {}).get('makeRaw'))
+            return self.session.capture_burst(UPLOAD_FOLDER, f"pimage_burst_cam_{self.camera_info['Num']}_{timestamp}", count, interval, make_raw,
+                                              on_written=self.catalog_files)
+        except Exception as e:
+            capture_log.warning(f"Error starting burst: {e}")
+            return None
+
+    def catalog_files(self, *paths):
+        """Add freshly written gallery files of this camera to the media catalog, None entries are skipped"""
+        for path in paths:
+            if path:
+                media_catalog.add(os.path.basename(path), camera=self.camera_info.get('Num'))
+                thumbnail_cache.schedule(os.path.basename(path))
+                video_previews.schedule(os.path.basename(path))
+
+    def configure_pre_event(self):
+        """Apply the pre-event buffer length and RAM budget from the capture settings"""
+        capture_settings = self.live_config.get('capture-settings', {})
+        seconds = float(capture_settings.get("PreEventSeconds", 5))
+        max_bytes = int(float(capture_settings.get("PreEventBufferMB", 32)) * 1024 * 1024)
+        self.session.pre_event.configure(seconds, max_bytes)
+
+    @camera_command()
+    def trigger_event(self, post_seconds=None, still=False):
+        """Save the pre-event buffer plus post-roll as an event clip without restarting capture.
+
+        With still=True the frame that was live at the trigger is also saved as a photo.
+        Returns a dict with the clip (and photo) file names, or None if nothing runs.
+        """
+        try:
+            if not self.start_streaming():
+                return None
+            if post_seconds is None:
+                post_seconds = float(self.live_config.get('capture-settings', {}).get("PostEventSeconds", 5))
+            
+            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+            # Milliseconds keep two triggers within the same second from sharing a clip or photo
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+            camera_num = self.camera_info['Num']
+            result = {}
             
-            # Capture image
-            camera.capture_file(filepath)
+            if still:
+                latest = self.session.pre_event.latest()
+                if latest:
+                    filename = f"pimage_cam_{camera_num}_{timestamp}.jpg"
+                    with open(os.path.join(UPLOAD_FOLDER, filename), 'wb') as file:
+                        file.write(latest[0])
+                    self.catalog_files(filename)
+                    result['image'] = filename
             
-            # Release camera
-            self.release_camera()
+            filename = f"event_cam_{camera_num}_{timestamp}.mjpeg"
+            pts_path = os.path.join(UPLOAD_FOLDER, f"event_cam_{camera_num}_{timestamp}_timestamps.txt")
             
-            print(f"DEBUG: Photo captured successfully: {filepath}")
-            return filepath
+            def clip_closed(path):
+                self.catalog_files(path)
+                media_retention.release(path, pts_path)
+            
+            media_retention.hold(filename, pts_path)
+            clip = self.session.trigger_event(os.path.join(UPLOAD_FOLDER, filename), pts_path, post_seconds,
+                                              on_close=clip_closed)
+            if not clip:
+                recording_log.warning(f"Event trigger failed on camera {camera_num}")
+                media_retention.release(filename, pts_path)
+                return None
+            result['clip'] = filename
+            result['pre_roll_frames'] = clip.preroll_frames
+            result['post_seconds'] = post_seconds
+            return result
         except Exception as e:
-            print(f"DEBUG: Error capturing photo: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
-            # Make sure to release camera on error
-            self.release_camera()
+            recording_log.exception(f"Error in trigger_event: {e}")
             return None
 
+    def button_pressed(self):
+        """GPIO button handler, the photo is the frame that was live when the button went down"""
+        capture_log.info(f"Button pressed on camera {self.camera_info['Num']}")
+        # Posted without waiting, the GPIO callback thread must not block
+        try:
+            self.actor.submit(self.trigger_event, still=True)
+        except CameraBusy as e:
+            capture_log.warning(f"Button press dropped: {e}")
+
+    def ensure_streaming(self, timeout=5.0):
+        """Make sure the pipeline runs for a new viewer or snapshot.
+
+        A running pipeline is used as it is, without a trip through the actor, so
+        viewers never queue behind a photo or a recording stop. Only a stopped
+        pipeline is started, waiting at most timeout seconds for the actor.
+        """
+        if self.session.is_alive():
+            return True
+        try:
+            return self.actor.call(CameraObject.start_streaming.__wrapped__, (self,), timeout=timeout)
+        except CameraBusy as e:
+            stream_log.warning(f"Could not start the stream: {e}")
+            return False
+
+    @camera_command(busy=False)
     def start_streaming(self):
-        """Start streaming from the camera"""
+        """Start streaming from the camera, the running session is only restarted if its settings changed"""
         try:
-            print("DEBUG: Starting streaming process")
-            
-            # Create a new streaming output
-            self.output = StreamingOutput()
+            stream_log.debug("Starting streaming process")
             
             # Get settings from camera
             encoder = self.live_config.get('capture-settings', {}).get("Encoder", "MJPEGEncoder")
             frame_rate = self.live_config.get('capture-settings', {}).get("FrameRate", 60)
-            print(f"DEBUG: Using encoder: {encoder}, frame rate: {frame_rate}")
+            stream_log.debug(f"Using encoder: {encoder}, frame rate: {frame_rate}")
             
             # Get current resolution
             selected_resolution = self.live_config.get('capture-settings', {}).get("Resolution", "1456x1088")
@@ -679,84 +3913,52 @@ class CameraObject:
                 width, height = resolution
             else:
                 # Default resolution if not found
-                print(f"DEBUG: Resolution '{selected_resolution}' not found in output_resolutions, using default")
+                stream_log.debug(f"Resolution '{selected_resolution}' not found in output_resolutions, using default")
                 width, height = 1456, 1088
                 
-            print(f"DEBUG: Using resolution: {width}x{height}")
+            stream_log.debug(f"Using resolution: {width}x{height}")
             
             # Get rotation settings
             hflip = self.live_config.get('rotation', {}).get('hflip', 0) == 1
             vflip = self.live_config.get('rotation', {}).get('vflip', 0) == 1
-            print(f"DEBUG: Rotation settings - hflip: {hflip}, vflip: {vflip}")
-            
-            # Stop any existing streaming process
-            if self.streaming_process and self.streaming_process.is_alive():
-                print("DEBUG: Stopping existing streaming process")
-                self.streaming_process.stop()
-                time.sleep(0.5)  # Give process time to fully stop
+            stream_log.debug(f"Rotation settings - hflip: {hflip}, vflip: {vflip}")
             
-            # Create a new streaming process
-            print("DEBUG: Creating new streaming process")
-            # Use camera_info["Num"] instead of camera_num
-            camera_number = self.camera_info.get("Num", 0)
-            print(f"DEBUG: Using camera number: {camera_number}")
-            self.streaming_process = LibcameraProcess(camera_number, self.output)
-            
-            # Start the streaming process
-            success = self.streaming_process.start(
+            backend = self.pipeline_backend()
+            success = self.session.start(
                 width=width,
                 height=height,
                 fps=frame_rate,
-                codec="mjpeg",
-                quality=90,
                 hflip=hflip,
                 vflip=vflip,
-                # Don't add any additional arguments that might conflict
-                additional_args=None
+                quality=90,
+                backend=backend,
+                sensor_mode=self.selected_sensor_mode(),
+                controls=self.live_config.get('controls', {})
             )
             
             if success:
-                print(f"DEBUG: Successfully started stream with libcamera-vid at {frame_rate} FPS")
+                stream_log.debug(f"Stream running with {backend} at {frame_rate} FPS")
+                self.control_engine.sync()
                 return True
             else:
-                print("DEBUG: Failed to start streaming process")
+                stream_log.warning("Failed to start streaming process")
                 return False
                 
         except Exception as e:
-            print(f"DEBUG: Error in start_streaming: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+            stream_log.exception(f"Error in start_streaming: {e}")
             return False
 
+    @camera_command(busy=False)
     def stop_streaming(self):
-        """Stop streaming and release all resources"""
-        print("DEBUG: Stopping streaming process")
+        """Stop this camera's capture session, other cameras are not touched"""
+        stream_log.info("Stopping streaming process")
         
         try:
-            # Stop the streaming process
-            if self.streaming_process:
-                print("DEBUG: Stopping libcamera process")
-                self.streaming_process.stop()
-                self.streaming_process = None
-            
-            # Clear the output handler
-            if hasattr(self, 'output'):
-                print("DEBUG: Clearing output handler")
-                self.output = None
-                
-            # Make sure to kill any lingering libcamera processes
-            try:
-                print("DEBUG: Killing any lingering libcamera processes")
-                subprocess.run(["pkill", "-f", "libcamera-vid"], stderr=subprocess.DEVNULL)
-            except Exception as e:
-                print(f"DEBUG: Error killing processes: {e}")
-                
-            print("DEBUG: Streaming stopped successfully")
+            self.session.stop()
+            stream_log.info("Streaming stopped successfully")
             return True
         except Exception as e:
-            print(f"DEBUG: Error in stop_streaming: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+            stream_log.exception(f"Error in stop_streaming: {e}")
             return False
 
     def load_settings_from_file(self, config_location):
@@ -771,22 +3973,18 @@ class CameraObject:
             json.dump(self.settings, file)
 
     def configure_camera(self):
+        """Send the controls the running pipeline has not applied yet, they take effect on the next frame"""
         try:
-            # Attempt to set the controls
-            self.camera.set_controls(self.live_config['controls'])
-            print('\nControls set successfully.\n')
-            
-            # Adding a small sleep to ensure operations are completed
-            time.sleep(0.5)
+            if self.control_engine.sync() is None:
+                stream_log.info(f"Controls pending until the pipeline restarts: {self.control_engine.pending()}")
         except Exception as e:
-            # Log the exception
-            logging.error("An error occurred while configuring the camera: %s", str(e))
-            print(f"\nAn error occurred: {str(e)}\n")
+            capture_log.error(f"An error occurred while configuring the camera: {e}")
     
     def file_exists(self, file_name, file_path):
         file = os.path.join(file_path ,file_name)
         return os.path.exists(file)
 
+    @camera_command()
     def default_camera_settings(self):
         """Create default camera settings"""
         # Default capture settings
@@ -795,7 +3993,15 @@ class CameraObject:
             "makeRaw": False,
             "Resolution": "0",  # Default resolution index
             "Encoder": "MJPEGEncoder",
-            "FrameRate": 60
+            "FrameRate": 60,
+            "Bitrate": 10000000,     # H.264 recording bitrate in bits/s
+            "GOP": 60,               # H.264 keyframe interval in frames
+            "H264Profile": "high",
+            "PreEventSeconds": 5,    # Seconds of frames kept in RAM before a trigger
+            "PreEventBufferMB": 32,  # RAM budget of the pre-event buffer
+            "PostEventSeconds": 5,   # Seconds recorded after a trigger
+            "SegmentSeconds": 300,   # Recordings roll over to a new file after this long (0 = off)
+            "SegmentMB": 0           # ... or once a segment reaches this size (0 = off)
         }
         
         # Default rotation settings
@@ -844,23 +4050,21 @@ class CameraObject:
         
         return self.live_config
 
+    @camera_command()
     def config_from_file(self, file):
         newconfig = self.load_settings_from_file(file)
-        print(f"\Setting New Config:\n {newconfig}\n")
+        capture_log.info(f"Setting new config: {newconfig}")
         self.live_config = newconfig
-        self.stop_streaming()
         self.live_config['capture-settings']['Encoder'] = self.live_config['capture-settings'].get("Encoder", "MJPEGEncoder")
-        selected_resolution = self.live_config['capture-settings']['Resolution']
-        resolution = self.output_resolutions[selected_resolution]
-        mode = self.camera.sensor_modes[self.live_config['sensor-mode']]
-        print(f'\nSensor Mode Config:\n{mode}\n')
-        self.video_config = self.camera.create_video_configuration(main={'size':resolution}, sensor={'output_size': mode['size'], 'bit_depth': mode['bit_depth']})
-        self.apply_rotation(self.live_config['rotation'])
+        # Resolution, sensor mode and rotation are applied by start_streaming from the cached configurations
+        self.sensor_mode_selected = True
+        capture_log.debug(f"Sensor mode config: {self.selected_sensor_mode()}")
         self.camera_info['Has_Config'] = True
         self.camera_info['Config_Location'] = file
         self.update_camera_last_config()
         self.setbutton()
         self.setled()
+        self.configure_pre_event()
         self.start_streaming()
         self.configure_camera()
 
@@ -873,8 +4077,9 @@ class CameraObject:
         with open(os.path.join(current_dir, 'camera-last-config.json'), 'w') as file:
             json.dump(camera_last_config, file, indent=4)
 
+    @camera_command()
     def save_live_config(self, file):
-        print(f'\Saving Live Config:\n{file}\n')
+        capture_log.info(f"Saving live config: {file}")
         self.live_config['Model'] = self.camera_info['Model']
         self.camera_info['Has_Config'] = True
         
@@ -889,394 +4094,426 @@ class CameraObject:
             self.update_camera_last_config()
             return file  # Return the filename on success
         except Exception as e:
-            print(f'\nAn error occurred:\n{e}\n')
+            capture_log.error(f"Could not save live config {file}: {e}")
             return None  # Return None or raise an exception on failure
 
+    @camera_command(busy=(False, {'error': 'Camera busy'}))
     def update_live_config(self, data):
+        """Apply all settings in data as one transition, returns (success, changed settings or error)"""
         try:
-            # Initialize default return values
-            success = False
-            settings = {}
-            
-            # Update only the keys that are present in the data
-            for key in data:
-                if key in self.live_config['controls']:
-                    try:
-                        if key in ('AfMode', 'AeConstraintMode', 'AeExposureMode', 'AeFlickerMode', 'AeFlickerPeriod', 'AeMeteringMode', 'AfRange', 'AfSpeed', 'AwbMode', 'ExposureTime'):
-                            self.live_config['controls'][key] = int(data[key])
-                        elif key in ('Brightness', 'Contrast', 'Saturation', 'Sharpness', 'ExposureValue', 'LensPosition', 'AnalogueGain'):
-                            self.live_config['controls'][key] = float(data[key])
-                        elif key in ('AeEnable', 'AwbEnable', 'ScalerCrop'):
-                            self.live_config['controls'][key] = data[key]
-                        
-                        success = True
-                        settings = self.live_config['controls']
-                        print(f'\nUpdated live setting:\n{settings}\n')
-                        return success, settings
-                    except Exception as e:
-                        logging.error(f"Error updating control setting: {e}")
-                        return False, {'error': str(e)}
-                        
-                elif key in self.live_config['capture-settings']:
-                    try:
-                        if key == 'Resolution':
-                            self.live_config['capture-settings']['Resolution'] = int(data[key])
-                            selected_resolution = int(data[key])
-                            resolution = self.output_resolutions[selected_resolution]
-                            mode = self.camera.sensor_modes[self.sensor_mode]
-                            self.stop_streaming()
-                            self.video_config = self.camera.create_video_configuration(main={'size':resolution}, sensor={'output_size': mode['size'], 'bit_depth': mode['bit_depth']})
-                            self.camera.configure(self.video_config)
-                            self.apply_rotation(self.live_config['rotation'])
-                            self.start_streaming()
-                        elif key == 'makeRaw':
-                            self.live_config['capture-settings'][key] = data[key]
-                        elif key == 'Encoder':
-                            self.live_config['capture-settings'][key] = data[key]
-                            self.stop_streaming()
-                            time.sleep(1)
-                            self.start_streaming()
-                        
-                        success = True
-                        settings = self.live_config['capture-settings']
-                        return success, settings
-                    except Exception as e:
-                        logging.error(f"Error updating capture setting: {e}")
-                        return False, {'error': str(e)}
-                        
-                elif key in self.live_config['GPIO']:
-                    try:
-                        if key == 'button':
-                            self.live_config['GPIO'][key] = int(data[key])
-                            self.setbutton()
-                        elif key == 'led':
-                            self.live_config['GPIO'][key] = int(data[key])
-                            self.setled()
-                        elif key == 'enableGPIO':
-                            self.live_config['GPIO'][key] = data[key]
-                        
-                        success = True
-                        settings = self.live_config['GPIO']
-                        return success, settings
-                    except Exception as e:
-                        logging.error(f"Error updating GPIO setting: {e}")
-                        return False, {'error': str(e)}
-                        
-                elif key == 'sensor-mode':
-                    try:
-                        self.sensor_mode = sensor_mode = int(data[key])
-                        selected_resolution = self.live_config['capture-settings']['Resolution']
-                        resolution = self.output_resolutions[selected_resolution]
-                        mode = self.camera.sensor_modes[self.sensor_mode]
-                        self.live_config['sensor-mode'] = int(data[key])
-                        self.stop_streaming()
-                        
-                        try:
-                            self.video_config = self.camera.create_video_configuration(main={'size':resolution}, sensor={'output_size': mode['size'], 'bit_depth': mode['bit_depth']})
-                            self.apply_rotation(self.live_config['rotation'])
-                        except Exception as e:
-                            logging.error("An error occurred while configuring the camera: %s", str(e))
-                            print(f"\nAn error occurred:\n{str(e)}\n")
-                            return False, {'error': str(e)}
-                            
-                        self.camera.configure(self.video_config)
-                        print(f'\nVideo Config:\n{self.video_config}\n')
-                        self.start_streaming()
-                        success = True
-                        settings = self.live_config['sensor-mode']
-                        return success, settings
-                    except Exception as e:
-                        logging.error(f"Error updating sensor mode: {e}")
-                        return False, {'error': str(e)}
-            
-            # If no matching key was found
-            return False, {'error': 'No valid settings were updated'}
-            
+            transition, applied = self.control_engine.apply(data)
+            if not transition.changed():
+                return False, {'error': 'No valid settings were updated'}
+            capture_log.info(f"Updated live settings: {transition.changed()}")
+            return True, transition.changed()
+        except (TypeError, ValueError) as e:
+            capture_log.warning(f"Error updating settings: {e}")
+            return False, {'error': str(e)}
         except Exception as e:
-            logging.error(f"Error in update_live_config: {e}")
+            capture_log.exception(f"Error in update_live_config: {e}")
             return False, {'error': str(e)}
 
+    @camera_command(busy=(False, {'error': 'Camera busy'}))
     def apply_rotation(self,data):
-        self.stop_streaming()
-        transform = Transform()
-        # Update settings that require a restart
-        for key, value in data.items():
-            if key in self.live_config['rotation']:
-                if key in ('hflip', 'vflip'):
-                    self.live_config['rotation'][key] = data[key]
-                    setattr(transform, key, value) 
-            self.video_config['transform'] = transform 
-            self.camera.configure(self.video_config)
-            time.sleep(0.5)
-        self.start_streaming()
+        # Rotation needs a restart, the session picks the cached configuration for the new transform
+        self.control_engine.apply({key: value for key, value in data.items() if key in ('hflip', 'vflip')})
         success = True
         settings = self.live_config['rotation']
         return success, settings
 
-    def take_snapshot(self,camera_num):
-        try:
-            image_name = f'snapshot/pimage_snapshot_{camera_num}'
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], image_name)
-            request = self.camera.capture_request()
-            request.save("main", f'{filepath}.jpg')
-            logging.info(f"Image captured successfully. Path: {filepath}")
-            return f'{filepath}.jpg'
-        except Exception as e:
-            logging.error(f"Error capturing image: {e}")
+    def take_snapshot(self, fresh=False, timeout=2.0):
+        """Newest frame of the live stream as (sequence, timestamp, jpeg bytes), or None"""
+        if not self.ensure_streaming():
+            return None
+        return self.session.output.capture_frame(fresh=fresh, timeout=timeout)
         
-    def take_preview(self,camera_num):
+    def take_preview(self, camera_num):
+        """Save the newest live frame as the home page preview of this camera"""
         try:
-            image_name = f'snapshot/pimage_preview_{camera_num}'
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], image_name)
-            request = self.camera.capture_request()
-            request.save("main", f'{filepath}.jpg')
+            frame = self.take_snapshot()
+            if frame is None:
+                return None
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f'snapshot/pimage_preview_{camera_num}.jpg')
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            # Replace atomically so concurrent callers never serve a half written file
+            temp_path = f'{filepath}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as file:
+                file.write(frame[2])
+            os.replace(temp_path, filepath)
             logging.info(f"Image captured successfully. Path: {filepath}")
-            return f'{filepath}.jpg'
+            return filepath
         except Exception as e:
             logging.error(f"Error capturing image: {e}")
 
+    @camera_command(busy=(False, 'Camera busy'))
     def start_recording_video(self):
-        """Start recording video using libcamera-vid"""
-        if self.recording and self.recording_process and self.recording_process.is_alive():
-            print("DEBUG: Already recording")
+        """Start a segmented recording from the running capture session, the live stream keeps running"""
+        if self.is_recording():
+            recording_log.warning("Already recording")
             return False, "Already recording"
         
         try:
             # Clean up any stale state
             self.recording = False
-            if self.recording_process:
-                try:
-                    self.recording_process.stop()
-                except:
-                    pass
-            self.recording_process = None
-            self.video_path = None
+            self.segments = None
             
-            # Create a unique filename with timestamp
-            timestamp = int(datetime.timestamp(datetime.now()))
-            video_name = f'video_cam_{self.camera_info["Num"]}_{timestamp}.mp4'
-            self.video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_name)
-            
-            print(f"DEBUG: Recording to file: {self.video_path}")
+            # Recording tees off the live pipeline, make sure it runs with the current settings
+            if not self.start_streaming():
+                return False, "Capture pipeline is not running"
             
-            # Get current resolution
-            selected_resolution = self.live_config['capture-settings']["Resolution"]
-            resolution = self.output_resolutions[selected_resolution]
-            width, height = resolution
+            # libcamera-vid gives MJPEG frames, the Picamera2 pipeline an H.264 elementary stream
+            extension = 'h264' if self.pipeline_backend() == 'picamera2' else 'mjpeg'
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
             
-            # Get rotation settings
-            hflip = self.live_config['rotation'].get('hflip', 0) == 1
-            vflip = self.live_config['rotation'].get('vflip', 0) == 1
+            # Segments are named <stem>_0001.<extension>, <stem>_0002.<extension>, ...
+            timestamp = int(datetime.timestamp(datetime.now()))
+            capture_settings = self.live_config.get('capture-settings', {})
+            segments = RecordingSegments(app.config['UPLOAD_FOLDER'], f'video_cam_{self.camera_info["Num"]}_{timestamp}', extension,
+                                         segment_seconds=float(capture_settings.get('SegmentSeconds', 300)),
+                                         segment_bytes=int(float(capture_settings.get('SegmentMB', 0)) * 1024 * 1024),
+                                         on_open=media_retention.hold, on_segment=self.segment_closed)
+            encoder_options = {
+                'bitrate': int(capture_settings.get('Bitrate', 10000000)),
+                'gop': int(capture_settings.get('GOP', 60)),
+                'profile': capture_settings.get('H264Profile', 'high')
+            }
             
-            # Create a new recording process
-            self.recording_process = LibcameraProcess(self.camera_info["Num"])
+            # Have the janitor check the free space now, not at its next pass
+            media_retention.wake.set()
+            if self.session.start_recording(segments, **encoder_options):
+                self.recording = True
+                self.segments = segments
+                self.recording_started = time.time()
+                recording_log.info(f"Started recording {segments.stem}, manifest {segments.manifest_path}")
+                return True, os.path.basename(segments.manifest_path)
             
-            # Start the recording process with MJPEG output to file
-            success = self.recording_process.start(
-                width=width,
-                height=height,
-                fps=frame_rate,
-                output=self.video_path,
-                codec="mjpeg",
-                quality=90,  # Adjust quality as needed
-                hflip=hflip,
-                vflip=vflip,
-                additional_args=[
-                    "--segment", "0",  # Disable segmentation for recording
-                    "--save-pts", "timestamps.txt"  # Save timestamps for debugging
-                ]
-            )
-            
-            if success:
-                # Verify the process is running
-                time.sleep(0.5)  # Give it a moment to start
-                if self.recording_process.is_alive():
-                    # Only set recording flag if process started successfully
-                    self.recording = True
-                    print(f"DEBUG: Started recording to {self.video_path}")
-                    return True, video_name
-                else:
-                    print(f"DEBUG: Recording process started but died immediately")
-                    self.recording_process = None
-                    self.video_path = None
-                    return False, "Recording process failed to start properly"
-            else:
-                print(f"DEBUG: Failed to start recording process")
-                # Clean up on failure
-                self.recording_process = None
-                self.video_path = None
-                return False, "Failed to start recording process"
+            recording_log.warning("Failed to start recording")
+            return False, "Failed to start recording"
                 
         except Exception as e:
-            print(f"DEBUG: Error starting video recording: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+            recording_log.exception(f"Error starting video recording: {e}")
             # Clean up on error
             self.recording = False
-            self.recording_process = None
-            self.video_path = None
+            self.segments = None
             return False, str(e)
 
+    def segment_closed(self, segments, segment, path, pts_path):
+        """Called on the writer thread when a segment is complete, the rest happens on the segment pool"""
+        self.segment_pool.submit(self.finish_segment, segments, segment, path, pts_path)
+
+    def finish_segment(self, segments, segment, path, pts_path):
+        """Mux an H.264 segment, catalog it and mark it ready in the manifest"""
+        try:
+            final_path = self.mux_recording(path, pts_path) if path.endswith('.h264') else path
+            self.catalog_files(final_path)
+            segments.segment_done(segment, os.path.basename(final_path))
+            recording_log.info(f"Segment {os.path.basename(final_path)} ready, {segment['frames']} frames, {segment['duration']}s")
+        except Exception as e:
+            recording_log.warning(f"Error finishing segment {path}: {e}")
+        finally:
+            media_retention.release(path, pts_path)
+
     def stop_recording_video(self):
+        stopped, message, segments = self.end_recording()
+        if not stopped or segments is None:
+            return stopped, message
         try:
-            print(f"DEBUG: stop_recording_video called - Current state: recording={self.recording}, process={self.recording_process is not None}")
-            
-            # Always attempt to stop any recording process, even if state is inconsistent
-            video_path = self.video_path  # Store path before clearing
-            process_stopped = False
+            # The pool runs in order, once this returns every segment is muxed and cataloged.
+            # The wait happens here, the actor takes other commands while the last segment is muxed.
+            self.segment_pool.submit(lambda: None).result()
+            self.last_recording = segments
+            files = segments.files()
+            if not files:
+                recording_log.warning(f"Recording {segments.stem} produced no frames")
+                return False, "Recording file not found"
             
-            # Try to stop the recording process if it exists
-            if self.recording_process is not None:
-                print("DEBUG: Stopping recording process")
-                try:
-                    self.recording_process.stop()
-                    process_stopped = True
-                    # Give the filesystem a moment to finalize the file
-                    time.sleep(0.5)
-                except Exception as e:
-                    print(f"DEBUG: Error stopping recording process: {e}")
-                finally:
-                    self.recording_process = None
+            recording_log.info(f"Recording saved in {len(files)} segments, {segments.bytes_written()} bytes")
+            return True, os.path.join(app.config['UPLOAD_FOLDER'], files[-1])
+        except Exception as e:
+            recording_log.error(f"Error finishing video recording: {e}")
+            return False, str(e)
+
+    @camera_command(busy=(False, 'Camera busy', None))
+    def end_recording(self):
+        """Stop the recording, returns (stopped, message, segments), the last segment may still be muxing"""
+        try:
+            recording_log.debug(f"stop_recording_video called - Current state: recording={self.recording}")
+            segments = self.segments
             
-            # Reset recording state
+            # Stopping the tee or encoder flushes and closes the last segment before it returns
+            process_stopped = self.session.stop_recording()
             self.recording = False
+            self.segments = None
+            self.recording_started = None
             
-            # If we don't have a video path but we stopped a process, consider it a success
-            if video_path is None and process_stopped:
-                print("DEBUG: Recording process stopped, but no video path was set")
-                self.video_path = None
-                return True, "Recording stopped (no file produced)"
-            
-            # If we have a video path, check if the file exists
-            if video_path:
-                print(f"DEBUG: Checking for video file at: {video_path}")
-                
-                # Wait for the file to be fully written (up to 5 seconds)
-                max_retries = 10
-                retry_delay = 0.5
-                file_exists = False
-                file_size = 0
-                
-                for attempt in range(max_retries):
-                    if os.path.exists(video_path):
-                        file_exists = True
-                        file_size = os.path.getsize(video_path)
-                        print(f"DEBUG: Found file, size: {file_size} bytes (attempt {attempt + 1})")
-                        
-                        # If file has content, we can consider it valid
-                        if file_size > 0:
-                            # Wait a bit more to ensure it's fully written
-                            time.sleep(retry_delay)
-                            # Check if size is stable
-                            new_size = os.path.getsize(video_path)
-                            if new_size == file_size:
-                                print(f"DEBUG: File size is stable at {file_size} bytes")
-                                self.video_path = None
-                                return True, video_path
-                            else:
-                                print(f"DEBUG: File size changed from {file_size} to {new_size} bytes")
-                                file_size = new_size
-                    else:
-                        print(f"DEBUG: File not found (attempt {attempt + 1})")
-                    
-                    time.sleep(retry_delay)
-                
-                # If we get here, we couldn't find a stable file
-                error_msg = "Recording file not found" if not file_exists else f"File exists but may be incomplete (size: {file_size} bytes)"
-                print(f"DEBUG: {error_msg}")
-                
-                # If the file exists but is small, we'll still return it
-                if file_exists and file_size > 0:
-                    print(f"DEBUG: Returning potentially incomplete file")
-                    self.video_path = None
-                    return True, video_path
-                
-                self.video_path = None
-                return False, error_msg
-            
-            # If we get here, we weren't recording and didn't stop anything
             if not process_stopped:
-                print("DEBUG: Not recording - no process was stopped")
-                return False, "Not recording"
+                recording_log.info("Not recording - nothing was stopped")
+                return False, "Not recording", None
             
-            # Default case - we stopped something but don't have a file
-            return True, "Recording stopped"
-                
+            if segments is None:
+                return True, "Recording stopped (no file produced)", None
+            return True, "Recording stopped", segments
         except Exception as e:
-            print(f"DEBUG: Error stopping video recording: {e}")
-            import traceback
-            print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+            recording_log.exception(f"Error stopping video recording: {e}")
             # Make sure to clean up state even on error
             self.recording = False
-            self.recording_process = None
-            self.video_path = None
-            return False, str(e)
+            self.segments = None
+            self.recording_started = None
+            return False, str(e), None
+
+    def mux_recording(self, h264_path, pts_path):
+        """Mux a finished H.264 recording into a fragmented MP4 using its saved timestamps"""
+        params = self.session.params or {}
+        width = params.get('width', 1456)
+        height = params.get('height', 1088)
+        mp4_path = os.path.splitext(h264_path)[0] + '.mp4'
+        try:
+            frames = mux_h264_to_fmp4(h264_path, mp4_path, width, height, pts_path,
+                                      fps=params.get('fps', 30))
+            os.remove(h264_path)
+            recording_log.info(f"Muxed {frames} frames into {mp4_path}")
+            return mp4_path
+        except Exception as e:
+            # Keep the elementary stream, it is still playable and can be muxed later
+            recording_log.warning(f"Error muxing {h264_path}: {e}")
+            if os.path.exists(mp4_path):
+                os.remove(mp4_path)
+            return h264_path
 
     def is_recording(self):
         """Check if the camera is recording"""
-        return self.recording and self.recording_process is not None and self.recording_process.is_alive()
+        return self.recording and self.session.is_recording()
+
+    def recording_rate(self):
+        """Bytes per second written by the running recording so far, 0 when not recording"""
+        segments = self.segments
+        if not self.is_recording() or segments is None or not self.recording_started:
+            return 0
+        return segments.bytes_written() / max(1.0, time.time() - self.recording_started)
 
 # Init dictionary to store camera instances
 cameras = {}
 camera_new_config = {'cameras': []}
-print(f'\nDetected Cameras:\n{global_cameras}\n')
-
-# Iterate over each camera in the global_cameras list
-for camera_info in global_cameras:
-    # Flag to check if a matching camera is found in the last config
-    matching_camera_found = False
-    print(f'\nCamera Info:\n{camera_info}\n')
-
-    # Get the number of the camera in the global_cameras list
-    camera_num = camera_info['Num']
-
-    # Check against last known config
-    for camera_info_last in camera_last_config['cameras']:
-        if (camera_info['Num'] == camera_info_last['Num'] and camera_info['Model'] == camera_info_last['Model']):
-            print(f"\nDetected camera:\n{camera_info['Num']}: {camera_info['Model']} matched last used in config.\n")
-            camera_new_config['cameras'].append(camera_info_last)
-            matching_camera_found = True
-            camera_info['Config_Location'] = camera_new_config['cameras'][camera_num]['Config_Location']
-            camera_info['Has_Config'] = camera_new_config['cameras'][camera_num]['Has_Config']
-            camera_obj = CameraObject(camera_num, camera_info)
-            camera_obj.start_streaming()
-            cameras[camera_num] = camera_obj
-            break
-    
-    # If no matching camera found, check if it's a known Pi camera module
-    if not matching_camera_found:
-        is_pi_cam = False
-        for camera_modules in camera_module_info['camera_modules']:
-            if (camera_info['Model'] == camera_modules['sensor_model']):
-                is_pi_cam = True
-                print("\nCamera config has changed since last boot - Adding new Camera\n")
-                add_camera_config = {'Num':camera_info['Num'], 'Model':camera_info['Model'], 'Is_Pi_Cam': is_pi_cam, 'Has_Config': False, 'Config_Location': f"default_{camera_info['Model']}.json"}
-                camera_new_config['cameras'].append(add_camera_config)
+
+def camera_status(camera):
+    """Frame rate, latency, resolution and recording state of a camera, as get_fps and /events report it"""
+    state = camera.state()
+    capture_settings = state.live_config.get('capture-settings', {})
+    width, height = camera.output_resolutions.get(capture_settings.get("Resolution", "0"), (1456, 1088))
+    output = camera.output
+    return {
+        'fps': output.get_current_fps() if output else 0.0,
+        'target_fps': capture_settings.get("FrameRate", 30),
+        'width': width,
+        'height': height,
+        'latency': output.get_current_latency() if output else 0.0,
+        'recording': state.recording
+    }
+
+class StatusEvents:
+    """Server-sent status for every open page, sampled once no matter how many pages listen.
+
+    One thread reads camera status, pipeline errors and storage usage at most
+    max_rate times per second while at least one client is connected (storage only
+    every storage_interval seconds, it walks the gallery). A topic only gets a new
+    version when its value changed. Each client sends the latest value of the topics
+    it has not seen and then sleeps for its own interval, so a slow client skips
+    intermediate states instead of queueing them.
+    """
+    def __init__(self, max_rate=2.0, storage_interval=10.0, keepalive=15.0):
+        self.max_rate = max_rate
+        self.storage_interval = storage_interval
+        self.keepalive = keepalive
+        self.topics = {}      # (event, key) -> (version, data)
+        self.version = 0
+        self.clients = 0
+        self.condition = threading.Condition()
+        self.wake = threading.Event()
+        self.last_storage = None
+        self.thread = None
+        self.async_waiters = set()   # (loop, asyncio.Event) of clients served by the ASGI mode
+
+    def publish(self, event, key, data):
+        """Store data under its topic and wake the clients, unchanged data is not sent again"""
+        with self.condition:
+            current = self.topics.get((event, key))
+            if current is not None and current[1] == data:
+                return False
+            self.version += 1
+            self.topics[(event, key)] = (self.version, data)
+            self.condition.notify_all()
+            waiters = list(self.async_waiters)
+        for loop, event_flag in waiters:
+            loop.call_soon_threadsafe(event_flag.set)
+        return True
+
+    def sample(self, now):
+        for camera_num, camera in list(cameras.items()):
+            try:
+                status = camera_status(camera)
+                status['fps'] = round(status['fps'], 1)
+                status['latency'] = round(status['latency'], 1)
+                self.publish('camera', camera_num, {'camera': camera_num, **status})
+                self.publish('pipeline_error', camera_num, {'camera': camera_num, 'message': camera.session.error()})
+            except Exception as e:
+                http_log.warning("Could not sample status of camera %s: %s", camera_num, e)
+        if self.last_storage is None or now - self.last_storage >= self.storage_interval:
+            self.last_storage = now
+            try:
+                bitrate = sum(camera.recording_rate() for camera in cameras.values())
+                self.publish('storage', None, media_retention.usage(bitrate))
+            except OSError as e:
+                http_log.warning("Could not sample storage usage: %s", e)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.clients > 0)
+            # Cleared before sampling so a change made during the sample is not lost
+            self.wake.clear()
+            self.sample(time.monotonic())
+            # The recording routes set wake so their change goes out right away
+            self.wake.wait(1.0 / self.max_rate)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _interval(self, rate):
+        return 1.0 / min(rate or self.max_rate, self.max_rate)
+
+    def _connect(self, change):
+        with self.condition:
+            self.clients += change
+            self.condition.notify_all()
+
+    def _updates(self, seen, camera_num):
+        """SSE text of the topics newer than seen, and the version to remember. Call with the condition held."""
+        chunks = [f"event: {event}\ndata: {json.dumps(data)}\n\n" for (event, key), (version, data) in self.topics.items()
+                  if version > seen and (camera_num is None or key in (None, camera_num))]
+        return ''.join(chunks), self.version
+
+    def stream(self, rate=None, camera_num=None):
+        """SSE body for one client, at most rate batches per second and only one camera if given"""
+        interval = self._interval(rate)
+        seen = 0
+        self._connect(1)
+        try:
+            # Browsers reconnect after this many milliseconds if the connection drops
+            yield f"retry: {int(interval * 1000) + 1000}\n\n"
+            while True:
+                with self.condition:
+                    if not self.condition.wait_for(lambda: self.version > seen, self.keepalive):
+                        text = None
+                    else:
+                        text, seen = self._updates(seen, camera_num)
+                if text is None:
+                    # A comment line, keeps proxies from closing the connection and finds dead clients
+                    yield ": keepalive\n\n"
+                    continue
+                if text:
+                    yield text
+                time.sleep(interval)
+        finally:
+            self._connect(-1)
+
+    async def astream(self, rate=None, camera_num=None):
+        """stream() for the ASGI mode, waits on an asyncio.Event instead of holding a thread"""
+        interval = self._interval(rate)
+        seen = 0
+        changed = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), changed)
+        with self.condition:
+            self.async_waiters.add(waiter)
+        self._connect(1)
+        try:
+            yield f"retry: {int(interval * 1000) + 1000}\n\n"
+            while True:
+                with self.condition:
+                    text, seen = self._updates(seen, camera_num) if self.version > seen else (None, seen)
+                if text is None:
+                    try:
+                        await asyncio.wait_for(changed.wait(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                    changed.clear()
+                    continue
+                if text:
+                    yield text
+                await asyncio.sleep(interval)
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+            self._connect(-1)
+
+status_events = StatusEvents()
+metrics.gauge('picamera_event_clients', 'Pages connected to the /events status stream', [],
+              lambda: [((), status_events.clients)])
+
+def init_cameras():
+    """Detect the connected cameras, match them against the last config and start streaming"""
+    global camera_last_config
+    print(f'\nDetected Cameras:\n{global_cameras}\n')
+
+    # Stop capture processes a previous run left behind before opening the cameras
+    capture_sessions.reap_stale()
+
+    # Iterate over each camera in the global_cameras list
+    for camera_info in global_cameras:
+        # Flag to check if a matching camera is found in the last config
+        matching_camera_found = False
+        print(f'\nCamera Info:\n{camera_info}\n')
+
+        # Get the number of the camera in the global_cameras list
+        camera_num = camera_info['Num']
+
+        # Check against last known config
+        for camera_info_last in camera_last_config['cameras']:
+            if (camera_info['Num'] == camera_info_last['Num'] and camera_info['Model'] == camera_info_last['Model']):
+                print(f"\nDetected camera:\n{camera_info['Num']}: {camera_info['Model']} matched last used in config.\n")
+                camera_new_config['cameras'].append(camera_info_last)
+                matching_camera_found = True
                 camera_info['Config_Location'] = camera_new_config['cameras'][camera_num]['Config_Location']
                 camera_info['Has_Config'] = camera_new_config['cameras'][camera_num]['Has_Config']
                 camera_obj = CameraObject(camera_num, camera_info)
                 camera_obj.start_streaming()
                 cameras[camera_num] = camera_obj
                 break
+    
+        # If no matching camera found, check if it's a known Pi camera module
+        if not matching_camera_found:
+            is_pi_cam = False
+            for camera_modules in camera_module_info['camera_modules']:
+                if (camera_info['Model'] == camera_modules['sensor_model']):
+                    is_pi_cam = True
+                    print("\nCamera config has changed since last boot - Adding new Camera\n")
+                    add_camera_config = {'Num':camera_info['Num'], 'Model':camera_info['Model'], 'Is_Pi_Cam': is_pi_cam, 'Has_Config': False, 'Config_Location': f"default_{camera_info['Model']}.json"}
+                    camera_new_config['cameras'].append(add_camera_config)
+                    camera_info['Config_Location'] = camera_new_config['cameras'][camera_num]['Config_Location']
+                    camera_info['Has_Config'] = camera_new_config['cameras'][camera_num]['Has_Config']
+                    camera_obj = CameraObject(camera_num, camera_info)
+                    camera_obj.start_streaming()
+                    cameras[camera_num] = camera_obj
+                    break
         
-        # If it's not a Pi camera or in the last config, add it anyway
-        if not is_pi_cam:
-            print("\nAdding a new unknown camera to the configuration\n")
-            add_camera_config = {'Num':camera_info['Num'], 'Model':camera_info['Model'], 'Is_Pi_Cam': False, 'Has_Config': False, 'Config_Location': f"default_{camera_info['Model']}.json"}
-            camera_new_config['cameras'].append(add_camera_config)
-            camera_info['Config_Location'] = add_camera_config['Config_Location']
-            camera_info['Has_Config'] = add_camera_config['Has_Config']
-            camera_obj = CameraObject(camera_num, camera_info)
-            camera_obj.start_streaming()
-            cameras[camera_num] = camera_obj
-
-# Print the new config for debug
-print(f'\nCurrent detected compatible Cameras:\n{camera_new_config}\n')
-# Write config to last config file for next reboot
-camera_last_config = camera_new_config
-with open(os.path.join(current_dir, 'camera-last-config.json'), 'w') as file:
-    json.dump(camera_last_config, file, indent=4)
+            # If it's not a Pi camera or in the last config, add it anyway
+            if not is_pi_cam:
+                print("\nAdding a new unknown camera to the configuration\n")
+                add_camera_config = {'Num':camera_info['Num'], 'Model':camera_info['Model'], 'Is_Pi_Cam': False, 'Has_Config': False, 'Config_Location': f"default_{camera_info['Model']}.json"}
+                camera_new_config['cameras'].append(add_camera_config)
+                camera_info['Config_Location'] = add_camera_config['Config_Location']
+                camera_info['Has_Config'] = add_camera_config['Has_Config']
+                camera_obj = CameraObject(camera_num, camera_info)
+                camera_obj.start_streaming()
+                cameras[camera_num] = camera_obj
 
+    # Print the new config for debug
+    print(f'\nCurrent detected compatible Cameras:\n{camera_new_config}\n')
+    # Write config to last config file for next reboot
+    camera_last_config = camera_new_config
+    with open(os.path.join(current_dir, 'camera-last-config.json'), 'w') as file:
+        json.dump(camera_last_config, file, indent=4)
 
 
 def get_camera_info(camera_model, camera_module_info):
@@ -1346,16 +4583,17 @@ def control_camera(camera_num):
         settings_from_camera = camera.settings or {}
         print(f"DEBUG: settings_from_camera keys: {list(settings_from_camera.keys()) if settings_from_camera else 'None'}")
         
-        # Get live settings
-        live_settings = camera.live_config.get('controls', {})
+        # Get live settings from the camera's latest state snapshot
+        live_config = camera.state().live_config
+        live_settings = live_config.get('controls', {})
         print(f"DEBUG: live_settings keys: {list(live_settings.keys()) if live_settings else 'None'}")
         
         # Get rotation settings
-        rotation_settings = camera.live_config.get('rotation', {})
+        rotation_settings = live_config.get('rotation', {})
         print(f"DEBUG: rotation_settings keys: {list(rotation_settings.keys()) if rotation_settings else 'None'}")
         
         # Get capture settings
-        capture_settings = camera.live_config.get('capture-settings', {})
+        capture_settings = live_config.get('capture-settings', {})
         print(f"DEBUG: capture_settings keys: {list(capture_settings.keys()) if capture_settings else 'None'}")
         
         # Get resolutions
@@ -1414,6 +4652,7 @@ def camera_info(camera_num):
                               camera_num=camera_num, 
                               camera_info=camera_info, 
                               sensor_modes=sensor_modes,
+                              capture_settings=camera.state().live_config.get('capture-settings', {}),
                               cameras_data=cameras_data, 
                               camera_list=camera_list,
                               active_page='camera_info')
@@ -1427,9 +4666,10 @@ def reset_default_settings_camera(camera_num):
         camera = cameras.get(camera_num)
         camera.default_camera_settings()
         resolutions = camera.available_resolutions()
+        live_config = camera.state().live_config
         response_data = {
-        'live_settings': camera.live_config.get('controls'),
-        'rotation_settings': camera.live_config.get('rotation')
+        'live_settings': live_config.get('controls'),
+        'rotation_settings': live_config.get('rotation')
         }
         print(f"DEBUG: reset_default_settings_camera - Response data: {response_data}")
         return jsonify(response_data)
@@ -1448,10 +4688,11 @@ def get_file_settings_camera(camera_num):
         
         camera.config_from_file(filename)
         resolutions = camera.available_resolutions()
+        live_config = camera.state().live_config
         response_data = {
-            'live_settings': camera.live_config.get('controls'),
-            'rotation_settings': camera.live_config.get('rotation'),
-            'capture_settings': camera.live_config.get('capture-settings'), 
+            'live_settings': live_config.get('controls'),
+            'rotation_settings': live_config.get('rotation'),
+            'capture_settings': live_config.get('capture-settings'), 
             'resolutions': camera.available_resolutions(),
             'success': True
         }
@@ -1489,12 +4730,31 @@ def capture_photo(camera_num):
     try:
         cameras_data = [(camera_num, camera) for camera_num, camera in cameras.items()]
         camera = cameras.get(camera_num)
-        camera.take_photo()  # Call your take_photo function
-        time.sleep(1)
-        return jsonify(success=True, message="Photo captured successfully")
+        filepath = camera.take_photo()
+        if not filepath:
+            return jsonify(success=False, message="Photo capture failed")
+        return jsonify(success=True, message="Photo captured successfully", filename=os.path.basename(filepath))
     except Exception as e:
         return jsonify(success=False, message=str(e))
 
+@app.route('/burst_<int:camera_num>', methods=['POST'])
+def capture_burst(camera_num):
+    """Burst capture, ?count= frames every ?interval= seconds (0 is every sensor frame)"""
+    camera = cameras.get(camera_num)
+    if not camera:
+        return jsonify(success=False, message="Camera not found"), 404
+    
+    count = request.args.get('count', 10, type=int)
+    interval = request.args.get('interval', 0.0, type=float)
+    wait = request.args.get('wait', '0').lower() in ('1', 'true', 'yes')
+    if not 1 <= count <= 1000 or interval < 0:
+        return jsonify(success=False, message="count must be 1-1000 and interval not negative"), 400
+    
+    stats = camera.capture_burst(count, interval, wait=wait)
+    if not stats:
+        return jsonify(success=False, message="Burst capture failed")
+    return jsonify(success=True, message="Burst started" if stats['running'] else "Burst captured", **stats)
+
 @app.route("/about")
 def about():
     cameras_data = [(camera_num, camera) for camera_num, camera in cameras.items()]
@@ -1502,216 +4762,66 @@ def about():
     # Pass cameras_data as a context variable to your template
     return render_template("about.html", title="About Picamera2 WebUI", cameras_data=cameras_data, camera_list=camera_list, active_page='about')
 
-def direct_camera_stream(camera_num, width=1456, height=1088, fps=30):
-    """Stream directly from the camera using a subprocess call to libcamera-vid"""
-    print(f"DEBUG: Starting direct camera stream for camera {camera_num}")
-    
-    # Make sure to release any Picamera2 instances
-    if camera_num in cameras:
-        cameras[camera_num].release_camera()
-    
-    # Kill any existing libcamera processes
-    try:
-        print("DEBUG: Killing any existing libcamera processes")
-        subprocess.run(["pkill", "-f", "libcamera"], stderr=subprocess.DEVNULL)
-        time.sleep(0.1)  # Reduced wait time
-    except Exception as e:
-        print(f"DEBUG: Error killing processes: {e}")
-    
-    # Build the command with optimized parameters
-    cmd = [
-        "libcamera-vid",
-        "--width", str(width),
-        "--height", str(height),
-        "--framerate", str(fps),
-        "--codec", "mjpeg",
-        "--quality", "50",
-        "--inline",
-        "--timeout", "0",
-        "--nopreview",
-        "--buffer-count", "2",
-        "--flush", "1",
-        "--output", "-"
-    ]
-    
-    if camera_num > 0:
-        cmd.extend(["--camera", str(camera_num)])
-    
-    print(f"DEBUG: Running command: {' '.join(cmd)}")
-    
-    # Start the process with optimized buffer size
-    try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=4096  # Small buffer size for lower latency
-        )
-        
-        # Check if process started successfully
-        time.sleep(0.1)  # Brief wait
-        if process.poll() is not None:
-            stderr = process.stderr.read().decode()
-            print(f"DEBUG: Process failed to start: {stderr}")
-            return None
-        
-        print("DEBUG: Process started successfully")
-        return process
-    except Exception as e:
-        print(f"DEBUG: Error starting process: {e}")
-        import traceback
-        print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
-        return None
-
-def generate_direct_stream(process):
-    """Generate a stream from a subprocess"""
-    print("DEBUG: Starting generate_direct_stream")
-    
-    if not process:
-        print("DEBUG: No process provided")
-        return
-    
-    try:
-        # Buffer for JPEG data
-        buffer = bytearray()
-        jpeg_start = b'\xff\xd8'
-        jpeg_end = b'\xff\xd9'
-        
-        while True:
-            try:
-                # Read data from the process
-                chunk = process.stdout.read1(4096)
-                
-                if not chunk:
-                    print("DEBUG: End of stream or no data")
-                    if process.poll() is not None:
-                        print("DEBUG: Process has terminated")
-                        break
-                    continue
-                
-                # Add chunk to buffer
-                buffer.extend(chunk)
-                
-                # Process all complete frames in buffer
-                while len(buffer) > 0:
-                    # Find start marker
-                    start_idx = buffer.find(jpeg_start)
-                    if start_idx < 0:
-                        # No start marker found, clear buffer
-                        buffer.clear()
-                        break
-                    
-                    # Remove any data before the start marker
-                    if start_idx > 0:
-                        buffer = buffer[start_idx:]
-                        start_idx = 0
-                    
-                    # Find end marker
-                    end_idx = buffer.find(jpeg_end, start_idx + 2)
-                    if end_idx < 0:
-                        # No end marker found, wait for more data
-                        break
-                    
-                    # Extract the frame
-                    frame = buffer[:end_idx + 2]
-                    
-                    # Remove the frame from buffer
-                    buffer = buffer[end_idx + 2:]
-                    
-                    # Yield the frame
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-                
-                # Prevent buffer from growing too large
-                if len(buffer) > 512 * 1024:  # 512KB limit
-                    print("DEBUG: Buffer too large, clearing")
-                    buffer.clear()
-                    
-            except IOError as e:
-                print(f"DEBUG: IOError in generate_direct_stream: {e}")
-                if process.poll() is not None:
-                    break
-                continue
-                
-    except Exception as e:
-        print(f"DEBUG: Error in generate_direct_stream: {e}")
-        import traceback
-        print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
-    finally:
-        # Clean up
-        if process and process.poll() is None:
-            try:
-                process.terminate()
-                process.wait(timeout=1)
-            except:
-                process.kill()
-            print("DEBUG: Process terminated")
-
 @app.route('/video_feed_<int:camera_num>')
 def video_feed(camera_num):
     """Route for streaming video from a camera"""
-    print(f"DEBUG: Video feed requested for camera {camera_num}")
+    stream_log.debug(f"Video feed requested for camera {camera_num}")
     
     # Check if camera exists
     if camera_num not in cameras:
-        print(f"DEBUG: Camera {camera_num} not found")
+        stream_log.debug(f"Camera {camera_num} not found")
         return "Camera not found", 404
     
-    # Get camera settings
     camera = cameras[camera_num]
-    width = 1456
-    height = 1088
-    fps = 30
-    
     try:
-        # Try to get settings from camera
-        if hasattr(camera, 'live_config'):
-            fps = camera.live_config.get('capture-settings', {}).get("FrameRate", 30)
-            selected_resolution = camera.live_config.get('capture-settings', {}).get("Resolution", "1456x1088")
-            if hasattr(camera, 'output_resolutions') and selected_resolution in camera.output_resolutions:
-                width, height = camera.output_resolutions[selected_resolution]
-    except Exception as e:
-        print(f"DEBUG: Error getting camera settings: {e}")
-    
-    # Start direct camera stream
-    process = direct_camera_stream(camera_num, width, height, fps)
+        max_fps = parse_max_fps(request.args.get('maxfps'))
+    except ValueError:
+        return "maxfps must be a positive number", 400
     
-    if not process:
-        print("DEBUG: Failed to start camera stream")
+    # All viewers share the camera's capture session, this only starts it if it is not running
+    if not camera.ensure_streaming():
+        stream_log.warning("Failed to start camera stream")
         return "Failed to start camera stream", 500
     
-    print("DEBUG: Starting video feed stream")
+    stream_log.debug("Starting video feed stream")
+    # Only Werkzeug's server exposes the connection, other WSGI servers keep their defaults
+    limit_unsent(request.environ.get('werkzeug.socket'))
     
     try:
-        return Response(generate_direct_stream(process),
+        return Response(generate_stream(camera, max_fps),
                         mimetype='multipart/x-mixed-replace; boundary=frame')
     except Exception as e:
-        print(f"DEBUG: Error in video_feed: {e}")
-        import traceback
-        print(f"DEBUG: Traceback:\n{traceback.format_exc()}")
+        stream_log.exception(f"Error in video_feed: {e}")
         return f"Error: {str(e)}", 500
 
 @app.route('/snapshot_<int:camera_num>')
 def snapshot(camera_num):
+    """Newest frame of the live stream straight from memory, ?fresh=1 waits for the next one"""
     camera = cameras.get(camera_num)
-    if camera:
-        # Capture an image
-        filepath = camera.take_snapshot(camera_num)
-        # Wait for a few seconds to ensure the image is saved
-        time.sleep(1)
-        return send_file(filepath, as_attachment=False, download_name="snapshot.jpg",  mimetype='image/jpeg')
-    else:
+    if not camera:
         abort(404)
+    
+    fresh = request.args.get('fresh', '0').lower() in ('1', 'true', 'yes')
+    frame = camera.take_snapshot(fresh=fresh)
+    if frame is None:
+        return "No frame available", 503
+    
+    sequence, timestamp, data = frame
+    response = Response(data, mimetype='image/jpeg')
+    response.headers['Content-Disposition'] = 'inline; filename=snapshot.jpg'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Frame-Sequence'] = str(sequence)
+    response.headers['X-Frame-Timestamp'] = f"{timestamp:.6f}"
+    return response
 
 @app.route('/preview_<int:camera_num>', methods=['POST'])
 def preview(camera_num):
     try:
         camera = cameras.get(camera_num)
         if camera:
-            # Capture an image
             filepath = camera.take_preview(camera_num)
-            # Wait for a few seconds to ensure the image is saved
-            time.sleep(1)
+            if not filepath:
+                return jsonify(success=False, message="No frame available")
             return jsonify(success=True, message="Photo captured successfully")
     except Exception as e:
         return jsonify(success=False, message=str(e))
@@ -1728,13 +4838,25 @@ def update_settings(camera_num):
     try:
         # Parse JSON data from the request
         data = request.get_json()
-        success, settings = camera.update_live_config(data)
-        if success:
-            camera.configure_camera()
-        return jsonify(success=success, message="Settings updated successfully", settings=settings)
+        # Queued for the camera's settings thread, /events reports when this sequence is applied
+        sequence = camera.actor.submit_settings(data)
+        return jsonify(success=True, message="Settings queued", sequence=sequence)
+    except (TypeError, ValueError, AttributeError) as e:
+        return jsonify(success=False, message=str(e)), 400
     except Exception as e:
         return jsonify(success=False, message=str(e))
 
+@app.route('/settings_status_<int:camera_num>', methods=['GET'])
+def settings_status(camera_num):
+    """Queued and applied settings sequence numbers, ?wait=<seconds> blocks until ?sequence= is applied"""
+    if camera_num not in cameras:
+        return jsonify({'success': False, 'message': 'Camera not found'}), 404
+    actor = cameras[camera_num].actor
+    sequence = request.args.get('sequence', type=int)
+    if sequence:
+        actor.wait_settings(sequence, timeout=min(request.args.get('wait', 0.0, type=float), 10.0))
+    return jsonify({'success': True, **actor.settings_status()})
+
 @app.route('/update_restart_settings_<int:camera_num>', methods=['POST'])
 def update_restart_settings(camera_num):
     if camera_num not in cameras:
@@ -1744,37 +4866,16 @@ def update_restart_settings(camera_num):
         data = request.json
         print(f'\nReceived data: {data}\n')
         
-        # Check if we need to update capture settings
-        if 'capture-settings' in data:
-            # Update capture settings
-            cameras[camera_num].live_config['capture-settings'].update(data['capture-settings'])
-            
-            # If frame rate or resolution is changed, we need to restart streaming
-            if 'FrameRate' in data['capture-settings'] or 'Resolution' in data['capture-settings']:
-                # Stop streaming
-                cameras[camera_num].stop_streaming()
-                
-                # Start streaming again with new settings
-                cameras[camera_num].start_streaming()
-                
-                print(f'\nRestarted streaming with updated settings\n')
-        
-        # Handle rotation settings
-        if 'hflip' in data or 'vflip' in data:
-            # Update rotation settings
-            if 'hflip' in data:
-                cameras[camera_num].live_config['rotation']['hflip'] = data['hflip']
-            if 'vflip' in data:
-                cameras[camera_num].live_config['rotation']['vflip'] = data['vflip']
-            
-            # Restart streaming with new rotation settings
-            cameras[camera_num].stop_streaming()
-            cameras[camera_num].start_streaming()
-            
-            print(f'\nRestarted streaming with updated rotation settings\n')
+        # Capture settings and rotation together are one transition, the session restarts at most once
+        changes = dict(data.get('capture-settings', {}))
+        changes.update({key: data[key] for key in ('hflip', 'vflip') if key in data})
+        camera = cameras[camera_num]
+        transition, _ = camera.actor.call(camera.control_engine.apply, (changes,))
+        if transition.needs_restart():
+            print(f'\nApplied restart settings: {transition.changed()}\n')
         
         success = True
-        settings = cameras[camera_num].live_config['rotation']
+        settings = camera.state().live_config['rotation']
         return jsonify({'success': success, 'settings': settings})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -1785,6 +4886,7 @@ def start_recording(camera_num):
         return jsonify({'success': False, 'message': 'Camera not found'}), 404
     
     success, result = cameras[camera_num].start_recording_video()
+    status_events.wake.set()
     
     if success:
         return jsonify({'success': True, 'message': 'Recording started', 'filename': result})
@@ -1797,14 +4899,34 @@ def stop_recording(camera_num):
         return jsonify({'success': False, 'message': 'Camera not found'}), 404
     
     success, video_path = cameras[camera_num].stop_recording_video()
+    status_events.wake.set()
     
     if success:
         # Extract just the filename from the path
         video_filename = os.path.basename(video_path)
-        return jsonify({'success': True, 'message': 'Recording stopped', 'filename': video_filename})
+        recording = cameras[camera_num].last_recording
+        return jsonify({'success': True, 'message': 'Recording stopped', 'filename': video_filename,
+                        'segments': recording.files() if recording else [video_filename],
+                        'manifest': os.path.basename(recording.manifest_path) if recording else None})
     else:
         return jsonify({'success': False, 'message': f'Failed to stop recording: {video_path}'})
 
+@app.route('/trigger_<int:camera_num>', methods=['POST'])
+def trigger_event(camera_num):
+    """Save the pre-event buffer plus post-roll as a clip, like pressing the GPIO button"""
+    if camera_num not in cameras:
+        return jsonify({'success': False, 'message': 'Camera not found'}), 404
+    
+    post_seconds = request.args.get('post', type=float)
+    if post_seconds is not None and post_seconds < 0:
+        return jsonify({'success': False, 'message': 'post must not be negative'}), 400
+    
+    result = cameras[camera_num].trigger_event(post_seconds=post_seconds)
+    if result:
+        return jsonify({'success': True, 'message': 'Event clip started', **result})
+    else:
+        return jsonify({'success': False, 'message': 'Failed to trigger event clip'})
+
 @app.route('/download_video/<filename>', methods=['GET'])
 def download_video(filename):
     try:
@@ -1829,21 +4951,9 @@ def download_video(filename):
             
         print(f"DEBUG: Sending video file: {filename}, size: {os.path.getsize(video_path)} bytes")
         
-        # Set the correct MIME type for MJPEG files
-        if filename.endswith('.mjpeg'):
-            return send_file(
-                video_path,
-                mimetype='video/x-mjpeg',
-                as_attachment=True,
-                download_name=filename
-            )
-        else:
-            # For other video formats
-            return send_file(
-                video_path,
-                as_attachment=True,
-                download_name=filename
-            )
+        # Set the correct MIME type for MJPEG files, other formats are guessed from the extension
+        mimetype = 'video/x-mjpeg' if filename.endswith('.mjpeg') else None
+        return send_media(video_path, mimetype=mimetype, as_attachment=True, download_name=filename)
     except Exception as e:
         print(f"DEBUG: Error downloading video: {e}")
         import traceback
@@ -1856,54 +4966,50 @@ def download_video(filename):
 @app.route('/check_recording_status_<int:camera_num>', methods=['GET'])
 def check_recording_status(camera_num):
     if camera_num not in cameras:
-        print("DEBUG: check_recording_status - Camera not found response")
+        http_log.debug("check_recording_status - Camera not found response")
         return jsonify({'recording': False, 'message': 'Camera not found'}), 404
     
     try:
-        is_recording = bool(cameras[camera_num].is_recording())
-        print(f"DEBUG: check_recording_status - Response data: {{'recording': {is_recording}}}")
+        is_recording = cameras[camera_num].state().recording
+        http_log.debug("check_recording_status - Response data: {'recording': %s}", is_recording)
         return jsonify({'recording': is_recording})
     except Exception as e:
-        print(f"DEBUG: check_recording_status - Error: {str(e)}")
+        http_log.warning(f"check_recording_status - Error: {str(e)}")
         return jsonify({'recording': False, 'error': str(e)})
 
 @app.route('/get_fps_<int:camera_num>', methods=['GET'])
 def get_fps(camera_num):
-    print(f"DEBUG: get_fps called for camera {camera_num}")
+    http_log.debug("get_fps called for camera %s", camera_num)
     if camera_num not in cameras:
-        print("DEBUG: get_fps - Camera not found response")
+        http_log.debug("get_fps - Camera not found response")
         return jsonify({'success': False, 'message': 'Camera not found'}), 404
     
     try:
-        camera = cameras[camera_num]
-        # Get current resolution
-        selected_resolution = camera.live_config.get('capture-settings', {}).get("Resolution", "0")
-        width, height = camera.output_resolutions.get(selected_resolution, (1456, 1088))
-        
-        # Get the actual measurements from the output handler
-        if hasattr(camera, 'output') and camera.output:
-            actual_fps = camera.output.get_current_fps()
-            actual_latency = camera.output.get_current_latency()
-            print(f"DEBUG: get_fps - Actual FPS: {actual_fps}, Latency: {actual_latency:.1f}ms")
-        else:
-            actual_fps = 0.0
-            actual_latency = 0.0
-            print("DEBUG: get_fps - No output handler available")
-        
-        return jsonify({
-            'success': True,
-            'fps': actual_fps,
-            'target_fps': camera.live_config.get('capture-settings', {}).get("FrameRate", 30),
-            'width': width,
-            'height': height,
-            'latency': actual_latency
-        })
+        status = camera_status(cameras[camera_num])
+        http_log.debug("get_fps - Actual FPS: %s, Latency: %.1fms", status['fps'], status['latency'])
+        return jsonify({'success': True, **status})
     except Exception as e:
-        print(f"DEBUG: get_fps - Error: {str(e)}")
-        import traceback
-        print(f"DEBUG: get_fps - Traceback:\n{traceback.format_exc()}")
+        http_log.exception(f"get_fps - Error: {str(e)}")
         return jsonify({'success': False, 'fps': 0, 'error': str(e)})
 
+@app.route('/events')
+def events():
+    """Server-sent camera status, pipeline errors and storage usage, replaces polling get_fps"""
+    rate = request.args.get('rate', type=float)
+    camera_num = request.args.get('camera', type=int)
+    status_events.start()
+    response = Response(status_events.stream(rate if rate and rate > 0 else None, camera_num),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep nginx and similar proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 ####################
 # Image Gallery Functions
 ####################
@@ -1915,73 +5021,207 @@ def image_gallery():
     camera_list = [(camera_num, camera, camera.camera_info['Model']) for camera_num, camera in cameras.items()]
     
     try:
-        if not os.path.exists(UPLOAD_FOLDER):
-            os.makedirs(UPLOAD_FOLDER)
-        
-        # Get all image files
-        image_files = [f for f in os.listdir(UPLOAD_FOLDER) if f.endswith('.jpg')]
-        
-        # Get all video files (both MP4 and MJPEG)
-        video_files = [f for f in os.listdir(UPLOAD_FOLDER) if f.endswith('.mp4') or f.endswith('.mjpeg')]
-        
-        # Sort files by creation time (newest first)
-        image_files.sort(key=lambda x: os.path.getctime(os.path.join(UPLOAD_FOLDER, x)), reverse=True)
-        video_files.sort(key=lambda x: os.path.getctime(os.path.join(UPLOAD_FOLDER, x)), reverse=True)
+        # Only the first page is rendered, the rest is loaded from /api/media while scrolling
+        first_page, next_cursor = media_catalog.page(limit=GALLERY_PAGE_SIZE)
+        first_page = [describe_media(entry) for entry in first_page]
         
         # If there are no files, render a special template
-        if not image_files and not video_files:
+        if not first_page:
             return render_template('no_files.html', cameras_data=cameras_data, camera_list=camera_list)
         
-        # Create a list of dictionaries with image information
-        images_info = []
-        for image_file in image_files:
-            # Check if there's a corresponding .dng file
-            dng_file = image_file.replace('.jpg', '.dng')
-            has_dng = os.path.exists(os.path.join(UPLOAD_FOLDER, dng_file))
-
-            # Get image dimensions
-            img = Image.open(os.path.join(UPLOAD_FOLDER, image_file))
-            width, height = img.size
-            
-            # Get file creation time
-            creation_time = datetime.fromtimestamp(os.path.getctime(os.path.join(UPLOAD_FOLDER, image_file)))
-            
-            # Add image info to the list
-            images_info.append({
-                'filename': image_file,
-                'width': width,
-                'height': height,
-                'has_dng': has_dng,
-                'creation_time': creation_time,
-                'type': 'image'
-            })
-        
-        # Create a list of dictionaries with video information
-        videos_info = []
-        for video_file in video_files:
-            # Get file creation time
-            creation_time = datetime.fromtimestamp(os.path.getctime(os.path.join(UPLOAD_FOLDER, video_file)))
-            
-            # Determine video type
-            video_type = 'mjpeg' if video_file.endswith('.mjpeg') else 'mp4'
-            
-            # Add video info to the list
-            videos_info.append({
-                'filename': video_file,
-                'creation_time': creation_time,
-                'type': 'video',
-                'format': video_type
-            })
-        
-        # Combine and sort all media by creation time
-        all_media = images_info + videos_info
-        all_media.sort(key=lambda x: x['creation_time'], reverse=True)
-        
-        return render_template('image_gallery.html', media=all_media, cameras_data=cameras_data, camera_list=camera_list, active_page='image_gallery')
+        return render_template('image_gallery.html', media=first_page, next_cursor=next_cursor, page_size=GALLERY_PAGE_SIZE,
+                               cameras_data=cameras_data, camera_list=camera_list, active_page='image_gallery')
     except Exception as e:
         logging.error(f"Error loading image gallery: {e}")
         return render_template('error.html', error=str(e), cameras_data=cameras_data, camera_list=camera_list)
 
+def describe_media(entry):
+    """Add the URLs of a catalog entry's file, thumbnail or video preview for the gallery"""
+    item = dict(entry)
+    filename = entry['filename']
+    item['url'] = url_for('static', filename='gallery/' + filename)
+    if entry['type'] == 'image':
+        item['thumbnail_url'] = url_for('thumbnail', size='md', filename=filename)
+    elif entry['preview'] and entry['width'] and entry['height']:
+        item['poster_url'] = url_for('static', filename='gallery/.previews/' + video_previews.poster_name(filename))
+        if entry['duration']:
+            tile_width, tile_height = VideoPreviews.tile_size(entry['width'], entry['height'])
+            item['sprite'] = {
+                'url': url_for('static', filename='gallery/.previews/' + video_previews.sprite_name(filename)),
+                'tiles': VideoPreviews.SPRITE_TILES,
+                'columns': VideoPreviews.SPRITE_COLUMNS,
+                'tile_width': tile_width,
+                'tile_height': tile_height
+            }
+    elif entry['frame_count'] is None:
+        # Clips found on disk or recorded before previews existed get theirs now
+        video_previews.schedule(filename)
+    return item
+
+def media_etag(stat):
+    """Strong validator for a gallery file, changes whenever the file is rewritten"""
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def media_range(stat, etag):
+    """The (start, stop) byte range requested for a file, None for the whole file or False if unsatisfiable"""
+    byte_range = request.range
+    # Unparseable, non-byte and multipart ranges are ignored and the whole file is sent
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+    
+    # If-Range only allows the partial response while the client's copy is still current
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date.timestamp() != int(stat.st_mtime):
+        return None
+    
+    return byte_range.range_for_length(stat.st_size) or False
+
+def media_body(environ, file, offset, length, block_size=1024 * 1024):
+    """Response iterable sending length bytes of file from offset
+    
+    Gunicorn and other servers with wsgi.file_wrapper send the wrapper with sendfile.
+    On the Werkzeug server the headers are flushed by an empty first chunk and the body
+    goes out through socket.sendfile on the client connection, so the file is never
+    copied through Python. Anything else gets plain reads.
+    """
+    if 'wsgi.file_wrapper' in environ:
+        file.seek(offset)
+        return environ['wsgi.file_wrapper'](file, block_size)
+    
+    def generate():
+        try:
+            connection = environ.get('werkzeug.socket')
+            if connection is not None and hasattr(connection, 'sendfile'):
+                yield b''
+                connection.sendfile(file, offset, length)
+                return
+            file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = file.read(min(block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            file.close()
+    return generate()
+
+def send_media(path, mimetype=None, as_attachment=False, download_name=None):
+    """Serve a gallery file with conditional requests and single byte ranges"""
+    stat = os.stat(path)
+    etag = media_etag(stat)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = int(stat.st_mtime)
+    response.accept_ranges = 'bytes'
+    if as_attachment:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name or os.path.basename(path))
+    
+    # If-None-Match takes precedence, If-Modified-Since is only checked without it
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = request.if_modified_since is not None and int(stat.st_mtime) <= request.if_modified_since.timestamp()
+    if not_modified:
+        response.status_code = 304
+        return response
+    
+    byte_range = media_range(stat, etag)
+    if byte_range is False:
+        response.status_code = 416
+        response.headers['Content-Range'] = f"bytes */{stat.st_size}"
+        return response
+    
+    start, stop = byte_range or (0, stat.st_size)
+    if byte_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{stat.st_size}"
+    response.content_length = stop - start
+    
+    file = HeldMediaFile(path, media_retention)
+    # HEAD responses never iterate the body, so the file is also closed with the response
+    response.call_on_close(file.close)
+    response.response = media_body(request.environ, file, start, stop - start)
+    return response
+
+@app.route('/api/media', methods=['GET'])
+def api_media():
+    """Keyset-paginated media listing: ?cursor=&limit=&type=image|video&camera=&since=epoch-or-ISO-date"""
+    try:
+        limit = min(max(request.args.get('limit', GALLERY_PAGE_SIZE, type=int), 1), 200)
+        media_type = request.args.get('type') or None
+        if media_type not in (None, 'image', 'video'):
+            return jsonify({'success': False, 'message': 'type must be image or video'}), 400
+        camera = request.args.get('camera', type=int)
+        since = request.args.get('since')
+        if since:
+            try:
+                since = float(since)
+            except ValueError:
+                since = datetime.fromisoformat(since).timestamp()
+        cursor = request.args.get('cursor') or None
+        try:
+            entries, next_cursor = media_catalog.page(limit, cursor, media_type, camera, since or None)
+        except (ValueError, TypeError, json.JSONDecodeError):
+            return jsonify({'success': False, 'message': 'Invalid cursor'}), 400
+        
+        items = []
+        for entry in entries:
+            item = describe_media(entry)
+            item['creation_time'] = entry['creation_time'].isoformat()
+            items.append(item)
+        return jsonify({'success': True, 'items': items, 'next_cursor': next_cursor})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+@app.route('/thumbnail/<size>/<filename>', methods=['GET'])
+def thumbnail(size, filename):
+    """Cached thumbnail of a gallery photo, sizes are ThumbnailCache.SIZES"""
+    if size not in ThumbnailCache.SIZES:
+        abort(404)
+    try:
+        digest = thumbnail_cache.digest(filename)
+        if digest is None or MediaCatalog.media_type(filename) != 'image':
+            abort(404)
+        
+        # Revalidation only needs the digest from the catalog, the thumbnail is not touched
+        etag = ThumbnailCache.etag_for(digest, size)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        path, etag = thumbnail_cache.get(filename, size)
+        response = send_file(path, mimetype='image/jpeg', etag=etag, max_age=86400, conditional=True)
+        return response
+    except (OSError, concurrent.futures.TimeoutError) as e:
+        print(f"DEBUG: Error serving thumbnail {size} of {filename}: {e}")
+        abort(500)
+
+@app.route('/api/storage', methods=['GET'])
+def storage_status():
+    """Gallery and card usage, retention policy and time left at the bitrate of running recordings"""
+    try:
+        bitrate = sum(camera.recording_rate() for camera in cameras.values())
+        return jsonify({'success': True, **media_retention.usage(bitrate)})
+    except OSError as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/storage/retention', methods=['POST'])
+def update_retention():
+    """Change the retention policy, the janitor applies it right away"""
+    try:
+        policy = media_retention.update_policy(request.get_json() or {})
+        return jsonify({'success': True, 'policy': policy})
+    except (TypeError, ValueError, AttributeError) as e:
+        return jsonify({'success': False, 'message': f'Invalid retention policy: {e}'}), 400
+
 @app.route('/delete_image/<filename>', methods=['DELETE'])
 def delete_image(filename):
     try:
@@ -1991,15 +5231,8 @@ def delete_image(filename):
         if not os.path.exists(filepath):
             return jsonify({'success': False, 'message': 'File not found'})
         
-        # Delete the file
-        os.remove(filepath)
-        
-        # If it's an image, also delete the corresponding DNG file if it exists
-        if filename.endswith('.jpg'):
-            dng_file = filename.replace('.jpg', '.dng')
-            dng_filepath = os.path.join(app.config['UPLOAD_FOLDER'], dng_file)
-            if os.path.exists(dng_filepath):
-                os.remove(dng_filepath)
+        # Delete the file with its DNG or timecode file, catalog row and previews
+        media_retention.delete(filename)
         
         return jsonify({'success': True, 'message': 'File deleted successfully'})
     except Exception as e:
@@ -2018,44 +5251,379 @@ def view_image(filename):
         if not os.path.exists(image_path):
             return render_template('error.html', error=f"Image not found: {filename}", cameras_data=cameras_data, camera_list=camera_list)
         
-        # Check if there's a corresponding .dng file
-        dng_file = filename.replace('.jpg', '.dng')
-        has_dng = os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], dng_file))
-        
-        # Get image dimensions
-        img = Image.open(image_path)
-        width, height = img.size
-        
-        # Get file creation time
-        creation_time = datetime.fromtimestamp(os.path.getctime(image_path))
+        # Size, DNG companion and creation time come from the media catalog
+        entry = media_catalog.get(filename)
+        if entry is None:
+            return render_template('error.html', error=f"Not a gallery image: {filename}", cameras_data=cameras_data, camera_list=camera_list)
         
-        return render_template('view_image.html', 
+        response = make_response(render_template('view_image.html', 
                               filename=filename, 
-                              width=width, 
-                              height=height, 
-                              has_dng=has_dng,
-                              creation_time=creation_time,
+                              width=entry['width'], 
+                              height=entry['height'], 
+                              has_dng=entry['has_dng'],
+                              creation_time=entry['creation_time'],
                               cameras_data=cameras_data, 
                               camera_list=camera_list,
-                              active_page='image_gallery')
+                              active_page='image_gallery'))
+        # Revisits of an unchanged page get a 304, the image itself is revalidated by the static route
+        response.add_etag()
+        return response.make_conditional(request)
     except Exception as e:
         logging.error(f"Error viewing image: {e}")
         return render_template('error.html', error=str(e), cameras_data=cameras_data, camera_list=camera_list)
 
 @app.route('/download_image/<filename>', methods=['GET'])
 def download_image(filename):
+    image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.isfile(image_path):
+        abort(404)
     try:
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        return send_file(image_path, as_attachment=True)
+        return send_media(image_path, as_attachment=True)
     except Exception as e:
         print(f"\nError downloading image:\n{e}\n")
         abort(500)
 
+####################
+# ASGI Serving Mode
+####################
+
+services_started = False
+
+def start_services():
+    """Open the cameras and start the background workers, once per process"""
+    global services_started
+    if services_started:
+        return
+    services_started = True
+    init_cameras()
+    # Index the gallery in the background so the first gallery page does not pay for it
+    threading.Thread(target=media_catalog.ensure_reconciled, daemon=True).start()
+    media_retention.start()
+
+MJPEG_PART_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+
+class AsyncFrameBroadcast:
+    """Hands the newest frame of one hub to the asyncio viewers of an event loop.
+
+    It is a sink of the hub while it has viewers. The capture thread builds the
+    multipart part once per frame for all viewers and schedules a single wake-up on
+    the loop unless one is still pending, so a busy loop finds the newest frame
+    instead of a backlog and the capture thread never waits for the loop. All
+    viewers await the same future, a heartbeat resolves it once a second so they
+    can notice a gone client or a new hub while the camera is silent.
+    """
+    def __init__(self, output, loop):
+        self.output = output
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.latest = None       # (sequence, timestamp, part)
+        self.sequence = 0
+        self.scheduled = False
+        self.ready = loop.create_future()
+        self.viewers = 0
+        self.heartbeat = loop.call_later(1.0, self._heartbeat)
+
+    def __call__(self, buf, timestamp):
+        part = b''.join((MJPEG_PART_HEADER, buf, b'\r\n'))
+        with self.lock:
+            self.sequence += 1
+            self.latest = (self.sequence, timestamp, part)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        with self.lock:
+            self.scheduled = False
+        ready, self.ready = self.ready, self.loop.create_future()
+        ready.set_result(None)
+
+    def _heartbeat(self):
+        self._wake()
+        self.heartbeat = self.loop.call_later(1.0, self._heartbeat)
+
+    def close(self):
+        self.heartbeat.cancel()
+
+    async def next_frame(self, last_sequence):
+        """The newest (sequence, timestamp, part) after last_sequence, or None after a heartbeat"""
+        latest = self.latest
+        if latest is None or latest[0] <= last_sequence:
+            await self.ready
+            latest = self.latest
+        return latest if latest and latest[0] > last_sequence else None
+
+class WsgiBridge:
+    """Runs the Flask app for ASGI requests on a pool of worker threads.
+
+    Response chunks are sent from the worker through the event loop, and the worker
+    waits for each send, so a slow client slows its own worker only. The WSGI
+    iterable is always closed, which releases held gallery files. Once the client
+    disconnects the next send raises, ending streaming responses.
+    """
+    def __init__(self, wsgi_app, max_workers=16):
+        self.wsgi_app = wsgi_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        loop = asyncio.get_running_loop()
+        disconnected = threading.Event()
+        watcher = asyncio.ensure_future(wait_for_disconnect(receive, disconnected))
+        try:
+            await loop.run_in_executor(self.executor, self.run, self.environ(scope, body), send, loop, disconnected)
+        finally:
+            watcher.cancel()
+            body.close()
+
+    @staticmethod
+    def environ(scope, body):
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope['query_string'].decode('latin1'),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'SERVER_NAME': scope['server'][0] if scope.get('server') else 'localhost',
+            'SERVER_PORT': str(scope['server'][1]) if scope.get('server') else '80',
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1').upper().replace('-', '_')
+            if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+                name = f'HTTP_{name}'
+            value = value.decode('latin1')
+            environ[name] = f"{environ[name]},{value}" if name in environ else value
+        return environ
+
+    def run(self, environ, send, loop, disconnected):
+        def send_message(message):
+            if disconnected.is_set():
+                raise ConnectionError("Client disconnected")
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start.update(type='http.response.start', status=int(status.split(' ', 1)[0]),
+                                  headers=[(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers])
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    send_message(response_start)
+                    started = True
+                send_message({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+            if not started:
+                send_message(response_start)
+            send_message({'type': 'http.response.body'})
+        except ConnectionError:
+            pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+async def wait_for_disconnect(receive, disconnected):
+    """Set disconnected (a threading or asyncio Event) once the client has gone away"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+class AsgiApp:
+    """ASGI entry point, for uvicorn app:asgi_app or python app.py --server asgi.
+
+    Live video and /events are served by coroutines, so a viewer costs a few KB
+    instead of a server thread. Every other route goes to the Flask app through
+    WsgiBridge and behaves as under app.run. The app never sees the client socket,
+    listen on asgi_listen_socket() so viewers get the unsent-bytes limit.
+    """
+    VIDEO_FEED = re.compile(r'^/video_feed_(\d+)$')
+
+    def __init__(self, wsgi_app, max_workers=16):
+        self.wsgi = WsgiBridge(wsgi_app, max_workers)
+        self.broadcasts = {}   # hub -> AsyncFrameBroadcast
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] != 'http':
+            return
+        elif self.VIDEO_FEED.match(scope['path']):
+            await self.video_feed(int(self.VIDEO_FEED.match(scope['path']).group(1)), scope, receive, send)
+        elif scope['path'] == '/events':
+            await self.events(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.get_running_loop().run_in_executor(None, start_services)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def query(scope):
+        return {key: values[-1] for key, values in urllib.parse.parse_qs(scope['query_string'].decode('latin1')).items()}
+
+    @staticmethod
+    async def plain_response(send, status, text):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': text.encode()})
+
+    def attach(self, output):
+        broadcast = self.broadcasts.get(output)
+        if broadcast is None:
+            broadcast = self.broadcasts[output] = AsyncFrameBroadcast(output, asyncio.get_running_loop())
+            output.add_sink(broadcast)
+        broadcast.viewers += 1
+        return broadcast
+
+    def detach(self, broadcast):
+        broadcast.viewers -= 1
+        if broadcast.viewers == 0:
+            broadcast.output.remove_sink(broadcast)
+            broadcast.close()
+            del self.broadcasts[broadcast.output]
+
+    async def video_feed(self, camera_num, scope, receive, send):
+        """Same stream as the video_feed route, as one coroutine per viewer"""
+        camera = cameras.get(camera_num)
+        if camera is None:
+            return await self.plain_response(send, 404, "Camera not found")
+        try:
+            max_fps = parse_max_fps(self.query(scope).get('maxfps'))
+        except ValueError:
+            return await self.plain_response(send, 400, "maxfps must be a positive number")
+        # Starting goes through the camera's actor and may block, keep it off the loop
+        if not await asyncio.get_running_loop().run_in_executor(None, camera.ensure_streaming) or camera.output is None:
+            return await self.plain_response(send, 500, "Failed to start camera stream")
+        
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame')]})
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(wait_for_disconnect(receive, disconnected))
+        output = camera.output
+        broadcast = self.attach(output)
+        pacer = ViewerPacer(camera, max_fps)
+        pacer.last_sequence = broadcast.sequence - 1 if broadcast.latest else 0
+        camera.session.acquire('preview')
+        output.add_viewer()
+        try:
+            while not disconnected.is_set():
+                # The camera may have been restarted with a new hub (e.g. settings change)
+                if camera.output is not None and camera.output is not output:
+                    output.remove_viewer()
+                    self.detach(broadcast)
+                    output = camera.output
+                    output.add_viewer()
+                    broadcast = self.attach(output)
+                    pacer.last_sequence = 0
+                
+                delay = pacer.delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                latest = await broadcast.next_frame(pacer.last_sequence)
+                if latest is None:
+                    continue
+                sequence, timestamp, part = latest
+                # Frames published while this viewer was still sending are skipped
+                pacer.take(sequence)
+                # The server's flow control makes this wait while the client's socket is full
+                await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+                pacer.sent(output, timestamp)
+        finally:
+            watcher.cancel()
+            pacer.close()
+            camera.session.release('preview')
+            output.remove_viewer()
+            self.detach(broadcast)
+
+    async def events(self, scope, receive, send):
+        """The /events route as a coroutine"""
+        query = self.query(scope)
+        try:
+            rate = float(query['rate']) if 'rate' in query else None
+            camera_num = int(query['camera']) if 'camera' in query else None
+        except ValueError:
+            return await self.plain_response(send, 400, "rate and camera must be numbers")
+        status_events.start()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(wait_for_disconnect(receive, disconnected))
+        stream = status_events.astream(rate if rate and rate > 0 else None, camera_num)
+        try:
+            async for text in stream:
+                if disconnected.is_set():
+                    break
+                await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+        finally:
+            watcher.cancel()
+            await stream.aclose()
+
+asgi_app = AsgiApp(app)
+
+def asgi_listen_socket(host, port):
+    """Listening socket for the ASGI server, its connections inherit the viewer unsent-bytes limit"""
+    sock = socket.create_server((host, port), family=socket.AF_INET6 if ':' in host else socket.AF_INET, backlog=2048)
+    limit_unsent(sock)
+    return sock
+
 if __name__ == "__main__":
     # Parse any argument passed from command line
     parser = argparse.ArgumentParser(description='PiCamera2 WebUI')
     parser.add_argument('--port', type=int, default=8080, help='Port number to run the web server on')
     parser.add_argument('--ip', type=str, default='0.0.0.0', help='IP to which the web server is bound to')
+    parser.add_argument('--server', choices=['werkzeug', 'asgi'], default='werkzeug',
+                        help='asgi serves live video and /events as coroutines (needs uvicorn)')
+    parser.add_argument('--events-rate', type=float, default=2.0, help='Most status updates per second sent on /events')
+    parser.add_argument('--log-level', type=str, default='INFO', help='Level of the webui loggers, e.g. DEBUG or WARNING')
+    parser.add_argument('--log-module', action='append', default=[], metavar='NAME=LEVEL',
+                        help='Level of one logger (stream, capture, recording, http), can be repeated')
     args = parser.parse_args()
+    module_levels = {}
+    for item in args.log_module:
+        name, _, level = item.partition('=')
+        if not level:
+            parser.error(f"--log-module expects NAME=LEVEL, got {item}")
+        module_levels[name.strip().lower()] = level.strip().upper()
+    setup_logging(args.log_level.upper(), module_levels)
+    if args.server == 'asgi' and uvicorn is None:
+        parser.error("--server asgi needs uvicorn, install it with: pip install uvicorn")
+    if args.events_rate <= 0:
+        parser.error("--events-rate must be positive")
+    status_events.max_rate = args.events_rate
     
-    app.run(host=args.ip, port=args.port)
+    start_services()
+    if args.server == 'asgi':
+        server = uvicorn.Server(uvicorn.Config(asgi_app, log_level='warning'))
+        server.run(sockets=[asgi_listen_socket(args.ip, args.port)])
+    else:
+        app.run(host=args.ip, port=args.port)
@@ -0,0 +1,210 @@
+"""Many live viewers on one camera, Werkzeug threads against the ASGI serving mode.
+
+Record a capture on the Pi first, for example:
+
+    libcamera-vid --codec mjpeg --width 640 --height 480 --framerate 30 -t 10000 -o capture.mjpeg
+
+then run (the asgi rows need uvicorn installed):
+
+    python benchmarks/asgi_viewers_benchmark.py capture.mjpeg --viewers 50 300
+
+A replay camera writes the capture into a StreamingOutput at --fps, so no camera is
+needed. /video_feed_0 is served on a loopback port by the threaded Werkzeug server
+that app.run uses, then by uvicorn with app.asgi_app. The viewers run as asyncio
+connections in a separate process and count multipart boundaries. Server CPU is the
+CPU time of this process, replay thread included, over the measured window.
+
+Viewers attach through the real CameraObject.ensure_streaming and a real
+CameraActor. The replayed pipeline is always running, so the numbers leave out
+starting the camera; --busy-actor keeps the actor occupied for the whole run, as
+a long photo or recording stop would.
+"""
+import argparse
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server
+
+import app
+from app import JpegFrameSplitter, StreamingOutput
+
+
+class ReplaySession:
+    """Stands in for CaptureSession, the replayed pipeline is always running"""
+    def is_alive(self):
+        return True
+
+    def is_recording(self):
+        return False
+
+    def acquire(self, consumer):
+        pass
+
+    def release(self, consumer):
+        pass
+
+
+class ReplayCamera:
+    """Stands in for CameraObject, publishing the capture's frames at a fixed rate"""
+    # Viewers attach exactly as on a real camera
+    ensure_streaming = app.CameraObject.ensure_streaming
+
+    def __init__(self, frames, fps):
+        self.camera_info = {'Num': 0}
+        self.session = ReplaySession()
+        self.output = StreamingOutput(camera_num=0)
+        self.recording = False
+        self.live_config = {}
+        self.frames = frames
+        self.fps = fps
+        self.stopped = threading.Event()
+        self.actor = app.CameraActor(self)
+        threading.Thread(target=self.replay, daemon=True).start()
+
+    def pipeline_backend(self):
+        return 'replay'
+
+    def replay(self):
+        interval = 1.0 / self.fps
+        next_time = time.perf_counter()
+        index = 0
+        while not self.stopped.is_set():
+            self.output.write(self.frames[index % len(self.frames)])
+            index += 1
+            next_time += interval
+            time.sleep(max(0.0, next_time - time.perf_counter()))
+
+
+def load_frames(path):
+    with open(path, 'rb') as file:
+        stream = io.BufferedReader(io.BytesIO(file.read()))
+    splitter = JpegFrameSplitter()
+    frames = []
+    while splitter.read_from(stream, 32768):
+        frames.extend(bytes(frame) for frame in splitter.frames())
+    return frames
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def viewer(port, start, stop, counts, index):
+    """One browser tab, counts the frames it receives between start and stop"""
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        return
+    writer.write(f"GET /video_feed_0 HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n".encode())
+    tail = b''
+    try:
+        while time.monotonic() < stop:
+            data = await asyncio.wait_for(reader.read(65536), max(0.01, stop - time.monotonic()))
+            if not data:
+                break
+            if time.monotonic() >= start:
+                counts[index] += (tail + data).count(b'--frame\r\n')
+            tail = data[-9:]
+    except (asyncio.TimeoutError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_viewers(port, viewers, warmup, seconds, results):
+    async def main():
+        counts = [0] * viewers
+        start = time.monotonic() + warmup
+        stop = start + seconds
+        await asyncio.gather(*(viewer(port, start, stop, counts, index) for index in range(viewers)))
+        return counts
+    results.put(asyncio.run(main()))
+
+
+def serve_werkzeug(port):
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', port, app.app, threaded=True)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+def serve_asgi(port):
+    import uvicorn
+    # Lifespan off, the replay camera replaces init_cameras
+    server = uvicorn.Server(uvicorn.Config(app.asgi_app, lifespan='off', log_level='warning'))
+    sock = app.asgi_listen_socket('127.0.0.1', port)
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+        thread.join(timeout=10)
+    return stop
+
+
+def run(name, serve, viewers, args):
+    port = free_port()
+    stop = serve(port)
+    if args.busy_actor:
+        app.cameras[0].actor.submit(time.sleep, args.warmup + args.seconds)
+    results = multiprocessing.Queue()
+    clients = multiprocessing.Process(target=run_viewers, args=(port, viewers, args.warmup, args.seconds, results))
+    clients.start()
+    time.sleep(args.warmup)
+    cpu_start = time.process_time()
+    peak_threads = 0
+    deadline = time.monotonic() + args.seconds
+    while time.monotonic() < deadline:
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.1)
+    cpu = time.process_time() - cpu_start
+    counts = results.get()
+    clients.join()
+    stop()
+    # Give the server time to notice the closed connections before the next run
+    time.sleep(1.0)
+    rates = [count / args.seconds for count in counts]
+    starved = sum(1 for count in counts if count == 0)
+    print(f"  {name:<10} {viewers:>5} viewers  fps/viewer median {statistics.median(rates):>5.1f} "
+          f"min {min(rates):>5.1f}  starved {starved:>4}  server CPU {cpu / args.seconds * 100:>5.1f}%  "
+          f"threads {peak_threads:>4}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare live viewer capacity of the Werkzeug and ASGI servers')
+    parser.add_argument('capture', help='Raw MJPEG file recorded with libcamera-vid --codec mjpeg')
+    parser.add_argument('--viewers', type=int, nargs='+', default=[50, 300], help='Concurrent viewers per run')
+    parser.add_argument('--fps', type=float, default=30.0, help='Replay frame rate')
+    parser.add_argument('--seconds', type=float, default=10.0, help='Measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=3.0, help='Seconds for the viewers to connect before measuring')
+    parser.add_argument('--servers', nargs='+', choices=['werkzeug', 'asgi'], default=['werkzeug', 'asgi'])
+    parser.add_argument('--busy-actor', action='store_true', help='Keep the camera actor busy with a long command during each run')
+    args = parser.parse_args()
+
+    frames = load_frames(args.capture)
+    app.cameras[0] = ReplayCamera(frames, args.fps)
+    average = sum(len(frame) for frame in frames) / len(frames)
+    print(f"{args.capture}: {len(frames)} frames of {average / 1024:.1f} KB on average, replayed at {args.fps:g} fps")
+    servers = {'werkzeug': serve_werkzeug, 'asgi': serve_asgi}
+    for viewers in args.viewers:
+        for name in args.servers:
+            run(name, servers[name], viewers, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Micro-benchmark for the MJPEG frame splitter used by the libcamera-vid reader thread.
+
+Record a capture on the Pi first, for example:
+
+    libcamera-vid --codec mjpeg --width 1456 --height 1088 --framerate 60 -t 10000 -o capture.mjpeg
+
+then run:
+
+    python benchmarks/jpeg_splitter_benchmark.py capture.mjpeg
+
+Each capture is loaded into memory and fed to the splitter in chunks the size of a
+pipe read, so the numbers show splitting cost only (no disk or pipe I/O). The old
+find-and-rebuild loop from generate_direct_stream is run on the same data for
+comparison.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import JpegFrameSplitter
+
+
+def legacy_split(data, chunk_size):
+    """The per-chunk rescan and buffer rebuild that generate_direct_stream used to do"""
+    frames = 0
+    buffer = bytearray()
+    stream = io.BytesIO(data)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+        while len(buffer) > 0:
+            start_idx = buffer.find(b'\xff\xd8')
+            if start_idx < 0:
+                buffer.clear()
+                break
+            if start_idx > 0:
+                buffer = buffer[start_idx:]
+            end_idx = buffer.find(b'\xff\xd9', 2)
+            if end_idx < 0:
+                break
+            frames += 1
+            buffer = buffer[end_idx + 2:]
+        if len(buffer) > 512 * 1024:
+            buffer.clear()
+    return frames
+
+
+def splitter_split(data, chunk_size):
+    frames = 0
+    splitter = JpegFrameSplitter()
+    stream = io.BufferedReader(io.BytesIO(data))
+    while splitter.read_from(stream, chunk_size):
+        for _ in splitter.frames():
+            frames += 1
+    return frames
+
+
+def run(name, func, data, chunk_size, repeat):
+    best = None
+    frames = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = func(data, chunk_size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    megabytes = len(data) / (1024 * 1024)
+    print(f"  {name:<10} {frames:>7} frames  {megabytes / best:>9.1f} MB/s  {frames / best:>10.1f} frames/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MJPEG frame splitting on recorded libcamera-vid captures')
+    parser.add_argument('captures', nargs='+', help='Raw MJPEG files recorded with libcamera-vid --codec mjpeg')
+    parser.add_argument('--chunk-size', type=int, default=32768, help='Bytes per simulated pipe read')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per capture, the best one is reported')
+    args = parser.parse_args()
+
+    for capture in args.captures:
+        with open(capture, 'rb') as file:
+            data = file.read()
+        print(f"{capture}: {len(data) / (1024 * 1024):.1f} MB, {args.chunk_size} byte reads")
+        run('legacy', legacy_split, data, args.chunk_size, args.repeat)
+        run('splitter', splitter_split, data, args.chunk_size, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
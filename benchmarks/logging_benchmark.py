@@ -0,0 +1,132 @@
+"""Reader-thread CPU of per-chunk print() against the queued, rate-limited loggers.
+
+Record a capture on the Pi first, for example:
+
+    libcamera-vid --codec mjpeg --width 1456 --height 1088 --framerate 60 -t 10000 -o capture.mjpeg
+
+then run:
+
+    python benchmarks/logging_benchmark.py capture.mjpeg
+
+The capture is split in 32 KB reads like the libcamera-vid reader thread does. The
+legacy run prints a line per read and two per frame, as the reader and the stream
+generator used to. The other runs log the same call sites through webui.capture at
+INFO (debug lines off) and at DEBUG (rate limited, written by the queue listener).
+Output goes into a pipe (shrunk to --pipe-size where Linux allows it) drained by a
+separate thread; --drain-delay slows that consumer down to mimic journald pushing
+back. Reader CPU is the thread's own CPU time, so the listener's writes are not
+counted against it. The best of --repeat runs is reported.
+"""
+import argparse
+import fcntl
+import io
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from app import JpegFrameSplitter, capture_log, stream_log
+
+
+def drain(fd, delay):
+    """Read the pipe like a log collector, sleeping delay seconds per 4 KB read"""
+    while True:
+        data = os.read(fd, 4096)
+        if not data:
+            break
+        if delay:
+            time.sleep(delay)
+
+
+def legacy_reader(data, chunk_size):
+    splitter = JpegFrameSplitter()
+    stream = io.BufferedReader(io.BytesIO(data))
+    while True:
+        chunk_size_read = splitter.read_from(stream, chunk_size)
+        if not chunk_size_read:
+            break
+        print(f"DEBUG: Received chunk of size {chunk_size_read} bytes")
+        for frame in splitter.frames():
+            print(f"DEBUG: Got frame of {len(frame)} bytes")
+            print(f"DEBUG: Yielding frame of {len(frame)} bytes")
+
+
+def logging_reader(data, chunk_size):
+    splitter = JpegFrameSplitter()
+    stream = io.BufferedReader(io.BytesIO(data))
+    while True:
+        chunk_size_read = splitter.read_from(stream, chunk_size)
+        if not chunk_size_read:
+            break
+        capture_log.debug("Received chunk of size %s bytes", chunk_size_read)
+        for frame in splitter.frames():
+            stream_log.debug("Got frame of %s bytes", len(frame))
+            stream_log.debug("Yielding frame of %s bytes", len(frame))
+
+
+def run_once(reader, data, chunk_size, drain_delay, pipe_size):
+    read_fd, write_fd = os.pipe()
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+        fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, pipe_size)
+    pipe = os.fdopen(write_fd, 'w', buffering=1)
+    consumer = threading.Thread(target=drain, args=(read_fd, drain_delay), daemon=True)
+    consumer.start()
+
+    console = app.log_listener.handlers[0]
+    previous_stdout, previous_stream = sys.stdout, console.setStream(pipe)
+    sys.stdout = pipe
+    result = {}
+
+    def measure():
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        reader(data, chunk_size)
+        result['cpu'] = time.thread_time() - cpu_start
+        result['wall'] = time.perf_counter() - start
+
+    try:
+        thread = threading.Thread(target=measure)
+        thread.start()
+        thread.join()
+    finally:
+        sys.stdout = previous_stdout
+        console.setStream(previous_stream)
+        pipe.close()
+        consumer.join(timeout=5)
+    return result['cpu'], result['wall']
+
+
+def run(name, reader, data, chunk_size, drain_delay, pipe_size, repeat):
+    runs = [run_once(reader, data, chunk_size, drain_delay, pipe_size) for _ in range(repeat)]
+    cpu = min(cpu for cpu, _ in runs)
+    wall = min(wall for _, wall in runs)
+    megabytes = len(data) / (1024 * 1024)
+    print(f"  {name:<16} reader CPU {cpu * 1000:>8.1f} ms  wall {wall * 1000:>8.1f} ms  {megabytes / wall:>8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare reader-thread CPU of print() and the queued loggers')
+    parser.add_argument('captures', nargs='+', help='Raw MJPEG files recorded with libcamera-vid --codec mjpeg')
+    parser.add_argument('--chunk-size', type=int, default=32768, help='Bytes per simulated pipe read')
+    parser.add_argument('--drain-delay', type=float, default=0.0, help='Seconds the log consumer sleeps per 4 KB read')
+    parser.add_argument('--pipe-size', type=int, default=4096, help='Pipe buffer size in bytes, like a busy journald socket')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per variant, the best one is reported')
+    args = parser.parse_args()
+
+    for capture in args.captures:
+        with open(capture, 'rb') as file:
+            data = file.read()
+        print(f"{capture}: {len(data) / (1024 * 1024):.1f} MB, {args.chunk_size} byte reads, drain delay {args.drain_delay}s")
+        run('print', legacy_reader, data, args.chunk_size, args.drain_delay, args.pipe_size, args.repeat)
+        app.setup_logging('INFO')
+        run('logging INFO', logging_reader, data, args.chunk_size, args.drain_delay, args.pipe_size, args.repeat)
+        app.setup_logging('DEBUG')
+        run('logging DEBUG', logging_reader, data, args.chunk_size, args.drain_delay, args.pipe_size, args.repeat)
+        app.setup_logging('INFO')
+
+
+if __name__ == '__main__':
+    main()
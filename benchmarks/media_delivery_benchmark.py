@@ -0,0 +1,102 @@
+"""Throughput benchmark for gallery downloads, send_file against send_media.
+
+Run it on the Pi with a recording from the gallery, for example:
+
+    python benchmarks/media_delivery_benchmark.py static/gallery/video_cam_0_20250101_120000.mjpeg
+
+Both paths are served by the Werkzeug server that app.run uses, on a loopback port in
+this process. Full downloads show the cost of copying the file through Python versus
+socket.sendfile, the seek runs fetch random byte ranges like a video player scrubbing
+through a clip. CPU time covers server and client together, so compare the two rows
+rather than reading it as the server's share.
+"""
+import argparse
+import http.client
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, send_file
+from werkzeug.serving import make_server
+
+from app import send_media
+
+
+def make_app(path):
+    bench = Flask(__name__)
+
+    @bench.route('/legacy')
+    def legacy():
+        return send_file(path, as_attachment=True)
+
+    @bench.route('/ranged')
+    def ranged():
+        return send_media(path, as_attachment=True)
+
+    return bench
+
+
+def fetch(port, url, headers, buffer):
+    """Read one response into buffer and return the number of body bytes"""
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('GET', url, headers=headers)
+    response = connection.getresponse()
+    if response.status not in (200, 206):
+        raise RuntimeError(f"{url} answered {response.status}")
+    received = 0
+    view = memoryview(buffer)
+    while True:
+        count = response.readinto(view)
+        if not count:
+            break
+        received += count
+    connection.close()
+    return received
+
+
+def run(name, port, url, requests, buffer):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    received = 0
+    for headers in requests:
+        received += fetch(port, url, headers, buffer)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    megabytes = received / (1024 * 1024)
+    print(f"  {name:<16} {megabytes:>9.1f} MB  {megabytes / elapsed:>8.1f} MB/s  "
+          f"{len(requests) / elapsed:>8.1f} req/s  {cpu / max(megabytes, 1e-9) * 1000:>7.2f} ms CPU/MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare gallery download throughput of send_file and send_media')
+    parser.add_argument('media', help='Gallery file to serve, ideally a large MJPEG or MP4 recording')
+    parser.add_argument('--downloads', type=int, default=5, help='Full downloads per path')
+    parser.add_argument('--seeks', type=int, default=200, help='Random range requests per path')
+    parser.add_argument('--range-size', type=int, default=1024 * 1024, help='Bytes per range request')
+    args = parser.parse_args()
+
+    size = os.path.getsize(args.media)
+    server = make_server('127.0.0.1', 0, make_app(os.path.abspath(args.media)), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    random.seed(0)
+    range_size = min(args.range_size, size)
+    starts = [random.randrange(0, size - range_size + 1) for _ in range(args.seeks)]
+    seeks = [{'Range': f"bytes={start}-{start + range_size - 1}"} for start in starts]
+    buffer = bytearray(1024 * 1024)
+
+    print(f"{args.media}: {size / (1024 * 1024):.1f} MB")
+    for url in ('/legacy', '/ranged'):
+        run(f"{url[1:]} full", port, url, [{}] * args.downloads, buffer)
+    for url in ('/legacy', '/ranged'):
+        run(f"{url[1:]} seek", port, url, seeks, buffer)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,10 @@ let frameCount = 0;
 let fps = 0;
 let fpsUpdateInterval;
 
+// Server-sent status stream, replaces polling when the browser supports it
+let statusEvents = null;
+let serverRecordingChecked = false;
+
 // Initialize recording functionality
 document.addEventListener('DOMContentLoaded', function() {
     // Get camera number from URL
@@ -22,7 +26,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const match = urlPath.match(/control_camera_(\d+)/);
     if (match) {
         currentCameraNum = match[1];
-        checkRecordingStatus();
+        if (!window.EventSource) {
+            checkRecordingStatus();
+        }
         
         // Initialize FPS counter
         initFpsCounter();
@@ -109,6 +115,24 @@ function initFpsCounter() {
             latencyWrapper.appendChild(latencyLabel);
             latencyWrapper.appendChild(latencyDisplay);
             
+            // Create free disk space display with label
+            const storageWrapper = document.createElement('div');
+            storageWrapper.style.display = 'flex';
+            storageWrapper.style.justifyContent = 'space-between';
+            storageWrapper.style.marginTop = '4px';
+            storageWrapper.style.fontSize = '12px';
+            
+            const storageLabel = document.createElement('span');
+            storageLabel.textContent = 'Free:';
+            storageLabel.style.opacity = '0.8';
+            
+            const storageDisplay = document.createElement('span');
+            storageDisplay.id = 'storageDisplay';
+            storageDisplay.textContent = '--';
+            
+            storageWrapper.appendChild(storageLabel);
+            storageWrapper.appendChild(storageDisplay);
+            
             // Create recording indicator
             const recIndicator = document.createElement('div');
             recIndicator.id = 'recordingIndicator';
@@ -121,15 +145,81 @@ function initFpsCounter() {
             infoContainer.appendChild(fpsWrapper);
             infoContainer.appendChild(resWrapper);
             infoContainer.appendChild(latencyWrapper);
+            infoContainer.appendChild(storageWrapper);
             infoContainer.appendChild(recIndicator);
             
             // Add container to the camera container
             cameraContainer.appendChild(infoContainer);
             
-            // Update FPS display every second
-            fpsUpdateInterval = setInterval(fetchAndUpdateFps, 1000);
+            if (window.EventSource) {
+                // The server pushes changes, no request per second per tab
+                subscribeStatusEvents();
+            } else {
+                // Update FPS display every second
+                fpsUpdateInterval = setInterval(fetchAndUpdateFps, 1000);
+            }
+        }
+    }
+}
+
+// Listen to the server's status stream for this camera
+function subscribeStatusEvents() {
+    statusEvents = new EventSource(`/events?camera=${currentCameraNum}`);
+    
+    statusEvents.addEventListener('camera', event => {
+        const data = JSON.parse(event.data);
+        updateCameraInfo(data);
+        
+        // The first update tells whether the camera was already recording
+        if (!serverRecordingChecked) {
+            serverRecordingChecked = true;
+            if (data.recording) {
+                updateUIForRecording(true);
+            }
+        }
+    });
+    
+    statusEvents.addEventListener('storage', event => {
+        updateStorageInfo(JSON.parse(event.data));
+    });
+    
+    statusEvents.addEventListener('settings', event => {
+        // Pages that post settings listen for this to learn when their request is live
+        document.dispatchEvent(new CustomEvent('settingsapplied', { detail: JSON.parse(event.data) }));
+    });
+    
+    statusEvents.addEventListener('pipeline_error', event => {
+        const data = JSON.parse(event.data);
+        if (data.message) {
+            console.error('Camera pipeline error:', data.message);
+            if (document.getElementById('recordingAlert')) {
+                showRecordingAlert(`Camera error: ${data.message}`, 'danger');
+            }
         }
+    });
+    
+    window.addEventListener('beforeunload', () => statusEvents.close());
+}
+
+// Update the free disk space display
+function updateStorageInfo(data) {
+    const storageDisplay = document.getElementById('storageDisplay');
+    if (!storageDisplay || typeof data.disk_free === 'undefined') {
+        return;
     }
+    
+    const freeGb = data.disk_free / (1024 * 1024 * 1024);
+    let text = `${freeGb.toFixed(1)} GB`;
+    if (data.time_to_full) {
+        // Recording is running, show how long the card lasts at the current bitrate
+        const minutes = Math.floor(data.time_to_full / 60);
+        text += minutes >= 60 ? ` (${Math.floor(minutes / 60)}h ${minutes % 60}m)` : ` (${minutes}m)`;
+    }
+    storageDisplay.textContent = text;
+    
+    // Warn once the card gets close to the retention janitor's free space limit, not at all when it has none
+    const minFree = (data.policy && data.policy.min_free_mb ? data.policy.min_free_mb : 0) * 1024 * 1024;
+    storageDisplay.style.color = minFree > 0 && data.disk_free < minFree * 2 ? '#ff4d4d' : '';
 }
 
 // Fetch FPS from server and update display